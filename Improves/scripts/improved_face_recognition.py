@@ -6,14 +6,31 @@ import base64
 from io import BytesIO
 import mysql.connector
 import os
+import time
+import threading
 from datetime import datetime
-from sklearn.metrics.pairwise import cosine_similarity
+
+# Versão do pipeline que gera os encodings da galeria (CLAHE + HOG upsample 2 +
+# CNN, modelo large, 10 jitters). Uma galeria salva com outra versão é refeita.
+GALLERY_VERSION = 'clahe-hog2-cnn1-large-j10'
+
+# Pesos do score combinado (quanto menor, mais similar)
+COSINE_WEIGHT = 0.3
+EUCLIDEAN_WEIGHT = 0.7
 
 class ImprovedFaceRecognition:
-    def __init__(self, db_config):
+    def __init__(self, db_config, gallery_path=None, refresh_interval=60):
         self.db_config = db_config
         self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
         
+        # Galeria pré-calculada: encodings de todas as fotos cadastradas, salvos
+        # em disco e atualizados só para fotos novas/alteradas
+        self.gallery_path = gallery_path or os.path.join(os.getcwd(), 'cache', 'improved_gallery.npz')
+        self.refresh_interval = refresh_interval
+        self.gallery = None
+        self.last_gallery_check = 0
+        self.gallery_lock = threading.Lock()
+        
     def get_db_connection(self):
         return mysql.connector.connect(**self.db_config)
     
@@ -134,20 +151,224 @@ class ImprovedFaceRecognition:
         
         return all_encodings
     
-    def calculate_similarity_score(self, encoding1, encoding2):
+    def load_gallery(self):
         """
-        Calcula score de similaridade usando múltiplas métricas
+        Lê a galeria salva em disco. Cada linha de `encodings` pertence à foto
+        de mesmo índice em `foto_ids` (várias linhas por foto: HOG e CNN).
+        """
+        empty = {
+            'foto_ids': np.empty(0, dtype=np.int64),
+            'user_ids': np.empty(0, dtype=np.int64),
+            'nomes': np.empty(0, dtype=object),
+            'datas': np.empty(0, dtype=object),
+            'counts': np.empty(0, dtype=np.int64),
+            'encodings': np.empty((0, 128), dtype=np.float64)
+        }
+        if not os.path.exists(self.gallery_path):
+            return empty
+        
+        try:
+            with np.load(self.gallery_path, allow_pickle=False) as data:
+                if str(data['versao']) != GALLERY_VERSION:
+                    print("Galeria salva com outra versão do pipeline, recalculando")
+                    return empty
+                return {
+                    'foto_ids': data['foto_ids'],
+                    'user_ids': data['user_ids'],
+                    'nomes': data['nomes'].astype(object),
+                    'datas': data['datas'].astype(object),
+                    'counts': data['counts'],
+                    'encodings': data['encodings']
+                }
+        except Exception as e:
+            print(f"Erro ao ler a galeria salva ({e}), recalculando")
+            return empty
+    
+    def save_gallery(self, gallery):
+        """Grava a galeria em disco de forma atômica (arquivo temporário + rename)"""
+        os.makedirs(os.path.dirname(self.gallery_path) or '.', exist_ok=True)
+        tmp_path = f'{self.gallery_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                versao=np.array(GALLERY_VERSION),
+                foto_ids=gallery['foto_ids'],
+                user_ids=gallery['user_ids'],
+                nomes=gallery['nomes'].astype(str),
+                datas=gallery['datas'].astype(str),
+                counts=gallery['counts'],
+                encodings=gallery['encodings']
+            )
+        os.replace(tmp_path, self.gallery_path)
+    
+    def update_gallery(self):
+        """
+        Sincroniza a galeria com o banco: só as fotos novas ou com data de
+        captura alterada passam pelo extract_multiple_encodings; fotos
+        removidas saem da galeria. Retorna a galeria atualizada.
+        """
+        gallery = self.get_gallery()
+        
+        conn = self.get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT u.id, u.nome, f.id, f.caminho, f.data_captura
+            FROM usuario u 
+            INNER JOIN fotos_usuario f ON u.id = f.usuario_id
+            ORDER BY u.id, f.id
+        """)
+        fotos = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        
+        saved = {
+            int(foto_id): (str(data), start, count)
+            for foto_id, data, start, count in zip(
+                gallery['foto_ids'], gallery['datas'],
+                np.cumsum(gallery['counts']) - gallery['counts'], gallery['counts']
+            )
+        }
+        
+        foto_ids, user_ids, nomes, datas, counts, blocks = [], [], [], [], [], []
+        recalculadas = 0
+        
+        for user_id, nome, foto_id, caminho, data_captura in fotos:
+            data = str(data_captura)
+            
+            if foto_id in saved and saved[foto_id][0] == data:
+                # Foto já processada e não alterada: reaproveita os encodings
+                _, start, count = saved[foto_id]
+                encodings = gallery['encodings'][start:start + count]
+            else:
+                img_path = os.path.join(os.getcwd(), caminho.lstrip('/'))
+                if not os.path.exists(img_path):
+                    continue
+                
+                encodings = self.extract_multiple_encodings(Image.open(img_path))
+                recalculadas += 1
+                # Foto sem rosto fica registrada com 0 encodings (não é reprocessada
+                # a cada atualização, só se a data de captura mudar)
+                encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, 128)
+            
+            foto_ids.append(foto_id)
+            user_ids.append(user_id)
+            nomes.append(nome)
+            datas.append(data)
+            counts.append(len(encodings))
+            blocks.append(encodings)
+        
+        gallery = {
+            'foto_ids': np.asarray(foto_ids, dtype=np.int64),
+            'user_ids': np.asarray(user_ids, dtype=np.int64),
+            'nomes': np.asarray(nomes, dtype=object),
+            'datas': np.asarray(datas, dtype=object),
+            'counts': np.asarray(counts, dtype=np.int64),
+            'encodings': np.concatenate(blocks) if blocks else np.empty((0, 128), dtype=np.float64)
+        }
+        
+        removidas = len(set(saved) - set(foto_ids))
+        if recalculadas or removidas or not os.path.exists(self.gallery_path):
+            self.save_gallery(gallery)
+            print(f"Galeria atualizada: {len(foto_ids)} fotos ({recalculadas} processadas, {removidas} removidas)")
+        
+        return gallery
+    
+    def refresh_gallery(self):
+        """
+        Sincroniza a galeria com o banco e publica o resultado. Roda fora das
+        requisições de login (no __main__ ou na thread de start_gallery_refresher):
+        a consulta e o encoding das fotos novas não seguram o gallery_lock.
+        """
+        try:
+            gallery = self.update_gallery()
+        except Exception as e:
+            # Banco indisponível: segue com a última galeria conhecida (memória ou disco)
+            print(f"Erro ao atualizar a galeria: {e}")
+            return self.get_gallery()
+        
+        with self.gallery_lock:
+            self.gallery = gallery
+            self.last_gallery_check = time.time()
+        return gallery
+    
+    def start_gallery_refresher(self):
+        """Thread que atualiza a galeria a cada `refresh_interval` segundos"""
+        def loop():
+            while True:
+                time.sleep(self.refresh_interval)
+                self.refresh_gallery()
+        
+        thread = threading.Thread(target=loop, name='gallery-refresher', daemon=True)
+        thread.start()
+        return thread
+    
+    def get_gallery(self):
+        """
+        Galeria usada no login (somente leitura): a última publicada por
+        refresh_gallery ou, antes disso, a salva em disco
+        """
+        with self.gallery_lock:
+            if self.gallery is None:
+                self.gallery = self.load_gallery()
+            return self.gallery
+    
+    def calculate_similarity_scores(self, captured_encodings, db_encodings, starts=None):
+        """
+        Score combinado de todos os encodings capturados (M, 128) contra todos
+        os da galeria (N, 128) de uma vez: distância euclidiana pela expansão
+        ||a||² - 2a·b + ||b||² e similaridade coseno pelo produto dos vetores
+        normalizados, ambos a partir do mesmo produto matricial.
+        
+        Com `starts` (início do bloco de linhas de cada usuário, linhas
+        agrupadas por usuário) também calcula o menor score de cada usuário e,
+        por encoding capturado, o melhor e o segundo melhor usuário.
         """
-        # Distância euclidiana (face_recognition padrão)
-        euclidean_distance = face_recognition.face_distance([encoding1], encoding2)[0]
+        captured = np.asarray(captured_encodings, dtype=np.float64).reshape(-1, 128)
+        db = np.asarray(db_encodings, dtype=np.float64).reshape(-1, 128)
+        
+        captured_sq = np.einsum('ij,ij->i', captured, captured)
+        db_sq = np.einsum('ij,ij->i', db, db)
+        dot = captured @ db.T
+        
+        euclidean = np.sqrt(np.maximum(captured_sq[:, None] - 2.0 * dot + db_sq[None, :], 0.0))
+        norms = np.sqrt(captured_sq)[:, None] * np.sqrt(db_sq)[None, :]
+        cosine = dot / np.maximum(norms, 1e-12)
+        combined = (1 - cosine) * COSINE_WEIGHT + euclidean * EUCLIDEAN_WEIGHT
         
-        # Similaridade coseno
-        cosine_sim = cosine_similarity([encoding1], [encoding2])[0][0]
+        result = {'combined': combined, 'euclidean': euclidean, 'cosine': cosine}
+        if starts is None or not combined.size:
+            return result
         
-        # Score combinado (quanto menor, mais similar)
-        combined_score = (1 - cosine_sim) * 0.3 + euclidean_distance * 0.7
+        # Menor score de cada usuário (por encoding capturado)
+        user_scores = np.minimum.reduceat(combined, starts, axis=1)
         
-        return combined_score, euclidean_distance, cosine_sim
+        # Melhor e segundo melhor usuário por seleção parcial (sem ordenar tudo)
+        if user_scores.shape[1] > 1:
+            top2 = np.argpartition(user_scores, 1, axis=1)[:, :2]
+            top2_scores = np.take_along_axis(user_scores, top2, axis=1)
+            order = np.argsort(top2_scores, axis=1)
+            top2 = np.take_along_axis(top2, order, axis=1)
+            top2_scores = np.take_along_axis(top2_scores, order, axis=1)
+        else:
+            top2 = np.concatenate([np.zeros((len(captured), 1), dtype=np.int64),
+                                   np.full((len(captured), 1), -1)], axis=1)
+            top2_scores = np.concatenate([user_scores, np.full((len(captured), 1), np.inf)], axis=1)
+        
+        result.update({
+            'user_scores': user_scores,
+            'best_user': top2[:, 0],
+            'best_score': top2_scores[:, 0],
+            'second_user': top2[:, 1],
+            'second_score': top2_scores[:, 1]
+        })
+        return result
+    
+    def calculate_similarity_score(self, encoding1, encoding2):
+        """
+        Calcula score de similaridade usando múltiplas métricas
+        """
+        scores = self.calculate_similarity_scores([encoding1], [encoding2])
+        return scores['combined'][0, 0], scores['euclidean'][0, 0], scores['cosine'][0, 0]
     
     def process_and_recognize_face(self, image_data, confidence_threshold=0.45):
         """
@@ -175,62 +396,50 @@ class ImprovedFaceRecognition:
                     'message': 'Nenhum rosto detectado com qualidade adequada. Tente melhorar a iluminação e posicionamento.'
                 }
             
-            # Buscar usuários no banco
-            conn = self.get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT u.id, u.nome, f.caminho 
-                FROM usuario u 
-                INNER JOIN fotos_usuario f ON u.id = f.usuario_id
-            """)
-            usuarios = cursor.fetchall()
-            cursor.close()
-            conn.close()
+            # Encodings da galeria já calculados (não reprocessa as fotos a cada login)
+            gallery = self.get_gallery()
             
-            best_matches = []
+            if not len(gallery['encodings']):
+                return {
+                    'success': False,
+                    'message': 'Usuário não reconhecido. Verifique se você está cadastrado no sistema.'
+                }
             
-            for usuario in usuarios:
-                user_id, nome, caminho = usuario
-                
-                # Carregar e processar imagem do banco
-                img_path = os.path.join(os.getcwd(), caminho.lstrip('/'))
-                if not os.path.exists(img_path):
-                    continue
-                
-                db_image = Image.open(img_path)
-                db_encodings = self.extract_multiple_encodings(db_image)
-                
-                if not db_encodings:
-                    continue
-                
-                # Comparar todos os encodings capturados com todos do banco
-                best_score = float('inf')
-                best_details = None
-                
-                for captured_encoding in captured_encodings:
-                    for db_encoding in db_encodings:
-                        score, euclidean, cosine = self.calculate_similarity_score(
-                            captured_encoding, db_encoding
-                        )
-                        
-                        if score < best_score:
-                            best_score = score
-                            best_details = {
-                                'euclidean': euclidean,
-                                'cosine': cosine,
-                                'combined': score
-                            }
-                
-                if best_score < confidence_threshold:
-                    best_matches.append({
-                        'user_id': user_id,
-                        'nome': nome,
-                        'score': best_score,
-                        'details': best_details
-                    })
+            # Linhas agrupadas por usuário (um usuário pode ter várias fotos);
+            # a galeria já é montada em ordem de usuário
+            row_users = np.repeat(gallery['user_ids'], gallery['counts'])
+            row_names = np.repeat(gallery['nomes'], gallery['counts'])
+            db_encodings = gallery['encodings']
+            if np.any(row_users[1:] < row_users[:-1]):
+                order = np.argsort(row_users, kind='stable')
+                row_users, row_names, db_encodings = row_users[order], row_names[order], db_encodings[order]
+            starts = np.flatnonzero(np.concatenate([[True], row_users[1:] != row_users[:-1]]))
             
-            # Ordenar por melhor score
-            best_matches.sort(key=lambda x: x['score'])
+            # Todos os capturados contra toda a galeria em uma única passada
+            scores = self.calculate_similarity_scores(captured_encodings, db_encodings, starts)
+            
+            # Melhor score de cada usuário considerando todos os encodings capturados
+            user_scores = scores['user_scores'].min(axis=0)
+            candidates = np.flatnonzero(user_scores < confidence_threshold)
+            candidates = candidates[np.argsort(user_scores[candidates])][:2]
+            
+            best_matches = []
+            for user in candidates:
+                # Detalhes do par (capturado, encoding do banco) com o menor score
+                start = starts[user]
+                end = starts[user + 1] if user + 1 < len(starts) else len(db_encodings)
+                block = scores['combined'][:, start:end]
+                probe, row = np.unravel_index(np.argmin(block), block.shape)
+                best_matches.append({
+                    'user_id': int(row_users[start]),
+                    'nome': row_names[start],
+                    'score': float(user_scores[user]),
+                    'details': {
+                        'euclidean': float(scores['euclidean'][probe, start + row]),
+                        'cosine': float(scores['cosine'][probe, start + row]),
+                        'combined': float(block[probe, row])
+                    }
+                })
             
             if best_matches:
                 best_match = best_matches[0]
@@ -302,6 +511,11 @@ if __name__ == "__main__":
     # Inicializar sistema
     face_system = ImprovedFaceRecognition(db_config)
     
+    # Pré-calcula (ou atualiza) a galeria em disco antes do primeiro login e
+    # mantém ela em dia em segundo plano
+    face_system.refresh_gallery()
+    face_system.start_gallery_refresher()
+    
     # Exemplo de reconhecimento
     # result = face_system.process_and_recognize_face(image_data)
     # print(result)
@@ -1,22 +1,34 @@
-from flask import Flask, render_template, request, jsonify, Response, flash, redirect, url_for
+from flask import Flask, render_template, request, jsonify, Response, flash, redirect, url_for, stream_with_context
 from flask_cors import CORS
 import cv2
-import face_recognition
 import numpy as np
 import base64
-from datetime import datetime
+from datetime import date, datetime, timedelta
 import os
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+from PIL import Image, ImageFilter
 from io import BytesIO, StringIO
 import mysql.connector
+from mysql.connector import pooling
 from dotenv import load_dotenv
 import time
 import logging
 import csv
+import json
 import requests
-from threading import Lock
-import io
+import click
+from contextlib import nullcontext
+from threading import Lock, Thread, Event
+import atexit
 from flasgger import Swagger 
+from werkzeug.utils import secure_filename
+from face_gallery import FaceGallery, SharedGalleryStore, configure_index, summarize_encodings
+from login_audit import LoginAuditWriter, prune_encodings
+from face_pipeline import LOGIN_MAX_WIDTH, decode_image, enhance_for_matching, normalize_enrollment_face
+from face_encoder import FaceEncoderPool, EncoderUnavailable
+from login_debounce import RecentRecognitions
+from student_directory import EnrolledIds, RemoteListCache, StudentDirectory
+from bulk_enrollment import PhotoDownloadError, download_photo, iter_downloaded_batches, make_session
+import face_encoder
 
 
 # Configurar logging
@@ -65,198 +77,730 @@ db_config = {
     'port': int(os.getenv('DB_PORT', 3306))
 }
 
+# Pool de conexões: evita handshake TCP + autenticação a cada requisição.
+# O mysql-connector limita o tamanho do pool a 32 conexões.
+DB_POOL_SIZE = min(int(os.getenv('DB_POOL_SIZE', 5)), 32)
+_db_pool = {'pool': None, 'pid': None}
+_db_pool_lock = Lock()
+
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'fotos')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # Cache para encodings do banco (melhora performance)
-encodings_cache = {}
+encodings_gallery = FaceGallery.empty()
 last_cache_update = 0
 CACHE_DURATION = 300  # 5 minutos
+# Marca d'água da última atualização do cache: maior foto/data de captura e
+# maior encoding/data de criação já lidos
+EMPTY_HIGH_WATER = {'foto_id': 0, 'data_captura': None, 'encoding_id': 0, 'data_criacao': None}
+cache_high_water = dict(EMPTY_HIGH_WATER)
+
+# Versão do pipeline que gerou os encodings gravados no banco. Encodings gerados
+# com outro modelo/detector são recalculados a partir da foto na próxima carga.
+ENCODING_MODEL = 'small'
+DETECTOR_VERSION = 'hog-up1-w800'
+
+# Vários encodings por usuário (fotos anteriores e logins reconhecidos): na galeria
+# cada usuário vira o protótipo (média) + até GALLERY_MAX_EXEMPLARS exemplares.
+# Logins com distância até LOGIN_ENCODING_MAX_DISTANCE (0 desativa) guardam o
+# encoding da captura, no máximo um por usuário a cada LOGIN_ENCODING_INTERVAL
+# segundos; o banco mantém os MAX_LOGIN_ENCODINGS mais recentes de cada usuário
+# e os MAX_HISTORY_ENCODINGS das fotos substituídas.
+GALLERY_MAX_EXEMPLARS = int(os.getenv('GALLERY_MAX_EXEMPLARS', 4))
+LOGIN_ENCODING_MAX_DISTANCE = float(os.getenv('LOGIN_ENCODING_MAX_DISTANCE', 0.35))
+LOGIN_ENCODING_INTERVAL = float(os.getenv('LOGIN_ENCODING_INTERVAL', 86400))
+MAX_LOGIN_ENCODINGS = int(os.getenv('MAX_LOGIN_ENCODINGS', 10))
+MAX_HISTORY_ENCODINGS = int(os.getenv('MAX_HISTORY_ENCODINGS', 5))
+_login_encoding_saved = {}
+
+# Cascata de detecção: HOG rápido -> HOG com upsample -> CNN (opcional, lento em CPU).
+# Cada estágio só roda se couber no orçamento de tempo, limitando o pior caso do login.
+# Fotos de cadastro podem ser grandes e não estão no caminho crítico do login,
+# por isso têm um orçamento próprio.
+FACE_DETECTION_ENABLE_CNN = os.getenv('FACE_DETECTION_ENABLE_CNN', 'false').lower() == 'true'
+face_encoder_config = {
+    'detection_budget': float(os.getenv('FACE_DETECTION_BUDGET', 1.5)),
+    'batch_budget': float(os.getenv('FACE_BATCH_DETECTION_BUDGET', 4.0)),
+    'enrollment_budget': float(os.getenv('FACE_ENROLLMENT_DETECTION_BUDGET', 10.0)),
+    'enable_cnn': FACE_DETECTION_ENABLE_CNN,
+    'cnn_budget': float(os.getenv('FACE_DETECTION_CNN_BUDGET', 3.0)),
+    'encoding_model': ENCODING_MODEL
+}
+
+# Detecção e encoding rodam em um pool de processos por worker (modelos do dlib
+# pré-carregados), fora da thread da requisição. 0 processa na própria thread.
+FACE_ENCODER_PROCESSES = int(os.getenv('FACE_ENCODER_PROCESSES', 2))
+encoder_pool = FaceEncoderPool(
+    face_encoder_config,
+    processes=FACE_ENCODER_PROCESSES,
+    max_pending=int(os.getenv('FACE_ENCODER_QUEUE', 0)) or None,
+    timeout=float(os.getenv('FACE_ENCODER_TIMEOUT', 10.0))
+)
+atexit.register(encoder_pool.shutdown)
+
+# Carga inicial do cache: fotos sem encoding gravado são processadas em um pool
+# temporário com todos os núcleos (BACKFILL_PROCESSES, 0 = todos) quando passam
+# de BACKFILL_PARALLEL_MIN; os encodings são gravados a cada BACKFILL_COMMIT_EVERY
+BACKFILL_PROCESSES = int(os.getenv('BACKFILL_PROCESSES', 0)) or None
+BACKFILL_PARALLEL_MIN = int(os.getenv('BACKFILL_PARALLEL_MIN', 16))
+BACKFILL_CHUNKSIZE = int(os.getenv('BACKFILL_CHUNKSIZE', 8))
+BACKFILL_COMMIT_EVERY = 200
+
+# Alunos da API PHP (/api/alunos_php): lista remota em cache por ALUNOS_PHP_TTL
+# segundos, revalidada com ETag/Last-Modified; o conjunto de alunos com foto é
+# relido do banco a cada ALUNOS_FOTO_TTL segundos ou quando algum worker
+# cadastra uma foto (invalidação da galeria compartilhada)
+ALUNOS_PHP_URL = os.getenv('ALUNOS_PHP_URL', "https://apppanorama.jsatecsistemas.com.br/api_alunos_para_reconhecimento.php")
+ALUNOS_PHP_TTL = int(os.getenv('ALUNOS_PHP_TTL', 300))
+ALUNOS_FOTO_TTL = int(os.getenv('ALUNOS_FOTO_TTL', 300))
+ALUNOS_PAGE_SIZE = 50
+
+# Cadastro em lote (/api/cadastro_lote e `flask cadastro-lote`): fotos baixadas
+# com BULK_DOWNLOAD_WORKERS conexões simultâneas, processadas e gravadas em lotes
+# de BULK_ENROLL_BATCH alunos (um commit por lote)
+BULK_DOWNLOAD_WORKERS = int(os.getenv('BULK_DOWNLOAD_WORKERS', 8))
+BULK_ENROLL_BATCH = int(os.getenv('BULK_ENROLL_BATCH', 50))
+# A rota responde dentro do timeout do gunicorn; listas maiores vão pelo comando
+BULK_ENROLL_MAX_API = int(os.getenv('BULK_ENROLL_MAX_API', 100))
+PHOTO_DOWNLOAD_TIMEOUT = (float(os.getenv('PHOTO_CONNECT_TIMEOUT', 5)), float(os.getenv('PHOTO_READ_TIMEOUT', 20)))
+photo_session = make_session(pool_size=BULK_DOWNLOAD_WORKERS)
+
+# Rejeição por ambiguidade no login: se o 2º usuário mais próximo estiver a menos
+# de MATCH_MARGIN do 1º, o login é recusado (0 desativa; `margin` na requisição
+# sobrepõe). MATCH_TOP_K candidatos vêm da mesma busca, sem varrer a galeria de novo.
+MATCH_MARGIN = float(os.getenv('MATCH_MARGIN', 0))
+MATCH_TOP_K = int(os.getenv('MATCH_TOP_K', 3))
+# Menor rosto (largura e altura em pixels do quadro reduzido) aceito no login individual
+MIN_FACE_SIZE = int(os.getenv('MIN_FACE_SIZE', 30))
+# Largura máxima do quadro no login em lote (vários rostos, alguns pequenos)
+BATCH_MAX_WIDTH = int(os.getenv('BATCH_MAX_WIDTH', 1280))
+
+# Logins repetidos: o mesmo usuário reconhecido de novo em menos de
+# LOGIN_DEBOUNCE_SECONDS (0 desativa) não gera outro registro e recebe a resposta
+# do primeiro reconhecimento. Os workers combinam pelos marcadores em
+# RECENT_LOGINS_DIR (vazio: só a memória de cada worker).
+LOGIN_DEBOUNCE_SECONDS = float(os.getenv('LOGIN_DEBOUNCE_SECONDS', 60))
+RECENT_LOGINS_DIR = os.getenv(
+    'RECENT_LOGINS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'recent_logins')
+)
+recent_logins = RecentRecognitions(LOGIN_DEBOUNCE_SECONDS, RECENT_LOGINS_DIR or None)
+
+# Atualização em segundo plano (stale-while-revalidate): as requisições de login
+# usam sempre o snapshot atual da galeria e nunca esperam pela reconstrução
+CACHE_BACKGROUND_REFRESH = os.getenv('CACHE_BACKGROUND_REFRESH', 'true').lower() == 'true'
+CACHE_POLL_INTERVAL = float(os.getenv('CACHE_POLL_INTERVAL', 0.5))
+cache_refresh_lock = Lock()
+cache_refresh_requested = Event()
+cache_refresh_stats = {
+    'refreshing': False,
+    'last_duration': None,
+    'last_error': None
+}
+_cache_refresher = {'thread': None, 'pid': None}
+_cache_refresher_lock = Lock()
+
+# Galeria compartilhada entre os workers do gunicorn (matriz mapeada em memória).
+# Só um worker por vez consulta o banco e publica uma nova geração; os demais
+# apenas mapeiam a geração publicada. GALLERY_STORE_DIR vazio desativa.
+GALLERY_STORE_DIR = os.getenv(
+    'GALLERY_STORE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'gallery')
+)
+gallery_store = SharedGalleryStore(GALLERY_STORE_DIR) if GALLERY_STORE_DIR else None
+gallery_generation = 0
+
+# Índice da busca 1:N: 'exact' (padrão) ou 'ivf' (aproximado, para galerias muito
+# grandes). Abaixo de GALLERY_INDEX_MIN_SIZE encodings a busca é sempre exata.
+# Atualizações incrementais reaproveitam os centróides do IVF até que as linhas
+# incluídas/removidas passem de GALLERY_INDEX_RETRAIN_DRIFT do tamanho treinado.
+GALLERY_INDEX = os.getenv('GALLERY_INDEX', 'exact')
+configure_index(
+    GALLERY_INDEX,
+    min_size=int(os.getenv('GALLERY_INDEX_MIN_SIZE', 20000)),
+    n_probe=int(os.getenv('GALLERY_INDEX_NPROBE', 8)),
+    retrain_drift=float(os.getenv('GALLERY_INDEX_RETRAIN_DRIFT', 0.2))
+)
+
+def get_db_pool():
+    """Pool de conexões do processo (criado sob demanda em cada worker do gunicorn)"""
+    with _db_pool_lock:
+        if _db_pool['pool'] is None or _db_pool['pid'] != os.getpid():
+            _db_pool['pool'] = pooling.MySQLConnectionPool(
+                pool_name=f"panorama_{os.getpid()}",
+                pool_size=DB_POOL_SIZE,
+                pool_reset_session=True,
+                **db_config
+            )
+            _db_pool['pid'] = os.getpid()
+        return _db_pool['pool']
 
 def get_db_connection():
+    """
+    Obtém uma conexão do pool. O pool verifica se a conexão ainda está viva
+    (e reconecta) antes de entregá-la; conn.close() a devolve ao pool.
+    """
+    try:
+        return get_db_pool().get_connection()
+    except mysql.connector.errors.PoolError:
+        # Pool esgotado: não bloqueia a requisição, abre uma conexão avulsa
+        logger.warning(f"Pool de conexões esgotado ({DB_POOL_SIZE}), abrindo conexão avulsa")
+    except mysql.connector.Error as e:
+        logger.error(f"Erro ao conectar ao banco: {e}")
+        return None
+    
     try:
-        connection = mysql.connector.connect(**db_config)
-        return connection
+        return mysql.connector.connect(**db_config)
     except mysql.connector.Error as e:
         logger.error(f"Erro ao conectar ao banco: {e}")
         return None
 
-def load_encodings_cache():
-    """Carrega encodings do banco em cache para melhor performance"""
-    global encodings_cache, last_cache_update
+# Registros de login gravados em lote por uma thread de fundo, fora da resposta;
+# o mesmo lote atualiza a presença diária agregada (PRESENCA_DIARIA=false desliga,
+# para bancos ainda sem a migração 004)
+login_audit = LoginAuditWriter(
+    lambda: get_db_connection(),
+    batch_size=int(os.getenv('LOGIN_AUDIT_BATCH_SIZE', 100)),
+    flush_interval=float(os.getenv('LOGIN_AUDIT_FLUSH_INTERVAL', 1.0)),
+    encoding_version=(ENCODING_MODEL, DETECTOR_VERSION),
+    max_login_encodings=MAX_LOGIN_ENCODINGS,
+    daily_attendance=os.getenv('PRESENCA_DIARIA', 'true').lower() == 'true'
+)
+atexit.register(login_audit.stop)
+
+def encoding_to_blob(encoding):
+    """Serializa o encoding de 128 posições para gravação em coluna BLOB"""
+    return np.asarray(encoding, dtype=np.float64).tobytes()
+
+def encoding_from_blob(blob):
+    """Reconstrói o encoding a partir do BLOB gravado no banco"""
+    return np.frombuffer(blob, dtype=np.float64)
+
+def extract_gallery_encoding(rgb_image):
+    """Extrai o encoding de referência de uma foto cadastrada (imagem RGB) no pool de encoding"""
+    return encoder_pool.run(face_encoder.extract_gallery_encoding, rgb_image)
+
+def photo_path(caminho):
+    """Caminho no disco de uma foto gravada em fotos_usuario (/static/fotos/...)"""
+    return os.path.join(os.getcwd(), caminho.lstrip('/'))
+
+def encode_photo_file(caminho):
+    """Lê uma foto de static/fotos e extrai seu encoding de referência"""
+    img_path = photo_path(caminho)
     
-    current_time = time.time()
-    if current_time - last_cache_update < CACHE_DURATION and encodings_cache:
-        return encodings_cache
+    if not os.path.exists(img_path):
+        logger.warning(f"Arquivo não encontrado: {img_path}")
+        return None
+    
+    # A leitura do arquivo também é feita no processo do pool
+    return encoder_pool.run(face_encoder.encode_photo_path, img_path)
+
+def encode_pending_photos(pendentes):
+    """
+    Gera (foto pendente, encoding) para as fotos sem encoding gravado. Poucas
+    fotos passam pelo pool das requisições; cargas grandes (partida a frio)
+    usam um pool temporário com todos os núcleos, com progresso no log.
+    """
+    if len(pendentes) < BACKFILL_PARALLEL_MIN:
+        for pendente in pendentes:
+            try:
+                yield pendente, encode_photo_file(pendente[3])
+            except Exception as e:
+                logger.error(f"Erro ao processar {pendente[1]}: {e}")
+        return
+    
+    validos = []
+    for pendente in pendentes:
+        img_path = photo_path(pendente[3])
+        if os.path.exists(img_path):
+            validos.append((pendente, img_path))
+        else:
+            logger.warning(f"Arquivo não encontrado: {img_path}")
+    
+    total = len(validos)
+    logger.info(f"Calculando {total} encodings a partir das fotos em paralelo...")
+    start_time = last_log = time.time()
+    
+    results = encoder_pool.map_bulk(
+        face_encoder.encode_photo_path_safe,
+        [img_path for _, img_path in validos],
+        processes=BACKFILL_PROCESSES,
+        chunksize=BACKFILL_CHUNKSIZE
+    )
+    for done, ((pendente, _), (encoding, erro)) in enumerate(zip(validos, results), 1):
+        if erro:
+            logger.error(f"Erro ao processar {pendente[1]}: {erro}")
+        yield pendente, encoding
+        
+        if time.time() - last_log >= 5 or done == total:
+            last_log = time.time()
+            elapsed = last_log - start_time
+            logger.info(
+                f"Encodings calculados: {done}/{total} fotos em {elapsed:.1f}s "
+                f"({done / max(elapsed, 1e-6):.1f} fotos/s)"
+            )
+
+def save_user_encoding(cursor, usuario_id, foto_id, encoding):
+    """Grava (ou substitui) o encoding associado a uma foto do usuário"""
+    cursor.execute("""
+        INSERT INTO encodings_usuario (usuario_id, foto_id, encoding, modelo, versao_detector)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            usuario_id = VALUES(usuario_id),
+            encoding = VALUES(encoding),
+            modelo = VALUES(modelo),
+            versao_detector = VALUES(versao_detector),
+            data_criacao = CURRENT_TIMESTAMP
+    """, (usuario_id, foto_id, encoding_to_blob(encoding), ENCODING_MODEL, DETECTOR_VERSION))
+
+def upsert_user(cursor, id_usuario_php, nome, cpf):
+    """
+    Retorna o id local do usuário do PHP, criando-o se ainda não existir, em
+    um único comando (chave única em id_usuario_php). LAST_INSERT_ID(id) faz o
+    lastrowid apontar para o usuário existente no caso de duplicidade.
+    """
+    cursor.execute("""
+        INSERT INTO usuario (nome, cpf, id_usuario_php) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+    """, (nome, cpf, id_usuario_php))
+    return cursor.lastrowid
+
+def upsert_user_photo(cursor, usuario_id, caminho):
+    """
+    Grava a foto atual do usuário (chave única em fotos_usuario.usuario_id).
+    Retorna (id da foto, substituída?); numa substituição o encoding da foto
+    anterior passa a valer como histórico.
+    """
+    cursor.execute("""
+        INSERT INTO fotos_usuario (usuario_id, caminho) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE
+            caminho = VALUES(caminho),
+            data_captura = CURRENT_TIMESTAMP,
+            id = LAST_INSERT_ID(id)
+    """, (usuario_id, caminho))
+    foto_id = cursor.lastrowid
+    
+    # rowcount: 1 = linha inserida, 2 = linha existente atualizada
+    replaced = cursor.rowcount == 2
+    if replaced:
+        archive_photo_encoding(cursor, usuario_id, foto_id)
+    return foto_id, replaced
+
+def archive_photo_encoding(cursor, usuario_id, foto_id):
+    """
+    Antes de substituir a foto do usuário, mantém o encoding da foto antiga
+    como histórico (sem foto associada), limitado aos MAX_HISTORY_ENCODINGS
+    mais recentes.
+    """
+    cursor.execute("""
+        UPDATE encodings_usuario SET foto_id = NULL, origem = 'historico'
+        WHERE foto_id = %s
+    """, (foto_id,))
+    prune_encodings(cursor, usuario_id, 'historico', MAX_HISTORY_ENCODINGS)
+
+def record_login(usuario_id, distance, encoding):
+    """
+    Enfileira o login reconhecido. Capturas bem próximas da galeria também
+    guardam o encoding (no máximo um por usuário a cada LOGIN_ENCODING_INTERVAL),
+    que entra nos exemplares do usuário na próxima atualização do cache.
+    """
+    now = time.time()
+    if (LOGIN_ENCODING_MAX_DISTANCE and distance <= LOGIN_ENCODING_MAX_DISTANCE
+            and now - _login_encoding_saved.get(usuario_id, 0) >= LOGIN_ENCODING_INTERVAL):
+        _login_encoding_saved[usuario_id] = now
+        return login_audit.record(usuario_id, encoding=encoding_to_blob(encoding))
+    return login_audit.record(usuario_id)
+
+def refresh_encodings_cache():
+    """
+    Atualiza o cache de encodings a partir do banco.
+    
+    A primeira carga lê todas as fotos cadastradas; as seguintes buscam apenas
+    as fotos inseridas ou alteradas desde a última marca d'água e removem do
+    cache os usuários que não possuem mais foto. A nova galeria substitui a
+    anterior em uma única atribuição, sem bloquear quem está lendo.
+    """
+    with cache_refresh_lock:
+        cache_refresh_stats['refreshing'] = True
+        start_time = time.time()
+        try:
+            if gallery_store is None:
+                gallery = _load_encodings_delta()
+            else:
+                gallery = _refresh_shared_gallery()
+            cache_refresh_stats['last_error'] = None
+            return gallery
+        except Exception as e:
+            cache_refresh_stats['last_error'] = str(e)
+            raise
+        finally:
+            cache_refresh_stats['refreshing'] = False
+            cache_refresh_stats['last_duration'] = round(time.time() - start_time, 3)
+
+def _refresh_shared_gallery():
+    """Atualiza a galeria compartilhada: só o worker construtor consulta o banco"""
+    with gallery_store.builder_lock() as is_builder:
+        # Parte sempre da geração mais recente, publicada por qualquer worker
+        adopt_published_gallery()
+        
+        if is_builder:
+            # Lido antes da consulta: invalidações posteriores disparam nova rodada
+            invalidation_stamp = gallery_store.invalidation_stamp()
+            previous_gallery = encodings_gallery
+            gallery = _load_encodings_delta()
+            
+            changed = gallery is not previous_gallery and (len(gallery) or len(previous_gallery))
+            if changed or not gallery_store.current_generation():
+                generation = gallery_store.publish(gallery, {
+                    key: value.isoformat() if isinstance(value, datetime) else value
+                    for key, value in cache_high_water.items()
+                })
+                logger.info(f"Galeria compartilhada publicada (geração {generation}, {len(gallery)} usuários)")
+            
+            gallery_store.mark_checked(invalidation_stamp)
+            # Troca a cópia privada pela matriz mapeada, compartilhada com os outros workers
+            adopt_published_gallery()
+    
+    return encodings_gallery
+
+def adopt_published_gallery():
+    """Passa a usar a geração mais recente publicada na galeria compartilhada"""
+    global encodings_gallery, cache_high_water, last_cache_update, gallery_generation
+    
+    generation = gallery_store.current_generation()
+    if generation and generation != gallery_generation:
+        gallery, metadata = gallery_store.load(generation)
+        encodings_gallery = gallery.prepare()
+        cache_high_water = {
+            key: metadata.get(key, default) for key, default in EMPTY_HIGH_WATER.items()
+        }
+        for key in ('data_captura', 'data_criacao'):
+            if cache_high_water[key]:
+                cache_high_water[key] = datetime.fromisoformat(cache_high_water[key])
+        gallery_generation = generation
+        logger.info(f"Galeria compartilhada mapeada (geração {generation}, {len(gallery)} usuários)")
+    
+    if gallery_generation:
+        last_cache_update = gallery_store.last_checked()
+
+def _load_encodings_delta():
+    """
+    Lê do banco as fotos e os encodings novos/alterados desde a marca d'água e
+    aplica na galeria. Retorna a galeria atual (o mesmo objeto se nada mudou).
     
-    logger.info("Atualizando cache de encodings...")
+    1. Fotos novas/alteradas sem encoding da versão atual são processadas e
+       o encoding é gravado (uma única vez).
+    2. Usuários com encodings gravados depois da marca (fotos ou logins)
+       têm todos os seus encodings relidos e resumidos.
+    """
+    global encodings_gallery, last_cache_update, cache_high_water
+    
+    current_time = time.time()
+    incremental = cache_high_water['foto_id'] > 0
+    logger.info("Atualizando cache de encodings (incremental)..." if incremental else "Atualizando cache de encodings...")
     start_time = time.time()
     
     conn = get_db_connection()
     if not conn:
-        return {}
+        raise RuntimeError("Banco de dados indisponível")
     
     try:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT u.id, u.nome, f.caminho 
+        query = """
+            SELECT u.id, u.nome, f.id, f.caminho, f.data_captura, e.modelo, e.versao_detector
             FROM usuario u 
             INNER JOIN fotos_usuario f ON u.id = f.usuario_id
-        """)
-        usuarios = cursor.fetchall()
+            LEFT JOIN encodings_usuario e ON e.foto_id = f.id
+        """
+        params = ()
+        if incremental:
+            # Fotos novas (id acima da marca) ou substituídas (data_captura atualizada)
+            query += " WHERE f.id > %s"
+            params = (cache_high_water['foto_id'],)
+            if cache_high_water['data_captura'] is not None:
+                query += " OR f.data_captura >= %s"
+                params += (cache_high_water['data_captura'],)
+        query += " ORDER BY f.data_captura, f.id"
         
-        new_cache = {}
+        cursor.execute(query, params)
+        fotos = cursor.fetchall()
         
-        for user_id, nome, caminho in usuarios:
-            img_path = os.path.join(os.getcwd(), caminho.lstrip('/'))
+        high_water = dict(cache_high_water)
+        changed_users = set()
+        pendentes = []
+        
+        for user_id, nome, foto_id, caminho, data_captura, modelo, versao in fotos:
+            high_water['foto_id'] = max(high_water['foto_id'], foto_id)
+            if data_captura is not None and (high_water['data_captura'] is None or data_captura > high_water['data_captura']):
+                high_water['data_captura'] = data_captura
             
-            if not os.path.exists(img_path):
-                logger.warning(f"Arquivo não encontrado: {img_path}")
+            changed_users.add(user_id)
+            if modelo != ENCODING_MODEL or versao != DETECTOR_VERSION:
+                # Foto sem encoding gravado: processa uma única vez e persiste
+                pendentes.append((user_id, nome, foto_id, caminho))
+        
+        recalculados = 0
+        for (user_id, nome, foto_id, _), encoding in encode_pending_photos(pendentes):
+            if encoding is None:
                 continue
             
-            try:
-                # Carregar e processar imagem
-                image = cv2.imread(img_path)
-                if image is None:
-                    continue
-                
-                # Redimensionar para acelerar processamento
-                height, width = image.shape[:2]
-                if width > 800:
-                    scale = 800 / width
-                    new_width = int(width * scale)
-                    new_height = int(height * scale)
-                    image = cv2.resize(image, (new_width, new_height))
-                
-                rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                
-                # Extrair encoding com configurações otimizadas
-                face_locations = face_recognition.face_locations(
-                    rgb_image, 
-                    model="hog",  # HOG é mais rápido que CNN
-                    number_of_times_to_upsample=1  # Reduzir para acelerar
-                )
-                
-                if face_locations:
-                    encodings = face_recognition.face_encodings(
-                        rgb_image, 
-                        face_locations,
-                        num_jitters=1,  # Reduzir para acelerar
-                        model="small"   # Modelo menor e mais rápido
-                    )
-                    
-                    if encodings:
-                        new_cache[user_id] = {
-                            'nome': nome,
-                            'encoding': encodings[0],
-                            'path': caminho
-                        }
-                        logger.info(f"Encoding carregado para {nome}")
-                
-            except Exception as e:
-                logger.error(f"Erro ao processar {nome}: {e}")
-                continue
-        
-        encodings_cache = new_cache
-        last_cache_update = current_time
+            save_user_encoding(cursor, user_id, foto_id, encoding)
+            recalculados += 1
+            if recalculados % BACKFILL_COMMIT_EVERY == 0:
+                # Grava aos poucos: um reinício no meio da carga não perde o trabalho feito
+                conn.commit()
         
-        load_time = time.time() - start_time
-        logger.info(f"Cache atualizado com {len(new_cache)} usuários em {load_time:.2f}s")
+        if recalculados:
+            if recalculados % BACKFILL_COMMIT_EVERY:
+                conn.commit()
+            logger.info(f"{recalculados} encodings recalculados a partir das fotos e gravados no banco")
         
-        return encodings_cache
+        if incremental:
+            # Encodings gravados desde a última carga (logins reconhecidos, fotos reprocessadas)
+            cursor.execute("""
+                SELECT DISTINCT usuario_id FROM encodings_usuario
+                WHERE id > %s OR data_criacao >= %s
+            """, (high_water['encoding_id'], high_water['data_criacao'] or datetime.min))
+            changed_users.update(row[0] for row in cursor.fetchall())
         
-    finally:
-        cursor.close()
-        conn.close()
-
-def extract_face_encoding_fast(image):
-    """Versão otimizada para extrair encoding rapidamente"""
-    try:
-        start_time = time.time()
+        changed = _load_user_encodings(cursor, None if not incremental else changed_users, high_water)
         
-        # Converter para RGB se necessário
-        if len(image.shape) == 3 and image.shape[2] == 3:
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if incremental:
+            # Usuários cuja foto foi apagada saem do cache
+            cursor.execute("SELECT DISTINCT usuario_id FROM fotos_usuario")
+            ativos = {row[0] for row in cursor.fetchall()}
+            removed = set(encodings_gallery.ids.tolist()) - ativos
+            # Usuários ainda sem nenhum encoding válido também
+            removed |= (changed_users - set(changed)) & set(encodings_gallery.ids.tolist())
+            
+            # A marca d'água é inclusiva (>=, para não perder gravações no mesmo
+            # segundo), então as últimas linhas são relidas a cada rodada: quem
+            # não mudou não gera uma nova galeria (nem uma nova geração publicada)
+            for user_id in encodings_gallery.unchanged_users(changed):
+                del changed[user_id]
+            
+            if changed or removed:
+                encodings_gallery = encodings_gallery.updated(changed, removed).prepare()
         else:
-            rgb_image = image
-        
-        # Redimensionar para acelerar (máximo 640px de largura)
-        height, width = rgb_image.shape[:2]
-        if width > 640:
-            scale = 640 / width
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            rgb_image = cv2.resize(rgb_image, (new_width, new_height))
-        
-        # Detectar faces com configurações rápidas
-        face_locations = face_recognition.face_locations(
-            rgb_image,
-            model="hog",  # Mais rápido
-            number_of_times_to_upsample=1  # Menos upsampling = mais rápido
-        )
-        
-        if not face_locations:
-            return None, "Nenhum rosto detectado"
-        
-        # Pegar a maior face
-        largest_face = max(face_locations, key=lambda face: (face[2] - face[0]) * (face[1] - face[3]))
-        top, right, bottom, left = largest_face
-        
-        # Verificar tamanho mínimo
-        face_width = right - left
-        face_height = bottom - top
+            removed = set()
+            encodings_gallery = FaceGallery.from_cache(changed).prepare()
         
-        if face_width < 30 or face_height < 30:
-            return None, "Face muito pequena"
+        cache_high_water = high_water
+        last_cache_update = current_time
         
-        # Extrair encoding com configurações rápidas
-        encodings = face_recognition.face_encodings(
-            rgb_image,
-            [largest_face],
-            num_jitters=1,  # Menos jitters = mais rápido
-            model="small"   # Modelo menor = mais rápido
+        load_time = time.time() - start_time
+        logger.info(
+            f"Cache atualizado com {len(encodings_gallery)} usuários em {load_time:.2f}s "
+            f"({len(changed)} novos/alterados, {len(removed)} removidos)"
         )
         
-        if not encodings:
-            return None, "Não foi possível extrair características"
-        
-        processing_time = time.time() - start_time
-        logger.info(f"Encoding extraído em {processing_time:.2f}s")
-        
-        return encodings[0], "Sucesso"
+        return encodings_gallery
         
-    except Exception as e:
-        logger.error(f"Erro ao extrair encoding: {e}")
-        return None, f"Erro: {str(e)}"
+    finally:
+        cursor.close()
+        conn.close()
 
-    cache_lock = Lock()
+def _load_user_encodings(cursor, user_ids, high_water, chunk_size=1000):
+    """
+    Lê todos os encodings válidos dos usuários informados (None = todos que
+    têm foto) e resume cada usuário em protótipo + exemplares.
+    Retorna user_id -> {'nome', 'encodings'} e avança a marca d'água.
+    """
+    query = """
+        SELECT e.usuario_id, u.nome, e.id, e.data_criacao, e.encoding
+        FROM encodings_usuario e
+        INNER JOIN usuario u ON u.id = e.usuario_id
+        WHERE e.modelo = %s AND e.versao_detector = %s
+          AND EXISTS (SELECT 1 FROM fotos_usuario f WHERE f.usuario_id = e.usuario_id)
+    """
+    if user_ids is None:
+        batches = [()]
+    else:
+        user_ids = sorted(user_ids)
+        batches = [tuple(user_ids[i:i + chunk_size]) for i in range(0, len(user_ids), chunk_size)]
     
-    # Tenta usar o modelo CNN se o HOG falhar
-    def find_face_encodings(image):
-        # Tenta primeiro com o HOG, que é mais rápido
-        face_locations = face_recognition.face_locations(image, model='hog')
+    encodings = {}
+    for batch in batches:
+        batch_query = query
+        if batch:
+            batch_query += f" AND e.usuario_id IN ({', '.join(['%s'] * len(batch))})"
+        # Do mais recente para o mais antigo dentro de cada usuário
+        batch_query += " ORDER BY e.usuario_id, e.data_criacao DESC, e.id DESC"
         
-        # Se o HOG não encontrar rostos, tenta com o CNN (mais lento, porém mais preciso)
-        if not face_locations:
-            print("Modelo HOG falhou. Tentando com o modelo CNN...")
-            face_locations = face_recognition.face_locations(image, model='cnn')
+        cursor.execute(batch_query, (ENCODING_MODEL, DETECTOR_VERSION) + batch)
+        for user_id, nome, encoding_id, data_criacao, blob in cursor.fetchall():
+            high_water['encoding_id'] = max(high_water['encoding_id'], encoding_id)
+            if data_criacao is not None and (high_water['data_criacao'] is None or data_criacao > high_water['data_criacao']):
+                high_water['data_criacao'] = data_criacao
+            
+            user = encodings.setdefault(user_id, {'nome': nome, 'rows': []})
+            user['rows'].append(encoding_from_blob(blob))
+    
+    return {
+        user_id: {
+            'nome': user['nome'],
+            'encodings': summarize_encodings(user['rows'], GALLERY_MAX_EXEMPLARS)
+        }
+        for user_id, user in encodings.items()
+    }
+
+def invalidate_encodings_cache():
+    """
+    Avisa todos os workers que há fotos novas/alteradas no banco. Cada um
+    aplica a atualização incremental em até CACHE_POLL_INTERVAL segundos.
+    """
+    if gallery_store is not None:
+        gallery_store.invalidate()
+    cache_refresh_requested.set()
+
+def _invalidation_pending():
+    # Depois de uma falha, espera o intervalo normal de nova tentativa
+    return (
+        gallery_store is not None
+        and not cache_refresh_stats['last_error']
+        and gallery_store.invalidation_pending()
+    )
+
+def _cache_refresher_loop():
+    next_refresh = 0
+    while True:
+        if time.time() >= next_refresh or cache_refresh_requested.is_set() or _invalidation_pending():
+            cache_refresh_requested.clear()
+            try:
+                refresh_encodings_cache()
+            except Exception as e:
+                logger.error(f"Erro ao atualizar cache em segundo plano: {e}")
             
-        # Se encontrou com algum dos modelos, extrai os encodings
-        if face_locations:
-            return face_recognition.face_encodings(image, known_face_locations=face_locations)
+            # Enquanto a primeira carga não der certo, tenta de novo em poucos segundos
+            interval = CACHE_DURATION if last_cache_update else min(CACHE_DURATION, 5)
+            next_refresh = time.time() + interval
+        
+        elif gallery_store is not None and gallery_store.current_generation() != gallery_generation:
+            # Outro worker publicou uma nova geração: basta mapeá-la
+            try:
+                with cache_refresh_lock:
+                    adopt_published_gallery()
+            except Exception as e:
+                logger.error(f"Erro ao mapear galeria compartilhada: {e}")
+        
+        cache_refresh_requested.wait(CACHE_POLL_INTERVAL)
+
+def start_cache_refresher():
+    """Inicia a thread de atualização do cache (uma por processo/worker do gunicorn)"""
+    with _cache_refresher_lock:
+        thread = _cache_refresher['thread']
+        if thread is not None and thread.is_alive() and _cache_refresher['pid'] == os.getpid():
+            return
         
-        # Se nenhum modelo encontrou, retorna lista vazia
-        return []
+        thread = Thread(target=_cache_refresher_loop, name='cache-refresher', daemon=True)
+        thread.start()
+        _cache_refresher['thread'] = thread
+        _cache_refresher['pid'] = os.getpid()
+
+def start_background_services():
+    """
+    Prepara o processo para o login antes da primeira requisição: sobe o pool de
+    encoding (modelos carregados) e carrega a galeria. Chamado no boot de cada
+    worker do gunicorn (gunicorn.conf.py) e ao rodar o app.py diretamente.
+    """
+    encoder_pool.start()
+    if CACHE_BACKGROUND_REFRESH:
+        start_cache_refresher()
+    else:
+        try:
+            refresh_encodings_cache()
+        except Exception as e:
+            logger.error(f"Erro ao carregar a galeria na inicialização: {e}")
+
+def get_encodings_gallery():
+    """Retorna o snapshot atual da galeria sem esperar por atualizações"""
+    if CACHE_BACKGROUND_REFRESH:
+        start_cache_refresher()
+    elif time.time() - last_cache_update >= CACHE_DURATION:
+        try:
+            refresh_encodings_cache()
+        except Exception as e:
+            # Continua servindo o snapshot anterior (se houver)
+            logger.error(f"Erro ao atualizar cache: {e}")
+    return encodings_gallery
+
+def find_face_encodings(image):
+    """
+    Detecta os rostos pela cascata de detecção do login e extrai os encodings
+    no pool de encoding. Retorna (encodings, detecção); a detecção informa o
+    estágio que encontrou o rosto.
+    """
+    return encoder_pool.run(face_encoder.encode_login_frame, image)
+
+
+def find_batch_face_encodings(image):
+    """Como find_face_encodings, mas sem parar no primeiro estágio que encontra rostos (login em lote)"""
+    return encoder_pool.run(face_encoder.encode_batch_frame, image)
+
+
+def select_login_face(encodings, locations, min_size=MIN_FACE_SIZE):
+    """
+    Escolhe o maior rosto do quadro de login (a pessoa diante do totem).
+    Retorna o encoding, ou None se o rosto tiver menos de `min_size` pixels.
+    """
+    index = max(range(len(encodings)), key=lambda i: (locations[i][2] - locations[i][0]) * (locations[i][1] - locations[i][3]))
+    top, right, bottom, left = locations[index]
+    if right - left < min_size or bottom - top < min_size:
+        return None
+    return encodings[index]
 
 
 def find_face_locations_robust(image):
-    """Tenta detectar faces com HOG e faz fallback para CNN se falhar."""
-    # Tenta com HOG primeiro por ser mais rápido
-    face_locations = face_recognition.face_locations(image, model='hog')
-    if not face_locations:
-        logger.info("Detecção HOG falhou, tentando com CNN (mais lento)...")
-        face_locations = face_recognition.face_locations(image, model='cnn')
-    return face_locations
+    """Detecta faces pela cascata de cadastro (HOG rápido, HOG com upsample e CNN se habilitado)."""
+    detection = encoder_pool.run(face_encoder.detect_enrollment_faces, image)
+    if detection.locations:
+        logger.info(f"Face detectada no estágio {detection.stage} em {detection.elapsed:.2f}s")
+    else:
+        logger.info(f"Nenhuma face detectada em {detection.elapsed:.2f}s (estágios pulados: {detection.skipped})")
+    return detection.locations
+
+
+def classify_match(candidates, threshold, margin):
+    """
+    Decide o reconhecimento a partir dos candidatos da galeria (do mais
+    próximo para o mais distante). Retorna (aceito, ambíguo, distância do 2º).
+    """
+    _, best_match, best_distance = candidates[0]
+    second_distance = candidates[1][2] if len(candidates) > 1 else None
+    
+    # Outro usuário quase tão próximo quanto o melhor: melhor recusar do que errar a pessoa
+    ambiguous = (
+        margin > 0 and second_distance is not None
+        and best_distance <= threshold and second_distance - best_distance < margin
+    )
+    accepted = bool(best_match) and best_distance <= threshold and not ambiguous
+    return accepted, ambiguous, second_distance
+
+
+def read_request_image():
+    """
+    Lê a imagem enviada em qualquer formato aceito pelas rotas de foto:
+    multipart/form-data (campo `image`), corpo binário `image/jpeg`/`image/png`
+    (demais parâmetros na query string) ou JSON com a imagem em Base64.
+    Retorna (bytes da imagem ou None, demais parâmetros da requisição).
+    """
+    upload = request.files.get('image')
+    if upload:
+        return upload.read(), request.form
+    
+    if request.mimetype.startswith('image/'):
+        return request.get_data(), request.args
+    
+    data = request.get_json(silent=True) or {}
+    foto_base64 = data.get('image')
+    if not foto_base64:
+        return None, data
+    
+    # Remover cabeçalho do data URL
+    if ',' in foto_base64:
+        foto_base64 = foto_base64.split(',')[1]
+    
+    return base64.b64decode(foto_base64), data
 
 
 # Rota principal - serve o menu
@@ -284,24 +828,13 @@ def enhance_face_image_for_save(image):
         if not face_locations:
             return None, False, "Nenhuma face detectada na imagem para salvar."
             
-        # Pega a maior face
-        top, right, bottom, left = max(face_locations, key=lambda x: (x[2]-x[0])*(x[1]-x[3]))
-        
-        # Cropar a face diretamente da imagem original
-        face_image = pil_image.crop((left, top, right, bottom))
-        
-        # Redimensionar para um tamanho padrão para consistência
-        face_image = face_image.resize((300, 300), Image.Resampling.LANCZOS)
-        
-        # Normalização de contraste com equalização de histograma
-        gray_face = face_image.convert('L')
-        equalized_face = ImageOps.equalize(gray_face)
-        
-        # Converter de volta para RGB para salvar como JPEG
-        final_image = equalized_face.convert('RGB')
+        # Pega a maior face, recorta e normaliza (mesmo tratamento do cadastro em lote)
+        final_image = normalize_enrollment_face(pil_image, face_locations)
         
         return final_image, True, "Imagem processada e normalizada com sucesso."
         
+    except EncoderUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Erro em enhance_face_image_for_save: {e}")
         return None, False, f"Erro no processamento da imagem: {str(e)}"
@@ -341,9 +874,11 @@ def cadastro():
 
             # Baixar e processar a foto
             try:
-                # Fazer o download da imagem do servidor PHP
-                response = requests.get(foto_url, verify=False)  # verify=False para evitar problemas com SSL
-                if response.status_code != 200:
+                # Fazer o download da imagem do servidor PHP (sessão compartilhada, com timeout)
+                try:
+                    foto_bytes = download_photo(photo_session, foto_url, timeout=PHOTO_DOWNLOAD_TIMEOUT)
+                except PhotoDownloadError as e:
+                    logger.warning(f"Erro ao baixar a foto de {nome}: {e}")
                     if request.is_json:
                         return jsonify({'success': False, 'message': 'Erro ao baixar a foto'}), 400
                     else:
@@ -351,7 +886,7 @@ def cadastro():
                         return redirect(url_for('cadastro'))
 
                 # Converter a resposta em imagem
-                image = Image.open(BytesIO(response.content))
+                image = Image.open(BytesIO(foto_bytes))
                 
                 # Processar e extrair face
                 face_image, success, message = enhance_face_image_for_save(image)
@@ -363,6 +898,11 @@ def cadastro():
                         flash(f'Não foi possível processar a imagem do aluno: {message}', 'error')
                         return redirect(url_for('cadastro'))
 
+                # Extrair o encoding agora, para que o cache não precise reprocessar a foto
+                encoding = extract_gallery_encoding(np.array(face_image))
+                if encoding is None:
+                    logger.warning(f"Não foi possível extrair o encoding da foto de {nome}")
+
                 # Primeiro inserir o usuário
                 conn = get_db_connection()
                 cursor = conn.cursor()
@@ -371,14 +911,8 @@ def cadastro():
                     # Iniciar transação
                     cursor.execute("START TRANSACTION")
                     
-                    # Inserir usuário com id_usuario_php
-                    cursor.execute("""
-                        INSERT INTO usuario (nome, cpf, id_usuario_php)
-                        VALUES (%s, %s, %s)
-                    """, (nome, cpf, id_usuario_php))
-                    
-                    # Pegar o ID do usuário inserido
-                    usuario_id = cursor.lastrowid
+                    # Inserir usuário com id_usuario_php (ou reaproveitar o já cadastrado)
+                    usuario_id = upsert_user(cursor, id_usuario_php, nome, cpf)
 
                     # Gerar nome único para o arquivo
                     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -390,13 +924,17 @@ def cadastro():
                     
                     # Salvar o caminho no banco
                     db_filepath = f"/static/fotos/{filename}"
-                    cursor.execute("""
-                        INSERT INTO fotos_usuario (usuario_id, caminho)
-                        VALUES (%s, %s)
-                    """, (usuario_id, db_filepath))
+                    foto_id, _ = upsert_user_photo(cursor, usuario_id, db_filepath)
+                    
+                    if encoding is not None:
+                        save_user_encoding(cursor, usuario_id, foto_id, encoding)
                     
                     # Commit da transação
                     cursor.execute("COMMIT")
+                    
+                    # Todos os workers passam a reconhecer o novo usuário
+                    invalidate_encodings_cache()
+                    enrolled_php_ids.add(id_usuario_php)
 
                     if request.is_json:
                         return jsonify({'success': True, 'message': 'Usuário cadastrado com sucesso!'})
@@ -434,104 +972,421 @@ def cadastro():
         finally:
             if 'cursor' in locals():
                 cursor.close()
-            if 'conn' in locals():
+            if 'conn' in locals() and conn:
                 conn.close()
     
     return render_template('cadastro.html')
     
     
-@app.route('/api/alunos_php')
-def get_alunos_php():
+def load_enrolled_php_ids():
+    """IDs do PHP dos usuários que já têm foto no banco local"""
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Banco de dados indisponível")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT u.id_usuario_php
+            FROM usuario u
+            INNER JOIN fotos_usuario f ON u.id = f.usuario_id
+            WHERE u.id_usuario_php IS NOT NULL
+        """)
+        ids = {int(row[0]) for row in cursor.fetchall()}
+        cursor.close()
+        return ids
+    finally:
+        conn.close()
+
+
+alunos_php_cache = RemoteListCache(ALUNOS_PHP_URL, ttl=ALUNOS_PHP_TTL, timeout=15)
+enrolled_php_ids = EnrolledIds(
+    load_enrolled_php_ids,
+    ttl=ALUNOS_FOTO_TTL,
+    generation=lambda: gallery_store.invalidation_stamp() if gallery_store is not None else None
+)
+student_directory = StudentDirectory(alunos_php_cache, enrolled_php_ids)
+
+
+def _bulk_student(aluno):
     """
-    Obter Alunos sem Foto Registrada
-    Retorna alunos da API PHP externa que ainda não têm biometria cadastrada.
-    ---
-    tags:
-      - Integração Externa
-    responses:
-      200:
-        description: Lista de alunos.
-        schema:
-          type: array
-          items:
-            type: object
-            properties:
-              id:
-                type: integer
-              nome:
-                type: string
-      500:
-        description: Erro ao consultar a API externa.
+    Normaliza um aluno do lote. Aceita também os campos das linhas de
+    /api/alunos_php (id, nome_aluno, cpf_aluno), acrescidas de foto_url.
     """
+    if not isinstance(aluno, dict):
+        return None
+    
+    nome = str(aluno.get('nome') or aluno.get('nome_aluno') or '').strip()
+    foto_url = aluno.get('foto_url') or aluno.get('foto')
     try:
-        # 1. Obter todos os alunos da API PHP
-        url_php = "https://apppanorama.jsatecsistemas.com.br/api_alunos_para_reconhecimento.php"
-        response = requests.get(url_php, timeout=15, verify=False)
-        response.raise_for_status()
-        alunos_php = response.json()
-
-        # 2. Obter IDs dos usuários que já possuem foto no banco de dados local
-        ids_com_foto = set()
-        conn = get_db_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                # Seleciona os IDs de usuário do PHP que estão na tabela de usuários e têm uma foto associada
-                cursor.execute("""
-                    SELECT u.id_usuario_php 
-                    FROM usuario u
-                    INNER JOIN fotos_usuario f ON u.id = f.usuario_id
-                    WHERE u.id_usuario_php IS NOT NULL
-                """)
-                # Adiciona os IDs a um conjunto para uma verificação rápida
-                ids_com_foto = {row[0] for row in cursor.fetchall()}
-            except mysql.connector.Error as db_error:
-                logger.error(f"Erro ao consultar o banco de dados local: {db_error}")
-            finally:
-                if 'cursor' in locals() and cursor:
-                    cursor.close()
-                conn.close()
-
-        # 3. Filtrar a lista de alunos para remover aqueles que já têm foto
-        # O ID do aluno do PHP é um inteiro, então garantimos a conversão para comparação.
-        alunos_sem_foto = [
-            aluno for aluno in alunos_php 
-            if aluno.get('id') and int(aluno.get('id')) not in ids_com_foto
-        ]
-        
-        # 4. Retornar a lista filtrada como JSON
-        return jsonify(alunos_sem_foto)
+        id_usuario_php = int(aluno.get('id_usuario_php') or aluno.get('id'))
+    except (TypeError, ValueError):
+        return None
+    
+    if not nome or not foto_url:
+        return None
+    cpf = aluno.get('cpf') or aluno.get('cpf_aluno') or ''
+    return {'id_usuario_php': id_usuario_php, 'nome': nome, 'cpf': cpf, 'foto_url': foto_url}
 
-    except requests.exceptions.RequestException as e:
-        # Captura erros de conexão, timeout, etc.
-        logger.error(f"!!! ERRO [RequestException] ao chamar API PHP: {e}")
-        return jsonify({'success': False, 'message': f'Erro ao acessar a API do PHP: {str(e)}'}), 500
-    except ValueError as e:
-        # Captura erros de decodificação do JSON (ex: se o PHP retornar um erro HTML)
-        logger.error(f"!!! ERRO [ValueError] de JSON na API PHP: {e}")
-        return jsonify({'success': False, 'message': f'A API do PHP não retornou um JSON válido.'}), 500
-    except Exception as e:
-        logger.error(f"!!! ERRO [Geral] na rota /api/alunos_php: {e}")
-        return jsonify({'success': False, 'message': f'Ocorreu um erro inesperado: {str(e)}'}), 500
 
+def _existing_enrollments(cursor, ids_php):
+    """Retorna {id_usuario_php: (id local, id da foto ou None)} dos alunos já no banco"""
+    if not ids_php:
+        return {}
+    
+    placeholders = ', '.join(['%s'] * len(ids_php))
+    cursor.execute(f"""
+        SELECT u.id_usuario_php, u.id, MAX(f.id)
+        FROM usuario u
+        LEFT JOIN fotos_usuario f ON f.usuario_id = u.id
+        WHERE u.id_usuario_php IN ({placeholders})
+        GROUP BY u.id_usuario_php, u.id
+    """, tuple(ids_php))
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
 
-# Rota para captura de fotos
-@app.route('/captura_fotos')
-def captura_fotos():
-    return render_template('captura_fotos.html')
 
-# Rota para salvar foto
-@app.route('/salvar_foto', methods=['POST'])
-def salvar_foto():
+def _save_enrollment_batch(processed):
     """
-    Salvar Biometria de Aluno
-    Recebe os dados do usuário e sua foto em Base64, extrai o rosto e cadastra no banco.
-    ---
-    tags:
-      - Cadastro de Biometria
-    parameters:
-      - in: body
-        name: body
+    Grava um lote de fotos processadas [(aluno, JPEG, encoding)] em uma única
+    transação, no mesmo formato do /salvar_foto. Retorna o status de cada aluno.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Banco de dados indisponível")
+    
+    cursor = conn.cursor()
+    saved_files = []
+    statuses = []
+    try:
+        for aluno, jpeg, encoding in processed:
+            usuario_id = upsert_user(cursor, aluno['id_usuario_php'], aluno['nome'], aluno['cpf'])
+            
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            # O nome vem do JSON enviado: secure_filename impede caminhos fora de UPLOAD_FOLDER
+            filename = f"{secure_filename(aluno['nome']) or 'aluno'}_{aluno['id_usuario_php']}_{timestamp}.jpg"
+            with open(os.path.join(UPLOAD_FOLDER, filename), 'wb') as f:
+                f.write(jpeg)
+            saved_files.append(os.path.join(UPLOAD_FOLDER, filename))
+            db_filepath = f"/static/fotos/{filename}"
+            
+            foto_id, replaced = upsert_user_photo(cursor, usuario_id, db_filepath)
+            status = 'atualizado' if replaced else 'cadastrado'
+            
+            if encoding is not None:
+                save_user_encoding(cursor, usuario_id, foto_id, encoding)
+            statuses.append({'status': status, 'usuario_id': usuario_id, 'encoding_saved': encoding is not None})
+        
+        conn.commit()
+        return statuses
+    
+    except Exception:
+        conn.rollback()
+        for filepath in saved_files:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def _run_enrollment_job(fn, foto_bytes):
+    """Processa uma foto do lote no pool das requisições; fila cheia vira erro do aluno"""
+    try:
+        return encoder_pool.run(fn, foto_bytes)
+    except EncoderUnavailable as e:
+        return None, None, str(e)
+
+
+def summarize_enrollment(results):
+    """Quantidade de alunos por status do cadastro em lote"""
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    return summary
+
+
+def enroll_students_bulk(alunos, skip_existing=True):
+    """
+    Cadastra uma lista de alunos {id_usuario_php, nome, foto_url} (ou linhas
+    de /api/alunos_php com foto_url). As fotos são baixadas em paralelo, um lote à frente,
+    processadas no pool de encoding (pool temporário com todos os núcleos em
+    cargas grandes) e gravadas com um commit por lote. Retorna o resultado de
+    cada aluno, na ordem recebida.
+    """
+    results = [None] * len(alunos)
+    pending = []
+    for index, aluno in enumerate(alunos):
+        normalized = _bulk_student(aluno)
+        if normalized is None:
+            results[index] = {'status': 'invalido', 'message': 'Informe id_usuario_php, nome e foto_url'}
+        else:
+            pending.append((index, normalized))
+    
+    if skip_existing and pending:
+        conn = get_db_connection()
+        if not conn:
+            raise RuntimeError("Banco de dados indisponível")
+        try:
+            cursor = conn.cursor()
+            existing = _existing_enrollments(cursor, sorted({aluno['id_usuario_php'] for _, aluno in pending}))
+            cursor.close()
+        finally:
+            conn.close()
+        
+        remaining = []
+        for index, aluno in pending:
+            if existing.get(aluno['id_usuario_php'], (None, None))[1] is not None:
+                results[index] = {'status': 'ja_cadastrado', 'message': 'Aluno já possui foto cadastrada'}
+            else:
+                remaining.append((index, aluno))
+        pending = remaining
+    
+    if pending:
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        start_time = time.time()
+        done = 0
+        logger.info(f"Cadastro em lote: {len(pending)} alunos")
+        
+        batches = iter_downloaded_batches(
+            [aluno for _, aluno in pending],
+            batch_size=BULK_ENROLL_BATCH,
+            workers=BULK_DOWNLOAD_WORKERS,
+            timeout=PHOTO_DOWNLOAD_TIMEOUT,
+            session=photo_session
+        )
+        # Cargas pequenas passam pelo pool das requisições; as grandes usam todos os núcleos
+        if len(pending) < BACKFILL_PARALLEL_MIN:
+            bulk = nullcontext(lambda fn, items: [_run_enrollment_job(fn, item) for item in items])
+        else:
+            bulk = encoder_pool.bulk(processes=BACKFILL_PROCESSES, chunksize=BACKFILL_CHUNKSIZE)
+        
+        with bulk as bulk_map:
+            for batch in batches:
+                # Os lotes chegam na ordem da lista pendente
+                indexes = [index for index, _ in pending[done:done + len(batch)]]
+                downloaded = []
+                for index, (aluno, foto_bytes, erro) in zip(indexes, batch):
+                    if erro:
+                        results[index] = {'status': 'erro_download', 'message': erro}
+                    else:
+                        downloaded.append((index, aluno, foto_bytes))
+                
+                processed = []
+                photos = bulk_map(face_encoder.prepare_enrollment_photo_safe, [item[2] for item in downloaded])
+                for (index, aluno, _), (jpeg, encoding, erro) in zip(downloaded, photos):
+                    if erro:
+                        results[index] = {'status': 'erro', 'message': f'Erro no processamento da imagem: {erro}'}
+                    elif jpeg is None:
+                        results[index] = {'status': 'sem_rosto', 'message': 'Nenhuma face detectada na foto'}
+                    else:
+                        processed.append((index, aluno, jpeg, encoding))
+                
+                if processed:
+                    try:
+                        saved = _save_enrollment_batch([item[1:] for item in processed])
+                        for (index, _, _, _), status in zip(processed, saved):
+                            results[index] = status
+                    except Exception as e:
+                        logger.error(f"Erro ao gravar lote do cadastro: {e}")
+                        for index, _, _, _ in processed:
+                            results[index] = {'status': 'erro', 'message': f'Erro no banco de dados: {str(e)}'}
+                
+                done += len(batch)
+                elapsed = time.time() - start_time
+                logger.info(
+                    f"Cadastro em lote: {done}/{len(pending)} alunos em {elapsed:.1f}s "
+                    f"({done / max(elapsed, 1e-6):.1f} alunos/s)"
+                )
+        
+        # Todos os workers passam a reconhecer os novos alunos
+        invalidate_encodings_cache()
+        enrolled_php_ids.add(*[
+            aluno['id_usuario_php'] for index, aluno in pending
+            if results[index]['status'] in ('cadastrado', 'atualizado')
+        ])
+    
+    for aluno, result in zip(alunos, results):
+        aluno = aluno if isinstance(aluno, dict) else {}
+        result['id_usuario_php'] = aluno.get('id_usuario_php') or aluno.get('id')
+        result['nome'] = aluno.get('nome')
+    return results
+
+
+@app.route('/api/cadastro_lote', methods=['POST'])
+def cadastro_lote():
+    """
+    Cadastro em Lote
+    Cadastra vários alunos de uma vez a partir das fotos do servidor PHP.
+    Aceita também as linhas de /api/alunos_php (id, nome_aluno, cpf_aluno)
+    acrescidas de foto_url, até
+    BULK_ENROLL_MAX_API alunos por requisição; para turmas inteiras use o
+    comando `flask cadastro-lote`.
+    ---
+    tags:
+      - Cadastro de Biometria
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          properties:
+            alunos:
+              type: array
+              items:
+                type: object
+                properties:
+                  id_usuario_php:
+                    type: integer
+                  nome:
+                    type: string
+                  foto_url:
+                    type: string
+            atualizar:
+              type: boolean
+              description: Substitui a foto de quem já tem cadastro (padrão false)
+    responses:
+      200:
+        description: Status de cada aluno (cadastrado, atualizado, ja_cadastrado, erro_download, sem_rosto,
+          invalido, erro) e o resumo.
+      400:
+        description: Lista de alunos ausente.
+      413:
+        description: Mais de BULK_ENROLL_MAX_API alunos; use `flask cadastro-lote`.
+      500:
+        description: Erro de banco de dados.
+    """
+    data = request.get_json(silent=True)
+    alunos = data.get('alunos') if isinstance(data, dict) else data
+    if not isinstance(alunos, list) or not alunos:
+        return jsonify({'success': False, 'message': 'Envie a lista de alunos'}), 400
+    if len(alunos) > BULK_ENROLL_MAX_API:
+        return jsonify({
+            'success': False,
+            'message': (f'No máximo {BULK_ENROLL_MAX_API} alunos por requisição. Divida a lista ou use '
+                        '`flask --app app cadastro-lote alunos.json` no servidor.')
+        }), 413
+    
+    start_time = time.time()
+    try:
+        results = enroll_students_bulk(alunos, skip_existing=not (isinstance(data, dict) and data.get('atualizar')))
+    except Exception as e:
+        logger.error(f"Erro no cadastro em lote: {e}")
+        return jsonify({'success': False, 'message': f'Erro no cadastro em lote: {str(e)}'}), 500
+    
+    return jsonify({
+        'success': True,
+        'total': len(results),
+        'summary': summarize_enrollment(results),
+        'results': results,
+        'processing_time': round(time.time() - start_time, 2)
+    })
+
+
+@app.cli.command('cadastro-lote')
+@click.argument('arquivo', type=click.File('r', encoding='utf-8'))
+@click.option('--atualizar', is_flag=True, help='Substitui a foto de quem já tem cadastro')
+def cadastro_lote_command(arquivo, atualizar):
+    """Cadastra os alunos de um arquivo JSON (lista de {id_usuario_php, nome, foto_url}; '-' lê da entrada padrão)."""
+    data = json.load(arquivo)
+    alunos = data.get('alunos', []) if isinstance(data, dict) else data
+    results = enroll_students_bulk(alunos, skip_existing=not atualizar)
+    
+    # Só os alunos com problema, um por linha (fácil de filtrar/corrigir)
+    for result in results:
+        if result['status'] not in ('cadastrado', 'atualizado'):
+            click.echo(f"{result['id_usuario_php']}\t{result['nome']}\t{result['status']}\t{result.get('message', '')}")
+    summary = summarize_enrollment(results)
+    click.echo(', '.join(f'{status}: {count}' for status, count in sorted(summary.items())))
+
+
+@app.route('/api/alunos_php')
+def get_alunos_php():
+    """
+    Obter Alunos sem Foto Registrada
+    Retorna alunos da API PHP externa que ainda não têm biometria cadastrada.
+    A lista da API PHP fica em cache (ALUNOS_PHP_TTL) e continua sendo servida
+    se a API cair. Sem parâmetros retorna a lista completa; com `q`, `page` ou
+    `per_page` retorna uma página da busca por nome ou CPF.
+    ---
+    tags:
+      - Integração Externa
+    parameters:
+      - in: query
+        name: q
+        type: string
+        description: Trecho do nome (sem diferenciar acentos) ou do CPF
+      - in: query
+        name: page
+        type: integer
+      - in: query
+        name: per_page
+        type: integer
+    responses:
+      200:
+        description: Lista de alunos (ou página {items, total, page, per_page}).
+        schema:
+          type: array
+          items:
+            type: object
+            properties:
+              id:
+                type: integer
+              nome:
+                type: string
+      304:
+        description: Lista não mudou desde o ETag enviado em If-None-Match.
+      500:
+        description: Erro ao consultar a API externa.
+    """
+    try:
+        paginated = any(param in request.args for param in ('q', 'page', 'per_page'))
+        if paginated:
+            page = max(1, request.args.get('page', 1, type=int))
+            per_page = min(200, max(1, request.args.get('per_page', ALUNOS_PAGE_SIZE, type=int)))
+            payload = student_directory.search(request.args.get('q', ''), page, per_page)
+        else:
+            payload = student_directory.all()
+        
+        # A resposta só muda com uma nova lista do PHP ou um novo cadastro
+        response = jsonify(payload)
+        response.set_etag(f'alunos-{student_directory.version()}')
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    except requests.exceptions.RequestException as e:
+        # Captura erros de conexão, timeout, etc. (sem nenhuma cópia em cache)
+        logger.error(f"!!! ERRO [RequestException] ao chamar API PHP: {e}")
+        return jsonify({'success': False, 'message': f'Erro ao acessar a API do PHP: {str(e)}'}), 500
+    except ValueError as e:
+        # Captura erros de decodificação do JSON (ex: se o PHP retornar um erro HTML)
+        logger.error(f"!!! ERRO [ValueError] de JSON na API PHP: {e}")
+        return jsonify({'success': False, 'message': f'A API do PHP não retornou um JSON válido.'}), 500
+    except Exception as e:
+        logger.error(f"!!! ERRO [Geral] na rota /api/alunos_php: {e}")
+        return jsonify({'success': False, 'message': f'Ocorreu um erro inesperado: {str(e)}'}), 500
+
+
+# Rota para captura de fotos
+@app.route('/captura_fotos')
+def captura_fotos():
+    return render_template('captura_fotos.html')
+
+# Rota para salvar foto
+@app.route('/salvar_foto', methods=['POST'])
+def salvar_foto():
+    """
+    Salvar Biometria de Aluno
+    Recebe os dados do usuário e sua foto em Base64, extrai o rosto e cadastra no banco.
+    Também aceita multipart/form-data (arquivo no campo `image`) ou o JPEG binário
+    no corpo (`Content-Type: image/jpeg`, demais campos na query string).
+    ---
+    tags:
+      - Cadastro de Biometria
+    parameters:
+      - in: body
+        name: body
         required: true
         schema:
           type: object
@@ -561,46 +1416,32 @@ def salvar_foto():
             if not os.path.exists(UPLOAD_FOLDER):
                 os.makedirs(UPLOAD_FOLDER)
 
-            data = request.json
+            try:
+                foto_bytes, data = read_request_image()
+            except Exception as e:
+                return jsonify({'success': False, 'message': f'Erro ao decodificar imagem base64: {str(e)}'}), 400
+
             usuario_id_php = data.get('usuario_id_php')
             nome_usuario = data.get('nome')
             cpf_usuario = data.get('cpf') or ''
-            foto_base64 = data.get('image')
 
-            if not all([usuario_id_php, nome_usuario, foto_base64]):
+            if not all([usuario_id_php, nome_usuario, foto_bytes]):
                 return jsonify({'success': False, 'message': 'Dados incompletos (ID PHP, Nome e Foto são obrigatórios)'}), 400
 
-            if ',' in foto_base64:
-                foto_base64 = foto_base64.split(',')[1]
-
-            try:
-                foto_bytes = base64.b64decode(foto_base64)
-            except Exception as e:
-                return jsonify({'success': False, 'message': f'Erro ao decodificar imagem base64: {str(e)}'}), 400
-
             conn = get_db_connection()
             cursor = conn.cursor()
             
-            usuario_id_local = None
             try:
-                cursor.execute("SELECT id FROM usuario WHERE id_usuario_php = %s", (usuario_id_php,))
-                result = cursor.fetchone()
-                
-                if result:
-                    usuario_id_local = result[0]
-                else:
-                    cursor.execute(
-                        "INSERT INTO usuario (nome, cpf, id_usuario_php) VALUES (%s, %s, %s)",
-                        (nome_usuario, cpf_usuario, usuario_id_php)
-                    )
-                    usuario_id_local = cursor.lastrowid
-
                 image = Image.open(BytesIO(foto_bytes))
                 face_image, success, message = enhance_face_image_for_save(image)
                 
                 if not success:
                     return jsonify({'success': False, 'message': message}), 400
                 
+                encoding = extract_gallery_encoding(np.array(face_image))
+                if encoding is None:
+                    logger.warning(f"Não foi possível extrair o encoding da foto de {nome_usuario}")
+                
                 timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
                 filename = f"{nome_usuario.replace(' ', '_')}_{timestamp}.jpg"
                 filepath = os.path.join(UPLOAD_FOLDER, filename)
@@ -609,28 +1450,29 @@ def salvar_foto():
                 
                 db_filepath = f"/static/fotos/{filename}"
                 
-                cursor.execute("SELECT id FROM fotos_usuario WHERE usuario_id = %s", (usuario_id_local,))
-                existing_photo = cursor.fetchone()
+                # Usuário e foto gravados com INSERT ... ON DUPLICATE KEY UPDATE
+                # (a foto anterior, se houver, tem o encoding arquivado como histórico)
+                usuario_id_local = upsert_user(cursor, usuario_id_php, nome_usuario, cpf_usuario)
+                foto_id, _ = upsert_user_photo(cursor, usuario_id_local, db_filepath)
                 
-                if existing_photo:
-                    cursor.execute(
-                        "UPDATE fotos_usuario SET caminho = %s, data_captura = CURRENT_TIMESTAMP WHERE usuario_id = %s",
-                        (db_filepath, usuario_id_local)
-                    )
-                else:
-                    cursor.execute(
-                        "INSERT INTO fotos_usuario (usuario_id, caminho) VALUES (%s, %s)",
-                        (usuario_id_local, db_filepath)
-                    )
+                if encoding is not None:
+                    save_user_encoding(cursor, usuario_id_local, foto_id, encoding)
                 
                 conn.commit()
                 
+                # Todos os workers passam a reconhecer a nova foto
+                invalidate_encodings_cache()
+                enrolled_php_ids.add(usuario_id_php)
+                
                 return jsonify({
                     'success': True, 
                     'message': 'Foto salva com sucesso!',
                     'filepath': db_filepath
                 })
                 
+            except EncoderUnavailable as e:
+                conn.rollback()
+                return jsonify({'success': False, 'message': f'Servidor ocupado, tente novamente: {str(e)}'}), 503
             except Exception as e:
                 if conn:
                     conn.rollback()
@@ -654,6 +1496,7 @@ def verificar_qualidade_foto():
     """
     Verificar Qualidade de Foto
     Verifica se a foto enviada é elegível para extração de rosto e biometria.
+    Também aceita multipart/form-data (campo `image`) ou JPEG binário no corpo.
     ---
     tags:
       - Cadastro de Biometria
@@ -672,18 +1515,11 @@ def verificar_qualidade_foto():
         description: Retorna se a qualidade da foto está adequada ou inadequada.
     """
     try:
-        data = request.json
-        foto_base64 = data.get('image')
+        foto_bytes, _ = read_request_image()
         
-        if not foto_base64:
+        if not foto_bytes:
             return jsonify({'success': False, 'message': 'Nenhuma imagem fornecida'})
         
-        # Remover cabeçalho
-        if ',' in foto_base64:
-            foto_base64 = foto_base64.split(',')[1]
-        
-        # Decodificar
-        foto_bytes = base64.b64decode(foto_base64)
         image = Image.open(BytesIO(foto_bytes))
         
         # Verificar qualidade
@@ -709,6 +1545,11 @@ def verificar_qualidade_foto():
                 ]
             })
             
+    except EncoderUnavailable as e:
+        return jsonify({
+            'success': False,
+            'message': f'Servidor ocupado, tente novamente: {str(e)}'
+        }), 503
     except Exception as e:
         return jsonify({
             'success': False,
@@ -723,7 +1564,10 @@ def login():
 def process_image():
     """
     Login via Reconhecimento Facial
-    Versão otimizada do processamento de imagem
+    Versão otimizada do processamento de imagem. Além do JSON com Base64, aceita
+    multipart/form-data (arquivo no campo `image`, `threshold` como campo do
+    formulário) ou o JPEG binário no corpo (`Content-Type: image/jpeg`,
+    `threshold` na query string), evitando o custo de Base64 + JSON.
     ---
     tags:
       - Autenticação Facial
@@ -741,6 +1585,14 @@ def process_image():
               type: number
               description: Grau de tolerância para o reconhecimento (padrão 0.5)
               example: 0.5
+            margin:
+              type: number
+              description: Diferença mínima de distância entre o 1º e o 2º usuário; abaixo dela o login
+                é recusado como ambíguo (padrão MATCH_MARGIN, 0 desativa)
+              example: 0.05
+            top_k:
+              type: integer
+              description: Quantidade de candidatos retornados no debug (2 a 10, padrão MATCH_TOP_K)
     responses:
       200:
         description: Usuário Autenticado com Sucesso.
@@ -752,22 +1604,19 @@ def process_image():
     start_time = time.time()
     
     try:
-        # Validar dados
-        if not request.json or 'image' not in request.json:
-            return jsonify({
-                'success': False,
-                'message': 'Nenhuma imagem fornecida'
-            }), 400
-        
-        # Decodificar imagem
-        image_data = request.json['image']
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-        
         try:
-            # Converte a imagem de base64 para um array numpy
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
+            # Aceita multipart, corpo binário ou JSON com Base64
+            image_bytes, params = read_request_image()
+            
+            # Validar dados
+            if image_bytes is None:
+                return jsonify({
+                    'success': False,
+                    'message': 'Nenhuma imagem fornecida'
+                }), 400
+            
+            # Decodifica já reduzida (máx. LOGIN_MAX_WIDTH) direto para array RGB
+            np_image = decode_image(image_bytes, max_width=LOGIN_MAX_WIDTH)
         except Exception as e:
             logger.error(f"Erro ao decodificar imagem: {e}")
             return jsonify({
@@ -777,105 +1626,121 @@ def process_image():
 
         # Pré-processamento: Aplica realces de contraste e nitidez na imagem do login
         # para que ela se pareça mais com a foto de referência salva.
-        enhancer_contrast = ImageEnhance.Contrast(image)
-        image = enhancer_contrast.enhance(1.4)
-        enhancer_sharpness = ImageEnhance.Sharpness(image)
-        image = enhancer_sharpness.enhance(1.3)
-        
-        np_image = np.array(image.convert('RGB'))
+        np_image = enhance_for_matching(np_image)
 
         # Encontra os encodings na imagem recebida usando a nova função
-        face_encodings_in_image = find_face_encodings(np_image)
+        face_encodings_in_image, detection = find_face_encodings(np_image)
         
         if not face_encodings_in_image:
             return jsonify({
                 'success': False,
                 'message': 'Nenhum rosto detectado na imagem.',
+                'processing_time': round(time.time() - start_time, 2),
+                'detection_skipped': detection.skipped
+            })
+        
+        # O maior rosto é o de quem está diante da câmera
+        login_encoding = select_login_face(face_encodings_in_image, detection.locations)
+        if login_encoding is None:
+            return jsonify({
+                'success': False,
+                'message': 'Rosto muito pequeno. Aproxime-se da câmera.',
                 'processing_time': round(time.time() - start_time, 2)
             })
         
-        # Carregar cache de encodings
-        cache = load_encodings_cache()
+        # Snapshot atual da galeria (atualizada em segundo plano)
+        gallery = get_encodings_gallery()
         
-        if not cache:
+        if not last_cache_update:
+            return jsonify({
+                'success': False,
+                'message': 'Cache de usuários ainda em carregamento, tente novamente em instantes',
+                'processing_time': round(time.time() - start_time, 2)
+            }), 503
+        
+        if not len(gallery):
             return jsonify({
                 'success': False,
                 'message': 'Nenhum usuário cadastrado ou erro no cache',
                 'processing_time': round(time.time() - start_time, 2)
             })
         
-        # Comparar com encodings do cache
-        best_match = None
-        best_distance = 1.0
-        best_user_id = None
-        
         comparison_start = time.time()
         
-        for user_id, user_data in cache.items():
-            try:
-                # Calcular distância
-                distance = face_recognition.face_distance(
-                    [user_data['encoding']], 
-                    face_encodings_in_image[0] # Usar o primeiro encoding encontrado
-                )[0]
-                
-                logger.info(f"Distância para {user_data['nome']}: {distance:.3f}")
-                
-                if distance < best_distance:
-                    best_distance = distance
-                    best_match = user_data['nome']
-                    best_user_id = user_id
-                    
-            except Exception as e:
-                logger.error(f"Erro ao comparar com {user_data['nome']}: {e}")
-                continue
+        # Threshold mais permissivo para melhor reconhecimento
+        threshold = float(params.get('threshold', 0.5))  # Aumentado de 0.45 para 0.5
+        # Margem mínima entre o 1º e o 2º usuário (0 desativa a rejeição por ambiguidade)
+        margin = float(params.get('margin', MATCH_MARGIN))
+        top_k = max(2, min(int(params.get('top_k', MATCH_TOP_K)), 10))
         
-        comparison_time = time.time() - comparison_start
-        logger.info(f"Comparação concluída em {comparison_time:.2f}s")
+        # Comparação 1:N vetorizada contra toda a galeria (usa o maior rosto);
+        # seleção parcial dos k melhores, sem ordenar a galeria inteira
+        candidates = gallery.search(login_encoding, k=top_k)
+        best_user_id, best_match, best_distance = candidates[0]
+        accepted, ambiguous, second_distance = classify_match(candidates, threshold, margin)
         
-        # Threshold mais permissivo para melhor reconhecimento
-        threshold = float(request.json.get('threshold', 0.5))  # Aumentado de 0.45 para 0.5
+        comparison_time = time.time() - comparison_start
+        logger.info(f"Comparação com {len(gallery)} usuários concluída em {comparison_time * 1000:.2f}ms")
+        logger.debug(f"Melhor match: {best_match} (distância {best_distance:.3f})")
         
         total_time = time.time() - start_time
         
-        if best_match and best_distance <= threshold: # Changed from < to <=
-            # Registrar login
-            try:
-                conn = get_db_connection()
-                if conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        INSERT INTO login (usuario_id, data_login, hora_login)
-                        VALUES (%s, CURDATE(), CURTIME())
-                    """, (best_user_id,))
-                    conn.commit()
-                    cursor.close()
-                    conn.close()
-            except Exception as e:
-                logger.error(f"Erro ao registrar login: {e}")
-            
-            return jsonify({
+        if accepted:
+            result = {
                 'success': True,
                 'name': best_match,
                 'message': f'Bem-vindo, {best_match}!',
                 'confidence': round((1 - best_distance) * 100, 1),
                 'distance': round(best_distance, 3),
-                'processing_time': round(total_time, 2),
-                'users_checked': len(cache)
-            })
+                'margin': round(second_distance - best_distance, 3) if second_distance is not None else None,
+                'users_checked': len(gallery),
+                'detection_stage': detection.stage
+            }
+            
+            new_login, cached = recent_logins.claim(best_user_id, result)
+            if not new_login:
+                # Reconhecido há pouco (continua diante da câmera): sem novo registro no banco
+                return jsonify(dict(cached or result, repeated=True, processing_time=round(total_time, 2)))
+            
+            # Registrar login (enfileirado; gravado em lote em segundo plano)
+            if not record_login(best_user_id, best_distance, login_encoding):
+                # Fila cheia: o login não foi gravado, o próximo quadro tenta de novo
+                recent_logins.release(best_user_id)
+            
+            return jsonify(dict(result, processing_time=round(total_time, 2)))
         else:
+            if ambiguous:
+                message = 'Reconhecimento ambíguo. Tente novamente com melhor posicionamento.'
+            else:
+                message = f'Usuário não reconhecido (melhor match: {round(best_distance, 3)})'
             return jsonify({
                 'success': False,
-                'message': f'Usuário não reconhecido (melhor match: {round(best_distance, 3)})',
+                'message': message,
                 'debug': {
                     'best_distance': round(best_distance, 3),
+                    'second_distance': round(second_distance, 3) if second_distance is not None else None,
                     'threshold': threshold,
-                    'users_checked': len(cache),
+                    'margin': margin,
+                    'ambiguous': ambiguous,
+                    'candidates': [
+                        {'name': nome, 'distance': round(distance, 3)}
+                        for _, nome, distance in candidates
+                    ],
+                    'users_checked': len(gallery),
                     'processing_time': round(total_time, 2),
-                    'best_match_name': best_match if best_match else 'Nenhum'
+                    'best_match_name': best_match if best_match else 'Nenhum',
+                    'detection_stage': detection.stage
                 }
             })
             
+    except EncoderUnavailable as e:
+        # Pool de encoding saturado: melhor o cliente tentar de novo do que esperar
+        logger.warning(f"Login recusado: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Servidor ocupado, tente novamente em instantes',
+            'processing_time': round(time.time() - start_time, 2)
+        }), 503
     except Exception as e:
         total_time = time.time() - start_time
         logger.error(f"Erro geral no processamento: {e}")
@@ -885,17 +1750,179 @@ def process_image():
             'processing_time': round(total_time, 2)
         }), 500
 
+@app.route('/process_image_batch', methods=['POST'])
+def process_image_batch():
+    """
+    Login em Lote (vários rostos no mesmo quadro)
+    Identifica todas as pessoas visíveis em um único quadro (ex.: câmera da
+    entrada da sala). Os encodings de todos os rostos saem de uma única
+    chamada ao dlib e são comparados com a galeria de uma vez (matriz M x 128).
+    Aceita os mesmos formatos de imagem e parâmetros de /process_image.
+    ---
+    tags:
+      - Autenticação Facial
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          properties:
+            image:
+              type: string
+              description: Quadro da câmera em Base64
+            threshold:
+              type: number
+              example: 0.5
+            margin:
+              type: number
+              example: 0.05
+    responses:
+      200:
+        description: Resultado por rosto detectado (faces) e usuários reconhecidos (recognized).
+      400:
+        description: Nenhuma imagem, ou imagem inválida.
+      503:
+        description: Cache ainda em carregamento ou servidor ocupado.
+    """
+    start_time = time.time()
+    
+    try:
+        try:
+            image_bytes, params = read_request_image()
+            if image_bytes is None:
+                return jsonify({'success': False, 'message': 'Nenhuma imagem fornecida'}), 400
+            
+            # Quadro maior que o do login individual: rostos no fundo da sala são pequenos
+            np_image = decode_image(image_bytes, max_width=BATCH_MAX_WIDTH)
+        except Exception as e:
+            logger.error(f"Erro ao decodificar imagem: {e}")
+            return jsonify({
+                'success': False,
+                'message': 'Formato de imagem inválido ou dados corrompidos.'
+            }), 400
+        
+        np_image = enhance_for_matching(np_image)
+        
+        # Todos os rostos do quadro em uma única chamada ao pool de encoding
+        face_encodings_in_image, detection = find_batch_face_encodings(np_image)
+        
+        if not face_encodings_in_image:
+            return jsonify({
+                'success': False,
+                'message': 'Nenhum rosto detectado na imagem.',
+                'faces': [],
+                'processing_time': round(time.time() - start_time, 2)
+            })
+        
+        gallery = get_encodings_gallery()
+        if not last_cache_update:
+            return jsonify({
+                'success': False,
+                'message': 'Cache de usuários ainda em carregamento, tente novamente em instantes',
+                'processing_time': round(time.time() - start_time, 2)
+            }), 503
+        
+        threshold = float(params.get('threshold', 0.5))
+        margin = float(params.get('margin', MATCH_MARGIN))
+        
+        # Matriz (M, 128) de rostos contra a galeria inteira de uma vez
+        results = gallery.search_batch(np.asarray(face_encodings_in_image), k=2)
+        
+        faces = []
+        best_face = {}
+        for face_index, (location, candidates) in enumerate(zip(detection.locations, results)):
+            top, right, bottom, left = (int(value) for value in location)
+            face = {'location': {'top': top, 'right': right, 'bottom': bottom, 'left': left}, 'success': False}
+            
+            if candidates:
+                user_id, nome, distance = candidates[0]
+                accepted, ambiguous, second_distance = classify_match(candidates, threshold, margin)
+                face.update({
+                    'distance': round(distance, 3),
+                    'ambiguous': ambiguous
+                })
+                if accepted:
+                    face.update({
+                        'success': True,
+                        'user_id': user_id,
+                        'name': nome,
+                        'confidence': round((1 - distance) * 100, 1)
+                    })
+                    # O mesmo usuário em dois rostos: vale o mais próximo
+                    if user_id not in best_face or distance < faces[best_face[user_id]]['distance']:
+                        best_face[user_id] = face_index
+            faces.append(face)
+        
+        for user_id, face_index in best_face.items():
+            faces[face_index]['primary'] = True
+        for face in faces:
+            if face['success'] and not face.get('primary'):
+                face.update({'success': False, 'duplicate_of': face.pop('user_id'), 'name': None})
+            face.pop('primary', None)
+        
+        # Logins de todos os reconhecidos no quadro, com o mesmo horário (menos
+        # quem já foi registrado há pouco)
+        new_logins = []
+        for user_id, face_index in best_face.items():
+            face = faces[face_index]
+            new_login, _ = recent_logins.claim(user_id, {
+                'success': True,
+                'name': face['name'],
+                'message': f"Bem-vindo, {face['name']}!",
+                'confidence': face['confidence'],
+                'distance': face['distance']
+            })
+            if new_login:
+                new_logins.append(user_id)
+            else:
+                face['repeated'] = True
+        if new_logins:
+            for user_id in login_audit.record_many(new_logins):
+                # Fila cheia: sem registro, o aluno não fica marcado como já registrado
+                recent_logins.release(user_id)
+        
+        return jsonify({
+            'success': bool(best_face),
+            'message': f'{len(best_face)} de {len(faces)} rostos reconhecidos',
+            'recognized': [faces[i]['name'] for i in best_face.values()],
+            'faces': faces,
+            'users_checked': len(gallery),
+            'detection_stage': detection.stage,
+            'processing_time': round(time.time() - start_time, 2)
+        })
+    
+    except EncoderUnavailable as e:
+        logger.warning(f"Login em lote recusado: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Servidor ocupado, tente novamente em instantes',
+            'processing_time': round(time.time() - start_time, 2)
+        }), 503
+    except Exception as e:
+        logger.error(f"Erro no processamento em lote: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'Erro interno: {str(e)}',
+            'processing_time': round(time.time() - start_time, 2)
+        }), 500
+
 @app.route('/update_cache', methods=['POST'])
 def update_cache():
-    """Força atualização do cache"""
-    global last_cache_update
-    last_cache_update = 0  # Força atualização
-    cache = load_encodings_cache()
+    """Força atualização do cache (neste worker e, pela invalidação, nos demais)"""
+    try:
+        invalidate_encodings_cache()
+        gallery = refresh_encodings_cache()
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Erro ao atualizar cache: {str(e)}'
+        }), 500
     
     return jsonify({
         'success': True,
-        'message': f'Cache atualizado com {len(cache)} usuários',
-        'users': list(cache.values())
+        'message': f'Cache atualizado com {len(gallery)} usuários',
+        'users': [{'id': int(user_id), 'nome': nome} for user_id, nome in zip(gallery.ids, gallery.nomes)]
     })
 
 @app.route('/health')
@@ -926,15 +1953,21 @@ def health_check():
     try:
         conn = get_db_connection()
         if conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM usuario")
-            user_count = cursor.fetchone()[0]
-            cursor.close()
-            conn.close()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COUNT(*) FROM usuario")
+                user_count = cursor.fetchone()[0]
+                cursor.close()
+            finally:
+                conn.close()
             
             cache_info = {
-                'cached_users': len(encodings_cache),
-                'last_update': datetime.fromtimestamp(last_cache_update).isoformat() if last_cache_update else 'Never'
+                'cached_users': len(encodings_gallery),
+                'last_update': datetime.fromtimestamp(last_cache_update).isoformat() if last_cache_update else 'Never',
+                'age_seconds': round(time.time() - last_cache_update, 1) if last_cache_update else None,
+                'last_refresh_duration': cache_refresh_stats['last_duration'],
+                'refreshing': cache_refresh_stats['refreshing'],
+                'last_error': cache_refresh_stats['last_error']
             }
             
             return jsonify({
@@ -955,64 +1988,435 @@ def health_check():
         }), 500
 
 
+# Linhas lidas do banco (e escritas no CSV) por vez na exportação
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 2000))
+
+
+def parse_date_param(value, name):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f"Parâmetro {name} inválido (use AAAA-MM-DD): {value}")
+
+
+def login_export_filters(args):
+    """Monta o WHERE da exportação a partir de data_inicio, data_fim, usuario_id e id_usuario_php"""
+    conditions, params = [], []
+    
+    data_inicio = parse_date_param(args['data_inicio'], 'data_inicio') if args.get('data_inicio') else None
+    data_fim = parse_date_param(args['data_fim'], 'data_fim') if args.get('data_fim') else None
+    if data_inicio and data_fim:
+        if data_inicio > data_fim:
+            raise ValueError("data_inicio posterior a data_fim")
+        conditions.append("l.data_login BETWEEN %s AND %s")
+        params += [data_inicio, data_fim]
+    elif data_inicio:
+        conditions.append("l.data_login >= %s")
+        params.append(data_inicio)
+    elif data_fim:
+        conditions.append("l.data_login <= %s")
+        params.append(data_fim)
+    
+    for name, column in (('usuario_id', 'l.usuario_id'), ('id_usuario_php', 'u.id_usuario_php')):
+        if args.get(name):
+            try:
+                params.append(int(args[name]))
+            except ValueError:
+                raise ValueError(f"Parâmetro {name} inválido: {args[name]}")
+            conditions.append(f"{column} = %s")
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return where, tuple(params), (data_inicio, data_fim)
+
+
+class LoginExport:
+    """
+    CSV de logins gerado em blocos de EXPORT_CHUNK_SIZE linhas lidas do cursor
+    sem buffer (as linhas vêm do servidor aos poucos): memória constante,
+    qualquer que seja o tamanho do histórico.
+
+    close() devolve a conexão ao pool ao fim do gerador e também pela resposta
+    ao ser encerrada (call_on_close), para quando o gerador nem chega a rodar
+    (HEAD, cliente que desconecta antes do primeiro bloco).
+    """
+
+    def __init__(self, conn, cursor):
+        self.conn = conn
+        self.cursor = cursor
+        self.finished = False
+        self.closed = False
+
+    def stream(self):
+        si = StringIO()
+        cw = csv.writer(si, delimiter=';')
+        try:
+            # Escrever cabeçalho
+            cw.writerow(['Nome', 'Data', 'Hora'])
+            while True:
+                registros = self.cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                if not registros:
+                    self.finished = True
+                    break
+                cw.writerows(registros)
+                yield si.getvalue()
+                si.seek(0)
+                si.truncate()
+            if si.tell():
+                yield si.getvalue()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if not self.finished:
+                # Download interrompido: o resultado pendente precisa ser lido
+                # antes de devolver a conexão ao pool
+                while self.cursor.fetchmany(EXPORT_CHUNK_SIZE):
+                    pass
+            self.cursor.close()
+        except Exception as e:
+            logger.error(f"Erro ao encerrar a exportação de logins: {e}")
+        self.conn.close()
+
+
 @app.route('/exportar_login')
 def exportar_login():
+    """
+    Exportar Registros de Login (CSV)
+    O arquivo é gerado enquanto é enviado, em blocos, direto do banco.
+    ---
+    tags:
+      - Relatórios
+    parameters:
+      - in: query
+        name: data_inicio
+        type: string
+        description: Data inicial (AAAA-MM-DD)
+      - in: query
+        name: data_fim
+        type: string
+        description: Data final (AAAA-MM-DD)
+      - in: query
+        name: usuario_id
+        type: integer
+      - in: query
+        name: id_usuario_php
+        type: integer
+    responses:
+      200:
+        description: Arquivo CSV (Nome;Data;Hora).
+    """
+    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        where, params, (data_inicio, data_fim) = login_export_filters(request.args)
         
-        # Buscar todos os registros de login com nome do usuário
-        cursor.execute("""
-            SELECT u.nome, l.data_login, l.hora_login 
+        conn = get_db_connection()
+        # Cursor sem buffer: as linhas são lidas do servidor conforme o CSV é enviado
+        cursor = conn.cursor(buffered=False)
+        cursor.execute(f"""
+            SELECT u.nome, l.data_login, l.hora_login
             FROM login l
             JOIN usuario u ON l.usuario_id = u.id
+            {where}
             ORDER BY l.data_login DESC, l.hora_login DESC
-        """)
-        
-        registros = cursor.fetchall()
-        
-        # Criar arquivo CSV em memória
-        si = StringIO()
-        cw = csv.writer(si, delimiter=';')
-        
-        # Escrever cabeçalho
-        cw.writerow(['Nome', 'Data', 'Hora'])
-        
-        # Escrever registros
-        for registro in registros:
-            cw.writerow(registro)
-        
-        # Preparar o arquivo para download
-        output = si.getvalue()
-        si.close()
-        
-        # Gerar nome do arquivo com data atual
-        data_atual = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"registros_login_{data_atual}.csv"
-        
-        # Retornar o arquivo CSV
-        return Response(
-            output,
-            mimetype='text/csv',
-            headers={
-                'Content-Disposition': f'attachment; filename={filename}',
-                'Content-Type': 'text/csv'
-            }
-        )
+        """, params)
         
     except Exception as e:
+        if conn:
+            conn.close()
         flash(f'Erro ao exportar registros: {str(e)}', 'error')
         return redirect(url_for('index'))
-        
+    
+    # Gerar nome do arquivo com data atual (e o período, se filtrado)
+    data_atual = datetime.now().strftime('%Y%m%d_%H%M%S')
+    periodo = ''
+    if data_inicio or data_fim:
+        periodo = f"{data_inicio or 'inicio'}_a_{data_fim or 'hoje'}_"
+    filename = f"registros_login_{periodo}{data_atual}.csv"
+    
+    # A conexão fica com a exportação até a resposta ser encerrada
+    export = LoginExport(conn, cursor)
+    response = Response(
+        stream_with_context(export.stream()),
+        mimetype='text/csv',
+        headers={
+            'Content-Disposition': f'attachment; filename={filename}',
+            'Content-Type': 'text/csv',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+    response.call_on_close(export.close)
+    return response
+
+# Presença (painéis de frequência): consultas só na tabela agregada presenca_diaria,
+# nunca no histórico bruto de logins; períodos limitados a PRESENCA_MAX_DIAS
+PRESENCA_MAX_DIAS = int(os.getenv('PRESENCA_MAX_DIAS', 366))
+PRESENCA_DIAS_PADRAO = 30
+
+
+def fetch_all(query, params=()):
+    """Executa uma consulta de leitura em uma conexão do pool e retorna as linhas"""
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Banco de dados indisponível")
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
     finally:
-        if 'cursor' in locals() and cursor:
-            cursor.close()
-        if 'conn' in locals() and conn:
-            conn.close()
+        conn.close()
+
+
+def format_time(value):
+    """Hora vinda do banco (o mysql-connector devolve TIME como timedelta) em HH:MM:SS"""
+    if value is None:
+        return None
+    if isinstance(value, timedelta):
+        seconds = int(value.total_seconds())
+        return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return value.strftime('%H:%M:%S')
+
+
+def attendance_period(args):
+    """Período (data_inicio, data_fim) da consulta; padrão: os últimos PRESENCA_DIAS_PADRAO dias"""
+    data_fim = parse_date_param(args['data_fim'], 'data_fim') if args.get('data_fim') else date.today()
+    if args.get('data_inicio'):
+        data_inicio = parse_date_param(args['data_inicio'], 'data_inicio')
+    else:
+        data_inicio = data_fim - timedelta(days=PRESENCA_DIAS_PADRAO - 1)
+    
+    if data_inicio > data_fim:
+        raise ValueError("data_inicio posterior a data_fim")
+    if (data_fim - data_inicio).days + 1 > PRESENCA_MAX_DIAS:
+        raise ValueError(f"Período maior que {PRESENCA_MAX_DIAS} dias")
+    return data_inicio, data_fim
+
+
+def parse_id_list(value, name):
+    """Lista de ids separados por vírgula (ex.: os alunos de uma turma)"""
+    try:
+        return sorted({int(item) for item in value.split(',') if item.strip()})
+    except ValueError:
+        raise ValueError(f"Parâmetro {name} inválido: {value}")
+
+
+@app.route('/api/presenca/dia')
+def presenca_dia():
+    """
+    Presença do Dia
+    Alunos que fizeram login no dia, com o primeiro e o último horário.
+    ---
+    tags:
+      - Relatórios
+    parameters:
+      - in: query
+        name: data
+        type: string
+        description: Dia (AAAA-MM-DD); padrão hoje
+    responses:
+      200:
+        description: Alunos presentes no dia.
+      400:
+        description: Data inválida.
+    """
+    try:
+        dia = parse_date_param(request.args['data'], 'data') if request.args.get('data') else date.today()
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    try:
+        rows = fetch_all("""
+            SELECT p.usuario_id, u.nome, u.id_usuario_php, p.primeiro_login, p.ultimo_login, p.total_logins
+            FROM presenca_diaria p
+            JOIN usuario u ON u.id = p.usuario_id
+            WHERE p.data = %s
+            ORDER BY p.primeiro_login
+        """, (dia,))
+        total_usuarios = fetch_all("SELECT COUNT(*) FROM usuario")[0][0]
+    except Exception as e:
+        logger.error(f"Erro ao consultar presença do dia: {e}")
+        return jsonify({'success': False, 'message': f'Erro ao consultar presença: {str(e)}'}), 500
+    
+    return jsonify({
+        'success': True,
+        'data': dia.isoformat(),
+        'presentes': len(rows),
+        'total_usuarios': total_usuarios,
+        'alunos': [{
+            'usuario_id': usuario_id,
+            'nome': nome,
+            'id_usuario_php': id_usuario_php,
+            'primeiro_login': format_time(primeiro),
+            'ultimo_login': format_time(ultimo),
+            'total_logins': total
+        } for usuario_id, nome, id_usuario_php, primeiro, ultimo, total in rows]
+    })
+
+
+@app.route('/api/presenca/aluno/<int:usuario_id>')
+def presenca_aluno(usuario_id):
+    """
+    Frequência de um Aluno
+    Dias em que o aluno fez login no período.
+    ---
+    tags:
+      - Relatórios
+    parameters:
+      - in: path
+        name: usuario_id
+        type: integer
+        required: true
+      - in: query
+        name: data_inicio
+        type: string
+        description: AAAA-MM-DD (padrão 30 dias antes de data_fim)
+      - in: query
+        name: data_fim
+        type: string
+        description: AAAA-MM-DD (padrão hoje)
+    responses:
+      200:
+        description: Dias presentes do aluno.
+      400:
+        description: Período inválido.
+      404:
+        description: Usuário não encontrado.
+    """
+    try:
+        data_inicio, data_fim = attendance_period(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    try:
+        usuario = fetch_all("SELECT nome, id_usuario_php FROM usuario WHERE id = %s", (usuario_id,))
+        if not usuario:
+            return jsonify({'success': False, 'message': 'Usuário não encontrado'}), 404
+        
+        rows = fetch_all("""
+            SELECT data, primeiro_login, ultimo_login, total_logins
+            FROM presenca_diaria
+            WHERE usuario_id = %s AND data BETWEEN %s AND %s
+            ORDER BY data
+        """, (usuario_id, data_inicio, data_fim))
+    except Exception as e:
+        logger.error(f"Erro ao consultar frequência do usuário {usuario_id}: {e}")
+        return jsonify({'success': False, 'message': f'Erro ao consultar presença: {str(e)}'}), 500
+    
+    nome, id_usuario_php = usuario[0]
+    return jsonify({
+        'success': True,
+        'usuario_id': usuario_id,
+        'nome': nome,
+        'id_usuario_php': id_usuario_php,
+        'data_inicio': data_inicio.isoformat(),
+        'data_fim': data_fim.isoformat(),
+        'dias_presentes': len(rows),
+        'dias': [{
+            'data': dia.isoformat(),
+            'primeiro_login': format_time(primeiro),
+            'ultimo_login': format_time(ultimo),
+            'total_logins': total
+        } for dia, primeiro, ultimo, total in rows]
+    })
+
+
+@app.route('/api/presenca/periodo')
+def presenca_periodo():
+    """
+    Frequência no Período
+    Presentes por dia e dias presentes por aluno no período, para todos os
+    alunos ou para um grupo (ex.: uma turma) informado em `usuario_id` ou
+    `id_usuario_php` (ids separados por vírgula).
+    ---
+    tags:
+      - Relatórios
+    parameters:
+      - in: query
+        name: data_inicio
+        type: string
+        description: AAAA-MM-DD (padrão 30 dias antes de data_fim)
+      - in: query
+        name: data_fim
+        type: string
+        description: AAAA-MM-DD (padrão hoje)
+      - in: query
+        name: usuario_id
+        type: string
+        description: Ids locais separados por vírgula
+      - in: query
+        name: id_usuario_php
+        type: string
+        description: Ids do PHP separados por vírgula
+    responses:
+      200:
+        description: Resumo por dia (dias) e por aluno (alunos).
+      400:
+        description: Parâmetros inválidos.
+    """
+    try:
+        data_inicio, data_fim = attendance_period(request.args)
+        conditions, params = ["p.data BETWEEN %s AND %s"], [data_inicio, data_fim]
+        for name, column in (('usuario_id', 'p.usuario_id'), ('id_usuario_php', 'u.id_usuario_php')):
+            if request.args.get(name):
+                ids = parse_id_list(request.args[name], name)
+                if not ids:
+                    raise ValueError(f"Parâmetro {name} vazio")
+                conditions.append(f"{column} IN ({', '.join(['%s'] * len(ids))})")
+                params += ids
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    where = ' AND '.join(conditions)
+    try:
+        por_dia = fetch_all(f"""
+            SELECT p.data, COUNT(*), SUM(p.total_logins)
+            FROM presenca_diaria p
+            JOIN usuario u ON u.id = p.usuario_id
+            WHERE {where}
+            GROUP BY p.data
+            ORDER BY p.data
+        """, tuple(params))
+        por_aluno = fetch_all(f"""
+            SELECT p.usuario_id, u.nome, u.id_usuario_php, COUNT(*), SUM(p.total_logins), MAX(p.data)
+            FROM presenca_diaria p
+            JOIN usuario u ON u.id = p.usuario_id
+            WHERE {where}
+            GROUP BY p.usuario_id, u.nome, u.id_usuario_php
+            ORDER BY u.nome
+        """, tuple(params))
+    except Exception as e:
+        logger.error(f"Erro ao consultar frequência no período: {e}")
+        return jsonify({'success': False, 'message': f'Erro ao consultar presença: {str(e)}'}), 500
+    
+    return jsonify({
+        'success': True,
+        'data_inicio': data_inicio.isoformat(),
+        'data_fim': data_fim.isoformat(),
+        'dias': [
+            {'data': dia.isoformat(), 'presentes': int(presentes), 'total_logins': int(total)}
+            for dia, presentes, total in por_dia
+        ],
+        'alunos': [{
+            'usuario_id': usuario_id,
+            'nome': nome,
+            'id_usuario_php': id_usuario_php,
+            'dias_presentes': int(dias),
+            'total_logins': int(total),
+            'ultimo_dia': ultimo_dia.isoformat()
+        } for usuario_id, nome, id_usuario_php, dias, total, ultimo_dia in por_aluno]
+    })
 
 if __name__ == '__main__':
     # Remover validação SSL caso consuma APIs externas
     import urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     
+    # Com o reloader, só o processo filho atende as requisições
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     app.run(host='0.0.0.0', port=8090, debug=True)
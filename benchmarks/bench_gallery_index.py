@@ -0,0 +1,84 @@
+"""
+Benchmark dos índices da galeria: recall@k e latência da busca aproximada (IVF)
+em relação à busca exata, com encodings sintéticos.
+
+Os encodings imitam os do dlib: norma próxima de 1, usuários agrupados em
+regiões do espaço e capturas a ~0.35 de distância da foto cadastrada.
+
+Uso:
+    python benchmarks/bench_gallery_index.py --size 200000 --queries 500 --nprobe 4 8 16 32
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from face_gallery import ENCODING_SIZE, ExactIndex, IVFIndex  # noqa: E402
+
+
+def synthetic_gallery(size, groups, rng):
+    centers = rng.normal(0, 1, (groups, ENCODING_SIZE))
+    members = centers[rng.integers(0, groups, size)] + rng.normal(0, 0.6, (size, ENCODING_SIZE))
+    return (members / np.linalg.norm(members, axis=1, keepdims=True)).astype(np.float32)
+
+
+def synthetic_probes(matrix, queries, noise, rng):
+    targets = rng.choice(len(matrix), queries, replace=False)
+    probes = matrix[targets] + rng.normal(0, noise / np.sqrt(ENCODING_SIZE), (queries, ENCODING_SIZE))
+    return targets, probes.astype(np.float32)
+
+
+def run_queries(index, probes, k):
+    start = time.perf_counter()
+    results = [index.search(probe, k)[0] for probe in probes]
+    elapsed_ms = (time.perf_counter() - start) * 1000 / len(probes)
+    return results, elapsed_ms
+
+
+def recall(results, expected):
+    hits = sum(len(np.intersect1d(found, truth)) for found, truth in zip(results, expected))
+    return hits / sum(len(truth) for truth in expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100000, help='encodings na galeria')
+    parser.add_argument('--groups', type=int, default=1000, help='regiões (agrupamentos) dos encodings')
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--noise', type=float, default=0.35, help='distância média da captura para a foto cadastrada')
+    parser.add_argument('--lists', type=int, default=None, help='listas do IVF (padrão: raiz de size)')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    matrix = synthetic_gallery(args.size, args.groups, rng)
+    sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+    targets, probes = synthetic_probes(matrix, args.queries, args.noise, rng)
+
+    exact = ExactIndex(matrix, sq_norms)
+    expected, exact_ms = run_queries(exact, probes, args.k)
+    top1_exact = np.mean([found[0] == target for found, target in zip(expected, targets)])
+
+    print(f"Galeria: {args.size} encodings, {args.queries} buscas, k={args.k}")
+    print(f"{'índice':<22}{'montagem (s)':>14}{'busca (ms)':>12}{'recall@k':>10}{'acerto top-1':>14}")
+    print(f"{'exato':<22}{0.0:>14.2f}{exact_ms:>12.3f}{1.0:>10.3f}{top1_exact:>14.3f}")
+
+    for n_probe in args.nprobe:
+        start = time.perf_counter()
+        ivf = IVFIndex(matrix, sq_norms, n_lists=args.lists, n_probe=n_probe, seed=args.seed)
+        build_s = time.perf_counter() - start
+
+        results, ivf_ms = run_queries(ivf, probes, args.k)
+        top1 = np.mean([len(found) and found[0] == target for found, target in zip(results, targets)])
+        name = f"ivf {ivf.n_lists} listas/{ivf.n_probe}"
+        print(f"{name:<22}{build_s:>14.2f}{ivf_ms:>12.3f}{recall(results, expected):>10.3f}{top1:>14.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Download concorrente das fotos do cadastro em lote.
+
+As fotos vêm do servidor PHP (`foto_url` de cada aluno). Em vez de um
+`requests.get` por aluno, sem timeout, os downloads usam uma única
+requests.Session com pool de conexões (keep-alive) e um ThreadPoolExecutor;
+cada download tem timeout de conexão e de leitura e um limite de tamanho.
+
+Os lotes são baixados um à frente do processamento (prefetch), para que a
+rede trabalhe enquanto o lote anterior é processado no pool de encoding.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Fotos maiores que isso são recusadas (proteção contra URLs erradas)
+MAX_PHOTO_BYTES = 15 * 1024 * 1024
+
+
+class PhotoDownloadError(Exception):
+    """Falha ao baixar a foto de um aluno"""
+
+
+def make_session(pool_size=8, retries=2, verify=False):
+    """
+    Sessão HTTP compartilhada pelos downloads: `pool_size` conexões por host
+    e novas tentativas (com espera crescente) em erros de conexão e 502/503/504.
+    """
+    session = requests.Session()
+    # Mesmo comportamento do /cadastro: o servidor PHP usa certificado próprio
+    session.verify = verify
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET'])
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_photo(session, url, timeout=(5, 20), max_bytes=MAX_PHOTO_BYTES):
+    """Baixa uma foto e retorna seus bytes; levanta PhotoDownloadError em qualquer falha"""
+    try:
+        with session.get(url, timeout=timeout, stream=True) as response:
+            if response.status_code != 200:
+                raise PhotoDownloadError(f"HTTP {response.status_code}")
+
+            content = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                content.extend(chunk)
+                if len(content) > max_bytes:
+                    raise PhotoDownloadError(f"Foto maior que {max_bytes // (1024 * 1024)} MB")
+    except requests.exceptions.RequestException as e:
+        raise PhotoDownloadError(str(e)) from e
+
+    if not content:
+        raise PhotoDownloadError("Resposta vazia")
+    return bytes(content)
+
+
+def _download_safe(session, url, timeout):
+    try:
+        return download_photo(session, url, timeout), None
+    except PhotoDownloadError as e:
+        return None, str(e)
+
+
+def iter_downloaded_batches(alunos, batch_size=100, workers=8, timeout=(5, 20), session=None):
+    """
+    Gera, lote a lote, [(aluno, bytes da foto ou None, mensagem de erro ou None)]
+    na ordem dos alunos. Os downloads do lote seguinte já começam enquanto o
+    lote atual é consumido.
+    """
+    own_session = session is None
+    session = session or make_session(pool_size=workers)
+    batches = [alunos[i:i + batch_size] for i in range(0, len(alunos), batch_size)]
+
+    def submit(batch):
+        return [(aluno, executor.submit(_download_safe, session, aluno['foto_url'], timeout)) for aluno in batch]
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='photo-download') as executor:
+            pending = submit(batches[0]) if batches else None
+            for index in range(len(batches)):
+                current = pending
+                pending = submit(batches[index + 1]) if index + 1 < len(batches) else None
+                yield [(aluno, *future.result()) for aluno, future in current]
+    finally:
+        if own_session:
+            session.close()
@@ -3,7 +3,8 @@ CREATE TABLE IF NOT EXISTS usuario(
     id INT UNSIGNED NOT NULL PRIMARY KEY AUTO_INCREMENT,
     nome CHAR(50) NOT NULL,
     cpf VARCHAR(20) NOT NULL,
-    id_usuario_php INT UNSIGNED NOT NULL
+    id_usuario_php INT UNSIGNED NOT NULL,
+    UNIQUE KEY uq_usuario_id_php (id_usuario_php)
 );
 
 CREATE TABLE IF NOT EXISTS fotos_usuario (
@@ -11,6 +12,7 @@ CREATE TABLE IF NOT EXISTS fotos_usuario (
     usuario_id INT UNSIGNED NOT NULL,
     caminho VARCHAR(255) NOT NULL,
     data_captura DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_fotos_usuario (usuario_id),
     FOREIGN KEY (usuario_id) REFERENCES usuario(id)
 );
 
@@ -19,5 +21,36 @@ CREATE TABLE IF NOT EXISTS login (
     usuario_id INT UNSIGNED NOT NULL,
     data_login DATE NOT NULL,
     hora_login TIME NOT NULL,
+    data_hora DATETIME AS (TIMESTAMP(data_login, hora_login)) STORED,
+    KEY idx_login_data (data_login, hora_login),
+    KEY idx_login_data_hora (data_hora),
+    KEY idx_login_usuario_data (usuario_id, data_login),
+    FOREIGN KEY (usuario_id) REFERENCES usuario(id)
+);
+
+CREATE TABLE IF NOT EXISTS encodings_usuario (
+    id INT UNSIGNED NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    usuario_id INT UNSIGNED NOT NULL,
+    foto_id INT UNSIGNED NULL,
+    origem VARCHAR(10) NOT NULL DEFAULT 'foto',
+    encoding BLOB NOT NULL,
+    modelo VARCHAR(20) NOT NULL,
+    versao_detector VARCHAR(40) NOT NULL,
+    data_criacao DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_encodings_foto (foto_id),
+    KEY idx_encodings_usuario_origem (usuario_id, origem, id),
+    KEY idx_encodings_data_criacao (data_criacao),
+    FOREIGN KEY (usuario_id) REFERENCES usuario(id),
+    FOREIGN KEY (foto_id) REFERENCES fotos_usuario(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS presenca_diaria (
+    data DATE NOT NULL,
+    usuario_id INT UNSIGNED NOT NULL,
+    primeiro_login TIME NOT NULL,
+    ultimo_login TIME NOT NULL,
+    total_logins INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (data, usuario_id),
+    KEY idx_presenca_usuario_data (usuario_id, data),
     FOREIGN KEY (usuario_id) REFERENCES usuario(id)
 );
@@ -0,0 +1,16 @@
+-- Encodings faciais (vetor de 128 posições) gravados no cadastro da foto.
+-- O cache de login lê estes BLOBs diretamente em vez de reprocessar os JPEGs.
+-- Fotos já existentes recebem o encoding na primeira carga do cache.
+
+CREATE TABLE IF NOT EXISTS encodings_usuario (
+    id INT UNSIGNED NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    usuario_id INT UNSIGNED NOT NULL,
+    foto_id INT UNSIGNED NOT NULL,
+    encoding BLOB NOT NULL,
+    modelo VARCHAR(20) NOT NULL,
+    versao_detector VARCHAR(40) NOT NULL,
+    data_criacao DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_encodings_foto (foto_id),
+    FOREIGN KEY (usuario_id) REFERENCES usuario(id),
+    FOREIGN KEY (foto_id) REFERENCES fotos_usuario(id) ON DELETE CASCADE
+);
@@ -0,0 +1,10 @@
+-- Vários encodings por usuário: além do encoding da foto atual (origem 'foto'),
+-- ficam os das fotos substituídas ('historico', sem foto associada) e os de
+-- logins reconhecidos com folga ('login'). O cache resume cada usuário em
+-- protótipo + exemplares; a aplicação mantém só os mais recentes de cada origem.
+
+ALTER TABLE encodings_usuario
+    MODIFY foto_id INT UNSIGNED NULL,
+    ADD COLUMN origem VARCHAR(10) NOT NULL DEFAULT 'foto' AFTER foto_id,
+    ADD KEY idx_encodings_usuario_origem (usuario_id, origem, id),
+    ADD KEY idx_encodings_data_criacao (data_criacao);
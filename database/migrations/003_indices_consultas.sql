@@ -0,0 +1,59 @@
+-- Índices das consultas mais frequentes e chaves únicas que permitem gravar o
+-- cadastro com INSERT ... ON DUPLICATE KEY UPDATE (um comando por tabela em vez
+-- de SELECT seguido de INSERT/UPDATE):
+--   * usuario.id_usuario_php: procurado em todo /salvar_foto e /cadastro;
+--   * fotos_usuario.usuario_id: uma foto atual por usuário;
+--   * login(data_login, hora_login): ordenação da exportação e relatórios;
+--   * login.data_hora: data e hora do login em uma única coluna DATETIME
+--     (gerada a partir das duas colunas, que continuam sendo as gravadas).
+--
+-- Antes das chaves únicas, os registros duplicados (criados pelo /cadastro,
+-- que sempre inseria um novo usuário) são unificados.
+
+-- 1. Usuários duplicados pelo mesmo id_usuario_php: mantém o de menor id e
+--    transfere para ele fotos, logins e encodings dos demais
+CREATE TEMPORARY TABLE usuario_duplicado AS
+SELECT u.id AS duplicado_id, m.manter_id
+FROM usuario u
+JOIN (
+    SELECT id_usuario_php, MIN(id) AS manter_id
+    FROM usuario
+    GROUP BY id_usuario_php
+    HAVING COUNT(*) > 1
+) m ON m.id_usuario_php = u.id_usuario_php AND u.id <> m.manter_id;
+
+UPDATE fotos_usuario f JOIN usuario_duplicado d ON f.usuario_id = d.duplicado_id SET f.usuario_id = d.manter_id;
+UPDATE login l JOIN usuario_duplicado d ON l.usuario_id = d.duplicado_id SET l.usuario_id = d.manter_id;
+UPDATE encodings_usuario e JOIN usuario_duplicado d ON e.usuario_id = d.duplicado_id SET e.usuario_id = d.manter_id;
+DELETE u FROM usuario u JOIN usuario_duplicado d ON u.id = d.duplicado_id;
+DROP TEMPORARY TABLE usuario_duplicado;
+
+-- 2. Mais de uma foto por usuário: fica a mais recente; o encoding das demais
+--    vira histórico (sem foto associada), como na troca de foto pela aplicação
+CREATE TEMPORARY TABLE foto_antiga AS
+SELECT f.id AS foto_id
+FROM fotos_usuario f
+JOIN (
+    SELECT usuario_id, MAX(id) AS manter_id
+    FROM fotos_usuario
+    GROUP BY usuario_id
+    HAVING COUNT(*) > 1
+) m ON m.usuario_id = f.usuario_id AND f.id <> m.manter_id;
+
+UPDATE encodings_usuario e JOIN foto_antiga a ON e.foto_id = a.foto_id
+SET e.foto_id = NULL, e.origem = 'historico';
+DELETE f FROM fotos_usuario f JOIN foto_antiga a ON f.id = a.foto_id;
+DROP TEMPORARY TABLE foto_antiga;
+
+-- 3. Índices e chaves únicas
+ALTER TABLE usuario
+    ADD UNIQUE KEY uq_usuario_id_php (id_usuario_php);
+
+ALTER TABLE fotos_usuario
+    ADD UNIQUE KEY uq_fotos_usuario (usuario_id);
+
+ALTER TABLE login
+    ADD COLUMN data_hora DATETIME AS (TIMESTAMP(data_login, hora_login)) STORED AFTER hora_login,
+    ADD KEY idx_login_data (data_login, hora_login),
+    ADD KEY idx_login_data_hora (data_hora),
+    ADD KEY idx_login_usuario_data (usuario_id, data_login);
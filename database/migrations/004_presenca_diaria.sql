@@ -0,0 +1,25 @@
+-- Presença diária agregada por usuário: uma linha por (dia, usuário) com o
+-- primeiro e o último login do dia e a quantidade de logins. É atualizada pela
+-- aplicação no mesmo lote que grava a tabela `login`, então os painéis leem
+-- esta tabela em vez de varrer o histórico bruto.
+
+CREATE TABLE IF NOT EXISTS presenca_diaria (
+    data DATE NOT NULL,
+    usuario_id INT UNSIGNED NOT NULL,
+    primeiro_login TIME NOT NULL,
+    ultimo_login TIME NOT NULL,
+    total_logins INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (data, usuario_id),
+    KEY idx_presenca_usuario_data (usuario_id, data),
+    FOREIGN KEY (usuario_id) REFERENCES usuario(id)
+);
+
+-- Carga inicial a partir do histórico existente (pode ser reexecutada)
+INSERT INTO presenca_diaria (data, usuario_id, primeiro_login, ultimo_login, total_logins)
+SELECT data_login, usuario_id, MIN(hora_login), MAX(hora_login), COUNT(*)
+FROM login
+GROUP BY data_login, usuario_id
+ON DUPLICATE KEY UPDATE
+    primeiro_login = VALUES(primeiro_login),
+    ultimo_login = VALUES(ultimo_login),
+    total_logins = VALUES(total_logins);
@@ -0,0 +1,298 @@
+"""
+Execução do trabalho do dlib (detecção e encoding de rostos) fora da thread
+da requisição.
+
+Cada worker do gunicorn mantém um pool de processos próprio, iniciado com
+'spawn' (o fork de um processo com threads e conexões abertas não é seguro)
+e com os modelos do dlib já carregados. A fila é limitada: quando todos os
+processos estão ocupados e a fila está cheia a chamada falha na hora
+(EncoderBusy), e cada tarefa tem um tempo máximo de espera (EncoderTimeout),
+para que as threads do Flask nunca fiquem presas atrás de um CNN lento.
+
+Com FACE_ENCODER_PROCESSES=0 as tarefas rodam na própria thread (testes e
+máquinas de um núcleo).
+
+O face_recognition é importado dentro das tarefas: o processo do Flask
+importa este módulo (e o face_pipeline) sem carregar os modelos do dlib, que
+ficam só nos processos do pool.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+import cv2
+import numpy as np
+from io import BytesIO
+from PIL import Image
+
+from face_pipeline import build_detection_cascade, normalize_enrollment_face
+
+logger = logging.getLogger(__name__)
+
+# Estado de cada processo do pool (configurado pelo initializer)
+_worker = {'config': None, 'login': None, 'batch': None, 'enrollment': None}
+
+
+class EncoderUnavailable(RuntimeError):
+    """O pool não conseguiu atender a tarefa a tempo"""
+
+
+class EncoderBusy(EncoderUnavailable):
+    """Fila de tarefas cheia"""
+
+
+class EncoderTimeout(EncoderUnavailable):
+    """A tarefa passou do tempo máximo de espera"""
+
+
+def configure_worker(config):
+    """
+    Initializer dos processos do pool: monta as cascatas de detecção e força a
+    carga dos modelos do dlib antes da primeira requisição real.
+    """
+    _worker['config'] = dict(config)
+    _worker['login'] = build_detection_cascade(
+        total_budget=config['detection_budget'],
+        enable_cnn=config['enable_cnn'],
+        cnn_budget=config['cnn_budget']
+    )
+    # Login em lote: continua nos estágios seguintes depois do primeiro rosto
+    _worker['batch'] = build_detection_cascade(
+        total_budget=config['batch_budget'],
+        enable_cnn=config['enable_cnn'],
+        cnn_budget=config['cnn_budget'],
+        exhaustive=True
+    )
+    _worker['enrollment'] = build_detection_cascade(
+        total_budget=config['enrollment_budget'],
+        enable_cnn=config['enable_cnn'],
+        cnn_budget=config['cnn_budget']
+    )
+
+    if config.get('warm_up'):
+        import face_recognition
+        blank = np.zeros((64, 64, 3), dtype=np.uint8)
+        face_recognition.face_locations(blank)
+        face_recognition.face_encodings(blank, [(8, 56, 56, 8)], model=config['encoding_model'])
+
+
+def _ping():
+    return os.getpid()
+
+
+def _encode_frame(rgb_image, cascade):
+    import face_recognition
+    detection = cascade.detect(rgb_image)
+    if not detection.locations:
+        return [], detection
+
+    # Mesmo modelo de landmarks usado nos encodings da galeria
+    encodings = face_recognition.face_encodings(
+        rgb_image,
+        known_face_locations=detection.locations,
+        num_jitters=1,
+        model=_worker['config']['encoding_model']
+    )
+    return encodings, detection
+
+
+def encode_login_frame(rgb_image):
+    """Detecta os rostos pela cascata do login e extrai os encodings; retorna (encodings, detecção)"""
+    return _encode_frame(rgb_image, _worker['login'])
+
+
+def encode_batch_frame(rgb_image):
+    """Como encode_login_frame, mas passando por todos os estágios que couberem (vários rostos)"""
+    return _encode_frame(rgb_image, _worker['batch'])
+
+
+def detect_enrollment_faces(rgb_image):
+    """Detecta os rostos de uma foto de cadastro; retorna a detecção completa"""
+    return _worker['enrollment'].detect(rgb_image)
+
+
+def extract_gallery_encoding(rgb_image):
+    """Extrai o encoding de referência de uma foto cadastrada (imagem RGB)"""
+    import face_recognition
+
+    # Redimensionar para acelerar processamento
+    height, width = rgb_image.shape[:2]
+    if width > 800:
+        scale = 800 / width
+        new_width = int(width * scale)
+        new_height = int(height * scale)
+        rgb_image = cv2.resize(rgb_image, (new_width, new_height))
+
+    # Extrair encoding com configurações otimizadas
+    face_locations = face_recognition.face_locations(
+        rgb_image,
+        model="hog",  # HOG é mais rápido que CNN
+        number_of_times_to_upsample=1  # Reduzir para acelerar
+    )
+
+    if not face_locations:
+        return None
+
+    encodings = face_recognition.face_encodings(
+        rgb_image,
+        face_locations,
+        num_jitters=1,  # Reduzir para acelerar
+        model=_worker['config']['encoding_model']
+    )
+
+    return encodings[0] if encodings else None
+
+
+def encode_photo_path(img_path):
+    """Lê uma foto do disco (no próprio processo do pool) e extrai seu encoding"""
+    image = cv2.imread(img_path)
+    if image is None:
+        return None
+
+    return extract_gallery_encoding(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+
+
+def encode_photo_path_safe(img_path):
+    """Versão da carga em lote: retorna (encoding ou None, mensagem de erro ou None)"""
+    try:
+        return encode_photo_path(img_path), None
+    except Exception as e:
+        return None, str(e)
+
+
+def prepare_enrollment_photo(image_bytes):
+    """
+    Cadastro completo de uma foto baixada, no processo do pool: detecta o maior
+    rosto, recorta e normaliza e extrai o encoding. Retorna (JPEG do rosto
+    normalizado, encoding ou None), ou (None, None) se não houver rosto.
+    """
+    pil_image = Image.open(BytesIO(image_bytes)).convert('RGB')
+    detection = detect_enrollment_faces(np.asarray(pil_image))
+    if not detection.locations:
+        return None, None
+
+    face_image = normalize_enrollment_face(pil_image, detection.locations)
+    encoding = extract_gallery_encoding(np.array(face_image))
+
+    # Volta como JPEG: bem menor que a imagem para atravessar o pool
+    buffer = BytesIO()
+    face_image.save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue(), encoding
+
+
+def prepare_enrollment_photo_safe(image_bytes):
+    """Versão do cadastro em lote: retorna (JPEG ou None, encoding ou None, mensagem de erro ou None)"""
+    try:
+        return prepare_enrollment_photo(image_bytes) + (None,)
+    except Exception as e:
+        return None, None, str(e)
+
+
+class FaceEncoderPool:
+    """Pool de processos com fila limitada para as tarefas do dlib"""
+
+    def __init__(self, config, processes=2, max_pending=None, timeout=10.0):
+        self.config = dict(config)
+        self.processes = processes
+        self.max_pending = max_pending or max(1, processes) * 4
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._inline_ready = False
+
+    @property
+    def inline(self):
+        return self.processes <= 0
+
+    def start(self):
+        """Cria o pool deste processo (um por worker do gunicorn) e pré-carrega os modelos"""
+        with self._lock:
+            if self.inline:
+                if not self._inline_ready:
+                    configure_worker(self.config)
+                    self._inline_ready = True
+                return None
+
+            if self._executor is not None and self._pid == os.getpid():
+                return self._executor
+
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=configure_worker,
+                initargs=(dict(self.config, warm_up=True),)
+            )
+            self._pid = os.getpid()
+            logger.info(f"Pool de encoding iniciado com {self.processes} processos")
+
+        # Sobe todos os processos agora, e não na primeira requisição
+        for _ in range(self.processes):
+            self._executor.submit(_ping)
+        return self._executor
+
+    def run(self, fn, *args, timeout=None):
+        """
+        Executa `fn(*args)` no pool e espera o resultado. Levanta EncoderBusy
+        se a fila estiver cheia e EncoderTimeout se passar do tempo máximo.
+        """
+        executor = self.start()
+        if executor is None:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise EncoderBusy("Fila de processamento facial cheia")
+
+        try:
+            future = executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        # A vaga só é liberada quando o processo termina a tarefa, mesmo que
+        # quem pediu já tenha desistido de esperar
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise EncoderTimeout(f"Processamento facial excedeu {self.timeout if timeout is None else timeout}s")
+
+    @contextmanager
+    def bulk(self, processes=None, chunksize=8):
+        """
+        Pool temporário com todos os núcleos (ou `processes`) para cargas
+        grandes, sem ocupar a fila das requisições. Produz uma função
+        `map(fn, itens)` que envia os itens em lotes de `chunksize` e gera os
+        resultados na ordem; o pool vale para várias chamadas dentro do bloco.
+        """
+        if self.inline:
+            self.start()
+            yield map
+            return
+
+        processes = processes or os.cpu_count() or 1
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=configure_worker,
+            initargs=(self.config,)
+        ) as executor:
+            logger.info(f"Pool temporário de encoding iniciado com {processes} processos")
+            yield lambda fn, items: executor.map(fn, items, chunksize=chunksize)
+
+    def map_bulk(self, fn, items, processes=None, chunksize=8):
+        """Aplica `fn` a todos os itens em um pool temporário (ver `bulk`)"""
+        with self.bulk(processes, chunksize) as bulk_map:
+            yield from bulk_map(fn, items)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,561 @@
+"""
+Galeria de encodings faciais em formato matricial.
+
+Todos os encodings cadastrados ficam em uma única matriz float32 (N, 128)
+contígua, com arrays paralelos de ids e nomes, para que a comparação 1:N do
+login seja feita em uma única operação vetorizada do NumPy. Cada usuário
+ocupa um bloco de linhas consecutivas (protótipo + exemplares, ver
+summarize_encodings) e a distância do usuário é a menor do seu bloco.
+
+A busca passa por um índice plugável: exato (varre a matriz inteira, padrão)
+ou IVF (k-means em NumPy; compara só com os grupos mais próximos), para
+galerias com centenas de milhares de encodings.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem lock entre processos, cada worker reconstrói
+    fcntl = None
+
+ENCODING_SIZE = 128
+
+
+# Índice usado pelas galerias montadas neste processo (ver configure_index)
+_index_settings = {'kind': 'exact', 'min_size': 20000, 'params': {}}
+
+
+def configure_index(kind='exact', min_size=20000, **params):
+    """
+    Escolhe o índice das próximas galerias: 'exact' ou 'ivf'. Galerias com
+    menos de `min_size` encodings usam sempre a busca exata, que nesse
+    tamanho já leva poucos milissegundos.
+    """
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Índice de galeria desconhecido: {kind}")
+    _index_settings.update(kind=kind, min_size=min_size, params=params)
+
+
+def _squared_distances(matrix, sq_norms, probe):
+    # Expansão ||x - q||² = ||x||² - 2x·q + ||q||²; arredondamentos podem gerar valores levemente negativos
+    return np.maximum(sq_norms - 2.0 * (matrix @ probe) + np.dot(probe, probe), 0.0)
+
+
+def _top_k(sq_distances, k):
+    """Posições dos k menores valores, em ordem (seleção parcial + ordenação só dos k)"""
+    k = min(k, len(sq_distances))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    nearest = np.argpartition(sq_distances, k - 1)[:k]
+    return nearest[np.argsort(sq_distances[nearest])]
+
+
+def summarize_encodings(encodings, max_exemplars=4):
+    """
+    Representação compacta de um usuário com vários encodings (fotos antigas,
+    logins reconhecidos), do mais recente para o mais antigo: o protótipo
+    (média de todos) seguido de até `max_exemplars` exemplares. Os exemplares
+    são o encoding mais recente e, em seguida, os mais distantes dos já
+    escolhidos, para cobrir variações de iluminação e pose.
+    """
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    if len(encodings) <= 1:
+        return encodings
+
+    prototype = encodings.mean(axis=0, keepdims=True)
+    if max_exemplars <= 0:
+        return prototype
+
+    if len(encodings) <= max_exemplars:
+        return np.concatenate([prototype, encodings])
+
+    chosen = [0]
+    nearest = np.linalg.norm(encodings - encodings[0], axis=1)
+    while len(chosen) < max_exemplars:
+        farthest = int(np.argmax(nearest))
+        chosen.append(farthest)
+        nearest = np.minimum(nearest, np.linalg.norm(encodings - encodings[farthest], axis=1))
+
+    return np.concatenate([prototype, encodings[chosen]])
+
+
+def _min_per_owner(sq_distances, owners):
+    """
+    Menor distância de cada usuário a partir das distâncias por linha, com as
+    linhas agrupadas por usuário (`owners` não decrescente). Retorna
+    (usuários, distâncias).
+    """
+    starts = np.flatnonzero(np.concatenate([[True], owners[1:] != owners[:-1]]))
+    return owners[starts], np.minimum.reduceat(sq_distances, starts)
+
+
+class ExactIndex:
+    """Busca exata: distância do rosto capturado para todas as linhas da matriz"""
+
+    def __init__(self, matrix, sq_norms, row_owner=None):
+        self.matrix = matrix
+        self.sq_norms = sq_norms
+        # Início do bloco de linhas de cada usuário (None: uma linha por usuário)
+        self.starts = None
+        if row_owner is not None:
+            self.starts = np.flatnonzero(np.concatenate([[True], row_owner[1:] != row_owner[:-1]]))
+
+    def search(self, probe, k=1):
+        """Retorna (posições dos usuários, distâncias) dos k mais próximos, em ordem"""
+        sq_distances = _squared_distances(self.matrix, self.sq_norms, probe)
+        if self.starts is not None:
+            sq_distances = np.minimum.reduceat(sq_distances, self.starts)
+        nearest = _top_k(sq_distances, k)
+        return nearest, np.sqrt(sq_distances[nearest])
+
+    def search_batch(self, probes, k=1):
+        """
+        Busca de vários rostos (M, 128) de uma vez: um único produto matricial
+        (M, N) e seleção parcial por linha. Retorna (posições, distâncias), ambos (M, k).
+        """
+        sq_distances = np.maximum(
+            self.sq_norms[None, :] - 2.0 * (probes @ self.matrix.T) + np.einsum('ij,ij->i', probes, probes)[:, None],
+            0.0
+        )
+        if self.starts is not None:
+            sq_distances = np.minimum.reduceat(sq_distances, self.starts, axis=1)
+
+        k = min(k, sq_distances.shape[1])
+        nearest = np.argpartition(sq_distances, k - 1, axis=1)[:, :k]
+        nearest_sq = np.take_along_axis(sq_distances, nearest, axis=1)
+        order = np.argsort(nearest_sq, axis=1)
+        return np.take_along_axis(nearest, order, axis=1), np.sqrt(np.take_along_axis(nearest_sq, order, axis=1))
+
+
+class IVFIndex:
+    """
+    Índice aproximado por listas invertidas (IVF).
+
+    Um k-means agrupa os encodings em `n_lists` listas; na busca o rosto é
+    comparado com os centróides e, de forma exata, só com os encodings das
+    `n_probe` listas mais próximas. As listas são guardadas como uma permutação
+    das linhas mais os deslocamentos de cada lista (sem copiar a matriz, que
+    pode estar mapeada do disco).
+    """
+
+    def __init__(self, matrix, sq_norms, row_owner=None, n_lists=None, n_probe=8, iterations=10, sample_size=65536,
+                 seed=0, retrain_drift=0.2, state=None):
+        self.matrix = matrix
+        self.sq_norms = sq_norms
+        self.row_owner = np.arange(len(matrix)) if row_owner is None else row_owner
+        self.retrain_drift = retrain_drift
+
+        if state is None:
+            n_lists = n_lists or int(round(np.sqrt(len(matrix))))
+            self.n_lists = max(1, min(n_lists, len(matrix)))
+            rng = np.random.default_rng(seed)
+            self.centroids = self._train(rng, iterations, sample_size)
+            # Linhas usadas no treino e linhas incluídas/removidas desde então
+            self.trained_size = len(matrix)
+            self.drift = 0
+            assignment = None
+        else:
+            # Centróides (e listas) de uma galeria anterior, sem refazer o k-means
+            self.centroids = np.asarray(state['centroids'], dtype=np.float32)
+            self.n_lists = len(self.centroids)
+            self.trained_size = int(state['trained_size'])
+            self.drift = int(state['drift'])
+            assignment = state.get('assignment')
+        self.n_probe = max(1, min(n_probe, self.n_lists))
+        self.centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+        self.assignment = self._assign(self.matrix) if assignment is None else np.asarray(assignment, dtype=np.int64)
+        self.order = np.argsort(self.assignment, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(self.assignment, minlength=self.n_lists))])
+
+    def state(self):
+        """Centróides e listas deste índice (reaproveitados por updated_state e pela galeria compartilhada)"""
+        return {'centroids': self.centroids, 'assignment': self.assignment,
+                'trained_size': self.trained_size, 'drift': self.drift}
+
+    def updated_state(self, kept_rows, new_rows):
+        """
+        Estado do índice da galeria atualizada: as linhas mantidas (`kept_rows`,
+        posições na matriz atual, na ordem da nova matriz) conservam a lista e
+        só as novas (`new_rows`, ao final da nova matriz) são atribuídas aos
+        centróides atuais. Retorna None quando as linhas incluídas/removidas
+        desde o treino passam de `retrain_drift` do tamanho treinado: aí o
+        k-means é refeito.
+        """
+        drift = self.drift + len(new_rows) + (len(self.matrix) - len(kept_rows))
+        if drift > self.retrain_drift * self.trained_size:
+            return None
+        return {
+            'centroids': self.centroids,
+            'assignment': np.concatenate([self.assignment[kept_rows], self._assign(new_rows)]),
+            'trained_size': self.trained_size,
+            'drift': drift
+        }
+
+    def _assign(self, rows, chunk_size=16384):
+        # Em blocos para não alocar uma matriz N x n_lists de uma vez
+        assignment = np.empty(len(rows), dtype=np.int64)
+        for start in range(0, len(rows), chunk_size):
+            block = np.asarray(rows[start:start + chunk_size], dtype=np.float32)
+            scores = self.centroid_sq_norms - 2.0 * (block @ self.centroids.T)
+            assignment[start:start + chunk_size] = np.argmin(scores, axis=1)
+        return assignment
+
+    def _train(self, rng, iterations, sample_size):
+        """k-means (Lloyd) sobre uma amostra da galeria"""
+        sample_rows = np.sort(rng.choice(len(self.matrix), min(sample_size, len(self.matrix)), replace=False))
+        sample = np.asarray(self.matrix[sample_rows], dtype=np.float32)
+        self.centroids = sample[rng.choice(len(sample), self.n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            self.centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+            assignment = self._assign(sample)
+            counts = np.bincount(assignment, minlength=self.n_lists)
+
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignment, sample)
+            filled = counts > 0
+            self.centroids[filled] = sums[filled] / counts[filled, None]
+
+            # Listas vazias recomeçam em um ponto qualquer da amostra
+            empty = np.flatnonzero(~filled)
+            if len(empty):
+                self.centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+
+        return self.centroids
+
+    def candidates(self, probe):
+        """Linhas das `n_probe` listas não vazias mais próximas do rosto capturado"""
+        scores = self.centroid_sq_norms - 2.0 * (self.centroids @ probe)
+        # Listas vazias (centróide sem nenhum encoding da galeria) não contam no n_probe;
+        # sem isso a busca podia terminar sem nenhum candidato
+        lists = np.argsort(scores, kind='stable')
+        lists = lists[self.offsets[lists + 1] > self.offsets[lists]][:self.n_probe]
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+
+    def search(self, probe, k=1):
+        """Retorna (posições dos usuários, distâncias) dos k mais próximos encontrados, em ordem"""
+        # Em ordem de linha, os blocos de cada usuário ficam contíguos
+        rows = np.sort(self.candidates(probe))
+        sq_distances = _squared_distances(self.matrix[rows], self.sq_norms[rows], probe)
+        owners, sq_distances = _min_per_owner(sq_distances, self.row_owner[rows])
+        nearest = _top_k(sq_distances, k)
+        return owners[nearest], np.sqrt(sq_distances[nearest])
+
+    def search_batch(self, probes, k=1):
+        """Vários rostos: cada um consulta as próprias listas; retorna listas de (posições, distâncias)"""
+        results = [self.search(probe, k) for probe in probes]
+        return [positions for positions, _ in results], [distances for _, distances in results]
+
+
+INDEX_TYPES = {'exact': ExactIndex, 'ivf': IVFIndex}
+
+
+def build_index(matrix, sq_norms, row_owner=None, kind='exact', min_size=20000, params=None, state=None):
+    """
+    Monta o índice configurado (busca exata abaixo de `min_size` encodings).
+    `state` (IVFIndex.state) reaproveita os centróides de um índice anterior.
+    """
+    if kind == 'exact' or len(matrix) < min_size:
+        return ExactIndex(matrix, sq_norms, row_owner)
+    if state is not None and kind == 'ivf':
+        return IVFIndex(matrix, sq_norms, row_owner, **(params or {}), state=state)
+    return INDEX_TYPES[kind](matrix, sq_norms, row_owner, **(params or {}))
+
+
+class FaceGallery:
+    """Snapshot imutável da galeria usado na comparação de rostos"""
+
+    def __init__(self, ids, nomes, matrix, counts=None, index_state=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.nomes = np.asarray(nomes, dtype=object)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        # Linhas de cada usuário (1 quando não há protótipo/exemplares)
+        self.counts = np.ones(len(self.ids), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        self.starts = np.cumsum(self.counts) - self.counts
+        self.row_owner = np.repeat(np.arange(len(self.ids)), self.counts) if len(self.matrix) != len(self.ids) else None
+        # ||x||² pré-calculado para a expansão ||x - q||² = ||x||² - 2x·q + ||q||²
+        self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        # Estado de um índice IVF anterior (ver IVFIndex.updated_state)
+        self.index_state = index_state
+        self._index = None
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], np.empty((0, ENCODING_SIZE), dtype=np.float32))
+
+    @classmethod
+    def from_cache(cls, cache):
+        """
+        Monta a galeria a partir do dicionário user_id -> {'nome', 'encoding'}
+        (ou 'encodings', matriz (k, 128) já resumida por summarize_encodings).
+        """
+        if not cache:
+            return cls.empty()
+
+        ids = list(cache.keys())
+        nomes = [cache[user_id]['nome'] for user_id in ids]
+        blocks = [
+            np.asarray(cache[user_id]['encodings'] if 'encodings' in cache[user_id] else cache[user_id]['encoding'],
+                       dtype=np.float32).reshape(-1, ENCODING_SIZE)
+            for user_id in ids
+        ]
+        return cls(ids, nomes, np.concatenate(blocks), [len(block) for block in blocks])
+
+    def updated(self, changed, removed_ids=()):
+        """
+        Nova galeria com os usuários de `changed` inseridos/substituídos e os
+        de `removed_ids` excluídos, sem reconstruir a matriz a partir do dict.
+        """
+        drop = np.fromiter(set(changed) | set(removed_ids), dtype=np.int64)
+        keep = ~np.isin(self.ids, drop)
+        kept_rows = np.flatnonzero(np.repeat(keep, self.counts))
+        novos = FaceGallery.from_cache(changed)
+
+        # Índice IVF: mantém os centróides e atribui só as linhas novas
+        index_state = None
+        if isinstance(self._index, IVFIndex):
+            index_state = self._index.updated_state(kept_rows, novos.matrix)
+
+        return FaceGallery(
+            np.concatenate([self.ids[keep], novos.ids]),
+            np.concatenate([self.nomes[keep], novos.nomes]),
+            np.concatenate([self.matrix[kept_rows], novos.matrix]),
+            np.concatenate([self.counts[keep], novos.counts]),
+            index_state
+        )
+
+    def unchanged_users(self, changed):
+        """Ids de `changed` cujo nome e encodings já estão nesta galeria, sem diferença"""
+        same = set()
+        for user_id, user in changed.items():
+            positions = np.flatnonzero(self.ids == user_id)
+            if not len(positions):
+                continue
+            position = positions[0]
+            block = np.asarray(user['encodings'] if 'encodings' in user else user['encoding'],
+                               dtype=np.float32).reshape(-1, ENCODING_SIZE)
+            start = self.starts[position]
+            if self.nomes[position] == user['nome'] and np.array_equal(
+                    self.matrix[start:start + self.counts[position]], block):
+                same.add(user_id)
+        return same
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def index(self):
+        """Índice de busca desta galeria, montado uma única vez por snapshot"""
+        if self._index is None:
+            self._index = build_index(self.matrix, self.sq_norms, self.row_owner, **_index_settings,
+                                      state=self.index_state)
+            self.index_state = None
+        return self._index
+
+    def prepare(self):
+        """Monta o índice antes de a galeria entrar em uso (fora do caminho do login)"""
+        self.index
+        return self
+
+    def distances(self, probe):
+        """Distância euclidiana do encoding capturado para todos os usuários (a menor de cada bloco)"""
+        probe = np.asarray(probe, dtype=np.float32)
+        sq_distances = _squared_distances(self.matrix, self.sq_norms, probe)
+        if self.row_owner is not None and len(self):
+            sq_distances = np.minimum.reduceat(sq_distances, self.starts)
+        return np.sqrt(sq_distances)
+
+    def search(self, probe, k=1):
+        """
+        Retorna os k usuários mais próximos do encoding capturado, do mais
+        próximo para o mais distante, como tuplas (user_id, nome, distância).
+        """
+        if not len(self):
+            return []
+
+        positions, distances = self.index.search(np.asarray(probe, dtype=np.float32), k)
+
+        return [
+            (int(self.ids[i]), self.nomes[i], float(distance))
+            for i, distance in zip(positions, distances)
+        ]
+
+    def search_batch(self, probes, k=1):
+        """
+        Busca de vários rostos capturados no mesmo quadro (M, 128) de uma vez.
+        Retorna, para cada rosto, a lista de (user_id, nome, distância) como em search().
+        """
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if not len(self) or not len(probes):
+            return [[] for _ in range(len(probes))]
+
+        positions, distances = self.index.search_batch(probes, k)
+        return [
+            [(int(self.ids[i]), self.nomes[i], float(distance)) for i, distance in zip(row_positions, row_distances)]
+            for row_positions, row_distances in zip(positions, distances)
+        ]
+
+
+class SharedGalleryStore:
+    """
+    Galeria compartilhada entre os workers do gunicorn via arquivos mapeados em memória.
+
+    Cada geração é gravada uma única vez como gallery-<geração>.npy (matriz
+    float32) e gallery-<geração>.json (ids, nomes e metadados); o arquivo
+    CURRENT aponta para a geração mais recente. Os workers mapeiam a matriz
+    somente leitura, então as páginas ficam no page cache do sistema e não
+    são duplicadas em cada processo.
+
+    Novos cadastros gravam um carimbo em INVALIDATED; enquanto ele for mais
+    novo que o carimbo em CHECKED (última consulta ao banco do construtor),
+    os workers tentam rodar a atualização incremental.
+    """
+
+    KEEP_GENERATIONS = 3
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.current_path = os.path.join(directory, 'CURRENT')
+        self.lock_path = os.path.join(directory, 'build.lock')
+        self.invalidated_path = os.path.join(directory, 'INVALIDATED')
+        self.checked_path = os.path.join(directory, 'CHECKED')
+
+    def _base_path(self, generation):
+        return os.path.join(self.directory, f'gallery-{generation:08d}')
+
+    def current_generation(self):
+        """Geração publicada mais recente (0 se nenhuma foi publicada)"""
+        try:
+            with open(self.current_path) as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _read_stamp(self, path):
+        try:
+            with open(path) as f:
+                return float(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0.0
+
+    def _write_stamp(self, path, value):
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(repr(float(value)))
+        os.replace(f'{path}.tmp', path)
+
+    def invalidate(self):
+        """Sinaliza a todos os workers que há cadastros novos a carregar do banco"""
+        self._write_stamp(self.invalidated_path, time.time())
+
+    def invalidation_stamp(self):
+        return self._read_stamp(self.invalidated_path)
+
+    def mark_checked(self, stamp):
+        """Registra que o banco foi consultado depois da invalidação `stamp`"""
+        self._write_stamp(self.checked_path, stamp)
+
+    def invalidation_pending(self):
+        """Há invalidação mais nova do que a última consulta ao banco?"""
+        return self.invalidation_stamp() > self._read_stamp(self.checked_path)
+
+    def last_checked(self):
+        """Momento em que o worker construtor confirmou a galeria contra o banco"""
+        try:
+            return os.stat(self.checked_path).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    @contextmanager
+    def builder_lock(self):
+        """
+        Elege um único worker para consultar o banco e publicar a galeria.
+        Retorna True para o processo que obteve o lock e False para os demais.
+        """
+        if fcntl is None:
+            yield True
+            return
+
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def publish(self, gallery, metadata=None):
+        """Grava uma nova geração da galeria e a torna a atual"""
+        generation = self.current_generation() + 1
+        base = self._base_path(generation)
+
+        with open(f'{base}.npy.tmp', 'wb') as f:
+            np.save(f, gallery.matrix)
+        with open(f'{base}.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                'ids': gallery.ids.tolist(),
+                'nomes': list(gallery.nomes),
+                'counts': gallery.counts.tolist(),
+                'metadata': metadata or {}
+            }, f, ensure_ascii=False)
+
+        # Centróides e listas do IVF: os workers mapeiam a galeria sem refazer o k-means
+        if isinstance(gallery._index, IVFIndex):
+            with open(f'{base}.ivf.npz.tmp', 'wb') as f:
+                np.savez(f, **gallery._index.state())
+            os.replace(f'{base}.ivf.npz.tmp', f'{base}.ivf.npz')
+
+        os.replace(f'{base}.npy.tmp', f'{base}.npy')
+        os.replace(f'{base}.json.tmp', f'{base}.json')
+
+        # A troca do ponteiro é atômica: leitores veem a geração antiga ou a nova
+        with open(f'{self.current_path}.tmp', 'w') as f:
+            f.write(str(generation))
+        os.replace(f'{self.current_path}.tmp', self.current_path)
+
+        self._remove_old_generations(generation)
+        return generation
+
+    def load(self, generation):
+        """Mapeia a geração informada; retorna (galeria, metadados)"""
+        base = self._base_path(generation)
+        with open(f'{base}.json', encoding='utf-8') as f:
+            data = json.load(f)
+
+        if not data['ids']:
+            return FaceGallery.empty(), data['metadata']
+
+        index_state = None
+        if os.path.exists(f'{base}.ivf.npz'):
+            with np.load(f'{base}.ivf.npz') as ivf:
+                index_state = {key: ivf[key] for key in ivf.files}
+
+        matrix = np.load(f'{base}.npy', mmap_mode='r')
+        return FaceGallery(data['ids'], data['nomes'], matrix, data.get('counts'), index_state), data['metadata']
+
+    def _remove_old_generations(self, generation):
+        # Workers que ainda mapeiam uma geração removida continuam lendo o
+        # arquivo normalmente (unlink não invalida o mapeamento já aberto)
+        for filename in os.listdir(self.directory):
+            name, _, ext = filename.partition('.')
+            if not name.startswith('gallery-') or ext not in ('npy', 'json', 'ivf.npz'):
+                continue
+            try:
+                old = int(name[len('gallery-'):])
+            except ValueError:
+                continue
+            if old <= generation - self.KEEP_GENERATIONS:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,207 @@
+"""
+Pipeline de imagem do login: decodificação já reduzida, redimensionamento e
+normalização feitos direto sobre arrays NumPy (OpenCV), sem ida e volta ao PIL,
+e a cascata de detecção de rostos com orçamento de tempo por estágio.
+"""
+import time
+from collections import namedtuple
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+# Largura máxima do quadro usado na detecção do login
+LOGIN_MAX_WIDTH = 640
+
+# Kernel do filtro SMOOTH do PIL, base do ImageEnhance.Sharpness
+SMOOTH_KERNEL = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+
+
+def decode_image(image_bytes, max_width=None):
+    """
+    Decodifica a imagem para um array RGB com no máximo `max_width` de largura.
+
+    Em JPEGs o decodificador já reduz a imagem na própria DCT (PIL draft, em
+    potências de 2), então um quadro grande nunca é expandido em tamanho
+    cheio; o ajuste final é feito com cv2.resize.
+    """
+    image = Image.open(BytesIO(image_bytes))
+
+    if max_width and image.width > max_width:
+        # Só tem efeito em JPEG; o tamanho resultante fica >= ao pedido
+        image.draft('RGB', (max_width, max(1, image.height * max_width // image.width)))
+
+    rgb_image = np.asarray(image.convert('RGB'))
+
+    height, width = rgb_image.shape[:2]
+    if max_width and width > max_width:
+        new_height = max(1, int(height * max_width / width))
+        rgb_image = cv2.resize(rgb_image, (max_width, new_height), interpolation=cv2.INTER_AREA)
+
+    return rgb_image
+
+
+def enhance_for_matching(rgb_image, contrast=1.4, sharpness=1.3):
+    """
+    Realce de contraste e nitidez da foto de login para que ela se pareça mais
+    com a foto de referência salva. Mesmas fórmulas do ImageEnhance.Contrast e
+    ImageEnhance.Sharpness do PIL, calculadas com saturação em uint8 pelo OpenCV.
+    """
+    # Contraste: mistura com a luminância média da imagem
+    mean = int(cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY).mean() + 0.5)
+    rgb_image = cv2.addWeighted(rgb_image, contrast, rgb_image, 0, (1 - contrast) * mean)
+
+    # Nitidez: mistura com a versão suavizada
+    smooth = cv2.filter2D(rgb_image, -1, SMOOTH_KERNEL, borderType=cv2.BORDER_REPLICATE)
+    return cv2.addWeighted(rgb_image, sharpness, smooth, 1 - sharpness, 0)
+
+
+def normalize_enrollment_face(pil_image, face_locations, size=300):
+    """
+    Recorta o maior rosto da foto de cadastro, redimensiona para `size` x `size`
+    e equaliza o histograma (foto de referência salva em static/fotos).
+    """
+    top, right, bottom, left = max(face_locations, key=lambda x: (x[2] - x[0]) * (x[1] - x[3]))
+
+    # Cropar a face diretamente da imagem original
+    face_image = pil_image.crop((left, top, right, bottom))
+    face_image = face_image.resize((size, size), Image.Resampling.LANCZOS)
+
+    # Normalização de contraste com equalização de histograma
+    equalized_face = ImageOps.equalize(face_image.convert('L'))
+
+    # De volta para RGB para salvar como JPEG
+    return equalized_face.convert('RGB')
+
+
+class DetectionStage:
+    """
+    Um estágio da cascata de detecção (modelo, upsample e escala da imagem).
+
+    O custo é estimado em segundos por megapixel efetivo (após escala e
+    upsample) e ajustado por média móvel a cada execução, para que o estágio
+    seja pulado quando não couber no orçamento de tempo. Enquanto pulado, a
+    estimativa volta aos poucos (`decay`) para o valor inicial: uma execução
+    lenta isolada não tira o estágio da cascata para sempre.
+    """
+
+    def __init__(self, name, model='hog', upsample=0, scale=1.0, budget=1.0, seconds_per_mpx=0.1, decay=0.1):
+        self.name = name
+        self.model = model
+        self.upsample = upsample
+        self.scale = scale
+        self.budget = budget
+        self.seconds_per_mpx = seconds_per_mpx
+        self.initial_seconds_per_mpx = seconds_per_mpx
+        self.decay = decay
+
+    def effective_mpx(self, shape):
+        factor = self.scale * (2 ** self.upsample)
+        return shape[0] * shape[1] * factor * factor / 1e6
+
+    def estimate(self, shape):
+        """Tempo estimado (s) deste estágio para uma imagem do formato dado"""
+        return self.seconds_per_mpx * self.effective_mpx(shape)
+
+    def observe(self, shape, seconds):
+        mpx = self.effective_mpx(shape)
+        if mpx > 0:
+            self.seconds_per_mpx = 0.8 * self.seconds_per_mpx + 0.2 * (seconds / mpx)
+
+    def skip(self):
+        """Registra que o estágio foi pulado; a estimativa se aproxima do valor inicial"""
+        self.seconds_per_mpx += self.decay * (self.initial_seconds_per_mpx - self.seconds_per_mpx)
+
+    def run(self, rgb_image):
+        image = rgb_image
+        if self.scale != 1.0:
+            height, width = rgb_image.shape[:2]
+            image = cv2.resize(rgb_image, (max(1, int(width * self.scale)), max(1, int(height * self.scale))),
+                               interpolation=cv2.INTER_AREA)
+
+        # Importado só aqui: o processo do Flask usa este módulo sem carregar o dlib
+        import face_recognition
+        locations = face_recognition.face_locations(image, number_of_times_to_upsample=self.upsample, model=self.model)
+
+        if self.scale != 1.0:
+            # Volta para as coordenadas da imagem original
+            locations = [
+                tuple(int(round(value / self.scale)) for value in location)
+                for location in locations
+            ]
+        return locations
+
+
+Detection = namedtuple('Detection', ['locations', 'stage', 'elapsed', 'skipped'])
+
+
+def _same_face(a, b):
+    """Duas caixas (top, right, bottom, left) do mesmo rosto: o centro de uma cai dentro da outra"""
+    center_y, center_x = (a[0] + a[2]) / 2, (a[1] + a[3]) / 2
+    return b[0] <= center_y <= b[2] and b[3] <= center_x <= b[1]
+
+
+class DetectionCascade:
+    """
+    Detecção de rostos em estágios, do mais barato para o mais caro.
+
+    Para no primeiro estágio que encontrar um rosto. Um estágio só é tentado
+    se o custo estimado couber no orçamento dele e no que resta do orçamento
+    total, o que limita o pior caso de latência do login.
+
+    Com `exhaustive` (quadros com várias pessoas) todos os estágios que
+    couberem no orçamento rodam e os rostos novos de cada um se somam aos
+    anteriores: os pequenos, que só o upsample encontra, não se perdem porque
+    um estágio barato já achou os grandes.
+    """
+
+    def __init__(self, stages, total_budget=1.5, exhaustive=False):
+        self.stages = stages
+        self.total_budget = total_budget
+        self.exhaustive = exhaustive
+
+    def detect(self, rgb_image):
+        start_time = time.time()
+        skipped = []
+        found = []
+        found_stages = []
+
+        for stage in self.stages:
+            elapsed = time.time() - start_time
+            estimate = stage.estimate(rgb_image.shape)
+            if estimate > stage.budget or elapsed + estimate > self.total_budget:
+                skipped.append(stage.name)
+                stage.skip()
+                continue
+
+            stage_start = time.time()
+            locations = stage.run(rgb_image)
+            stage.observe(rgb_image.shape, time.time() - stage_start)
+
+            if locations and not self.exhaustive:
+                return Detection(locations, stage.name, time.time() - start_time, skipped)
+
+            new = [location for location in locations
+                   if not any(_same_face(location, other) or _same_face(other, location) for other in found)]
+            if new:
+                found.extend(new)
+                found_stages.append(stage.name)
+
+        return Detection(found, '+'.join(found_stages) or None, time.time() - start_time, skipped)
+
+
+def build_detection_cascade(total_budget=1.5, enable_cnn=False, cnn_budget=3.0, exhaustive=False):
+    """
+    Cascata padrão: HOG rápido em meia resolução, HOG com upsample na
+    resolução cheia e, se habilitado, o CNN do dlib (muito lento em CPU).
+    """
+    stages = [
+        DetectionStage('hog_fast', model='hog', upsample=0, scale=0.5, budget=0.35 * total_budget, seconds_per_mpx=0.1),
+        DetectionStage('hog', model='hog', upsample=1, scale=1.0, budget=0.65 * total_budget, seconds_per_mpx=0.1),
+    ]
+    if enable_cnn:
+        stages.append(DetectionStage('cnn', model='cnn', upsample=0, scale=1.0, budget=cnn_budget, seconds_per_mpx=8.0))
+        total_budget += cnn_budget
+
+    return DetectionCascade(stages, total_budget, exhaustive)
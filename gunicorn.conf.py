@@ -1,3 +1,8 @@
 bind = "127.0.0.1:8090"
 workers = 4
-timeout = 120 
\ No newline at end of file
+timeout = 120 
+
+def post_worker_init(worker):
+    # Cada worker carrega a galeria e o pool de encoding antes de aceitar requisições
+    from app import start_background_services
+    start_background_services()
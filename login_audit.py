@@ -0,0 +1,203 @@
+"""
+Gravação assíncrona e em lote dos registros de login.
+
+O reconhecimento só enfileira o evento (usuário + data/hora do acerto) e
+responde imediatamente; uma thread de fundo grava a fila na tabela `login`
+com INSERTs de várias linhas, quando o lote enche ou a cada intervalo.
+
+Logins reconhecidos com folga podem levar junto o encoding da captura, gravado
+em encodings_usuario (origem 'login') no mesmo lote, mantendo só os mais
+recentes de cada usuário.
+
+Com `daily_attendance`, o mesmo lote também atualiza a presença agregada por
+dia e usuário (tabela presenca_diaria), lida pelos painéis de frequência.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def prune_encodings(cursor, usuario_id, origem, keep):
+    """Apaga os encodings de uma origem além dos `keep` mais recentes do usuário"""
+    cursor.execute("""
+        DELETE FROM encodings_usuario
+        WHERE usuario_id = %s AND origem = %s AND id NOT IN (
+            SELECT id FROM (
+                SELECT id FROM encodings_usuario
+                WHERE usuario_id = %s AND origem = %s
+                ORDER BY id DESC LIMIT %s
+            ) recentes
+        )
+    """, (usuario_id, origem, usuario_id, origem, keep))
+
+
+class LoginAuditWriter:
+    """Fila de eventos de login gravada em lote por uma thread de fundo"""
+
+    def __init__(self, connection_factory, batch_size=100, flush_interval=1.0, max_queue=10000,
+                 encoding_version=None, max_login_encodings=10, daily_attendance=False):
+        self.connection_factory = connection_factory
+        self.daily_attendance = daily_attendance
+        # (modelo, versão do detector) gravados junto dos encodings de login
+        self.encoding_version = encoding_version
+        self.max_login_encodings = max_login_encodings
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Inicia a thread de gravação (uma por processo/worker do gunicorn)"""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='login-audit', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def record(self, usuario_id, when=None, encoding=None):
+        """
+        Enfileira um login (com o BLOB do encoding da captura, opcional);
+        retorna False se a fila estiver cheia
+        """
+        when = when or datetime.now()
+        if encoding is not None and self.encoding_version is None:
+            encoding = None
+        self.start()
+        try:
+            self.queue.put_nowait((usuario_id, when.date(), when.time().replace(microsecond=0), encoding))
+            return True
+        except queue.Full:
+            logger.error(f"Fila de auditoria de login cheia, login do usuário {usuario_id} descartado")
+            return False
+
+    def record_many(self, usuario_ids, when=None):
+        """
+        Enfileira vários logins do mesmo instante (ex.: todos os rostos de um
+        quadro); retorna os usuários que não couberam na fila
+        """
+        when = when or datetime.now()
+        return [usuario_id for usuario_id in usuario_ids if not self.record(usuario_id, when)]
+
+    def flush(self):
+        """Grava imediatamente tudo que estiver na fila (para na primeira falha)"""
+        while True:
+            events = self._drain(self.batch_size)
+            if not events or not self._write(events):
+                return
+
+    def stop(self, timeout=5.0):
+        """Encerra a thread gravando o que restou na fila (chamado no desligamento)"""
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self.flush()
+
+    def _drain(self, limit):
+        events = []
+        while len(events) < limit:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def _run(self):
+        while not self._stop.is_set():
+            deadline = time.time() + self.flush_interval
+            events = []
+
+            # Acumula até encher o lote ou vencer o intervalo
+            while len(events) < self.batch_size and not self._stop.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    events.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                events.extend(self._drain(self.batch_size - len(events)))
+
+            if events and not self._write(events):
+                # Banco indisponível: espera um intervalo antes de tentar de novo
+                self._stop.wait(self.flush_interval)
+
+    def _write(self, events):
+        with self._write_lock:
+            conn = None
+            try:
+                conn = self.connection_factory()
+                if not conn:
+                    raise RuntimeError("Banco de dados indisponível")
+
+                cursor = conn.cursor()
+                # O mysql-connector transforma o executemany de INSERT em um único INSERT multi-linhas
+                cursor.executemany("""
+                    INSERT INTO login (usuario_id, data_login, hora_login)
+                    VALUES (%s, %s, %s)
+                """, [event[:3] for event in events])
+                if self.daily_attendance:
+                    self._write_attendance(cursor, events)
+                self._write_encodings(cursor, events)
+                conn.commit()
+                cursor.close()
+                logger.debug(f"{len(events)} logins gravados")
+                return True
+            except Exception as e:
+                logger.error(f"Erro ao registrar {len(events)} logins: {e}")
+                self._requeue(events)
+                return False
+            finally:
+                if conn:
+                    conn.close()
+
+    def _write_attendance(self, cursor, events):
+        # Um lote pode ter vários logins do mesmo usuário no dia: agrega antes
+        days = {}
+        for usuario_id, data_login, hora_login, _ in events:
+            key = (data_login, usuario_id)
+            if key in days:
+                primeiro, ultimo, total = days[key]
+                days[key] = (min(primeiro, hora_login), max(ultimo, hora_login), total + 1)
+            else:
+                days[key] = (hora_login, hora_login, 1)
+
+        cursor.executemany("""
+            INSERT INTO presenca_diaria (data, usuario_id, primeiro_login, ultimo_login, total_logins)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                primeiro_login = LEAST(primeiro_login, VALUES(primeiro_login)),
+                ultimo_login = GREATEST(ultimo_login, VALUES(ultimo_login)),
+                total_logins = total_logins + VALUES(total_logins)
+        """, [key + value for key, value in sorted(days.items())])
+
+    def _write_encodings(self, cursor, events):
+        encodings = [(event[0], event[3]) + self.encoding_version for event in events if event[3] is not None]
+        if not encodings:
+            return
+
+        cursor.executemany("""
+            INSERT INTO encodings_usuario (usuario_id, encoding, modelo, versao_detector, origem)
+            VALUES (%s, %s, %s, %s, 'login')
+        """, encodings)
+        for usuario_id in {row[0] for row in encodings}:
+            prune_encodings(cursor, usuario_id, 'login', self.max_login_encodings)
+
+    def _requeue(self, events):
+        # Mantém os eventos para a próxima tentativa enquanto houver espaço na fila
+        for i, event in enumerate(events):
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                logger.error(f"Fila de auditoria cheia, {len(events) - i} logins descartados")
+                return
@@ -0,0 +1,137 @@
+"""
+Reconhecimentos recentes por usuário, para não registrar o mesmo login várias
+vezes seguidas.
+
+Com o aluno parado diante do totem, o loop de captura da tela de login o
+reconhece a cada quadro; só o primeiro reconhecimento dentro da janela grava
+um login, os seguintes devolvem a resposta já dada.
+
+Cada processo guarda os reconhecimentos em memória; com um diretório
+configurado, cada usuário também tem um arquivo-marcador (instante + resposta)
+lido e gravado sob flock, para que os workers do gunicorn concordem sobre quem
+já foi registrado, mesmo quando quadros seguidos caem em workers diferentes.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem flock, vale só a memória de cada processo (sem marcadores)
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class RecentRecognitions:
+    """Janela de `window` segundos por usuário entre dois logins registrados"""
+
+    def __init__(self, window=60, directory=None):
+        self.window = window
+        self.directory = directory if fcntl is not None else None
+        self._recent = {}
+        self._lock = threading.Lock()
+        self._next_prune = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def claim(self, usuario_id, response=None, now=None):
+        """
+        Tenta registrar um reconhecimento do usuário. Retorna (novo, resposta):
+        novo=True se não houve reconhecimento na janela (o login deve ser
+        gravado e `response` fica guardada); senão False e a resposta guardada
+        do primeiro reconhecimento.
+        """
+        if not self.enabled:
+            return True, response
+
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._recent.get(usuario_id)
+            if entry is not None and now - entry[0] < self.window:
+                return False, entry[1]
+
+            if self.directory:
+                try:
+                    previous = self._claim_marker(usuario_id, response, now)
+                except OSError as e:
+                    # Sem o marcador, vale só a memória deste processo
+                    logger.error(f"Erro no marcador de login recente do usuário {usuario_id}: {e}")
+                    previous = None
+                if previous is not None:
+                    self._recent[usuario_id] = previous
+                    return False, previous[1]
+
+            self._recent[usuario_id] = (now, response)
+            self._prune(now)
+            return True, response
+
+    def release(self, usuario_id):
+        """
+        Desfaz o reconhecimento registrado por claim (o login não chegou a ser
+        gravado): o próximo reconhecimento do usuário volta a ser novo.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._recent.pop(usuario_id, None)
+            if self.directory:
+                try:
+                    self._release_marker(usuario_id)
+                except OSError as e:
+                    logger.error(f"Erro ao liberar o marcador de login recente do usuário {usuario_id}: {e}")
+
+    def _marker_path(self, usuario_id):
+        return os.path.join(self.directory, f'{int(usuario_id)}.json')
+
+    def _release_marker(self, usuario_id):
+        try:
+            f = open(self._marker_path(usuario_id), 'r+')
+        except FileNotFoundError:
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # Marcador vazio conta como ausente em _claim_marker
+                f.truncate()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _claim_marker(self, usuario_id, response, now):
+        path = self._marker_path(usuario_id)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            # O flock serializa workers que reconhecem o mesmo usuário ao mesmo tempo
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                content = f.read()
+                try:
+                    marker = json.loads(content) if content else None
+                except ValueError:
+                    marker = None
+
+                if marker is not None and now - marker.get('time', 0) < self.window:
+                    return marker['time'], marker.get('response')
+
+                f.seek(0)
+                f.truncate()
+                json.dump({'time': now, 'response': response}, f)
+                f.flush()
+                return None
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _prune(self, now):
+        # Descarta as entradas vencidas de tempos em tempos
+        if now < self._next_prune:
+            return
+        self._next_prune = now + self.window
+        for usuario_id in [key for key, (when, _) in self._recent.items() if now - when >= self.window]:
+            del self._recent[usuario_id]
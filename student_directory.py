@@ -0,0 +1,225 @@
+"""
+Lista de alunos da API PHP para as telas de cadastro.
+
+A lista remota é mantida em memória com TTL e revalidada com requisição
+condicional (If-None-Match / If-Modified-Since): um 304 só renova o prazo,
+sem baixar a lista de novo. Se a API PHP falhar, a última cópia continua
+sendo servida (stale-on-error) até voltar.
+
+O conjunto de `id_usuario_php` que já têm foto fica em memória e é atualizado
+no próprio cadastro; o banco só é consultado de novo quando o conjunto vence
+ou quando algum worker invalida a galeria compartilhada (novo cadastro).
+"""
+import logging
+import threading
+import time
+import unicodedata
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    """Texto sem acentos e em minúsculas, para a busca por nome"""
+    decomposed = unicodedata.normalize('NFKD', str(text or ''))
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+class RemoteListCache:
+    """Cópia local de uma lista JSON remota com TTL, ETag/Last-Modified e stale-on-error"""
+
+    def __init__(self, url, ttl=300, timeout=15, error_retry=30):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        # Após uma falha, espera este tempo antes de tentar a API de novo
+        self.error_retry = error_retry
+        self.data = None
+        self.version = 0
+        self.etag = None
+        self.last_modified = None
+        self.expires_at = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.data = None
+            self.version = 0
+            self.etag = self.last_modified = self.last_error = None
+            self.expires_at = 0
+
+    def get(self):
+        """
+        Retorna (lista, versão). Levanta a exceção da API apenas se nunca houve
+        uma cópia válida; com cópia em memória, uma falha só é registrada.
+        """
+        if self.data is not None and time.time() < self.expires_at:
+            return self.data, self.version
+
+        if self.data is not None and not self._lock.acquire(blocking=False):
+            # Outra thread já está revalidando: serve a cópia atual
+            return self.data, self.version
+        if self.data is None:
+            self._lock.acquire()
+
+        try:
+            if self.data is None or time.time() >= self.expires_at:
+                self._refresh()
+            return self.data, self.version
+        finally:
+            self._lock.release()
+
+    def _refresh(self):
+        headers = {}
+        if self.data is not None:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+        try:
+            response = requests.get(self.url, headers=headers, timeout=self.timeout, verify=False)
+            if response.status_code == 304 and self.data is not None:
+                logger.debug("Lista de alunos da API PHP não mudou (304)")
+            else:
+                response.raise_for_status()
+                data = response.json()
+                if not isinstance(data, list):
+                    raise ValueError("A API do PHP não retornou uma lista de alunos")
+                self.data = data
+                self.version += 1
+                self.etag = self._header(response, 'ETag')
+                self.last_modified = self._header(response, 'Last-Modified')
+                logger.info(f"Lista de alunos da API PHP atualizada: {len(data)} alunos")
+
+            self.last_error = None
+            self.expires_at = time.time() + self.ttl
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.last_error = str(e)
+            if self.data is None:
+                raise
+            logger.warning(f"API PHP indisponível, servindo a lista em cache: {e}")
+            self.expires_at = time.time() + self.error_retry
+
+    @staticmethod
+    def _header(response, name):
+        value = response.headers.get(name)
+        return value if isinstance(value, str) else None
+
+
+class EnrolledIds:
+    """
+    Conjunto dos `id_usuario_php` com foto cadastrada. `loader` lê o conjunto
+    do banco; `generation` (opcional) retorna um marcador que muda sempre que
+    algum worker cadastra uma foto (a invalidação da galeria compartilhada).
+    """
+
+    def __init__(self, loader, ttl=300, generation=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.generation = generation or (lambda: None)
+        self.ids = None
+        self.version = 0
+        self.expires_at = 0
+        self.loaded_generation = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.ids = None
+            self.expires_at = 0
+
+    def get(self):
+        """Retorna (conjunto, versão); recarrega do banco quando vencido ou invalidado"""
+        generation = self.generation()
+        with self._lock:
+            if self.ids is None or time.time() >= self.expires_at or generation != self.loaded_generation:
+                try:
+                    ids = set(self.loader())
+                except Exception as e:
+                    if self.ids is None:
+                        # Sem banco, a lista sai sem filtro (tenta de novo na próxima chamada)
+                        logger.error(f"Erro ao consultar os alunos com foto: {e}")
+                        return set(), self.version
+                    logger.error(f"Erro ao recarregar os alunos com foto, mantendo o conjunto atual: {e}")
+                    ids = self.ids
+                if ids != self.ids:
+                    self.version += 1
+                self.ids = ids
+                self.expires_at = time.time() + self.ttl
+                self.loaded_generation = generation
+            return self.ids, self.version
+
+    def add(self, *ids_php):
+        """Registra alunos recém-cadastrados (sem consultar o banco)"""
+        with self._lock:
+            if self.ids is None:
+                return
+            new = {int(id_php) for id_php in ids_php} - self.ids
+            if new:
+                self.ids |= new
+                self.version += 1
+
+
+class StudentDirectory:
+    """Alunos da API PHP ainda sem foto, com busca por nome e paginação"""
+
+    def __init__(self, remote, enrolled):
+        self.remote = remote
+        self.enrolled = enrolled
+        self._index = None
+        self._index_key = None
+        self._lock = threading.Lock()
+
+    def version(self):
+        """Versão da lista filtrada (usada no ETag da resposta)"""
+        self.without_photo()
+        return '-'.join(str(part) for part in self._index_key)
+
+    def without_photo(self):
+        """Retorna [(nome normalizado, aluno)] dos alunos sem foto, ordenados por nome"""
+        alunos, remote_version = self.remote.get()
+        ids, enrolled_version = self.enrolled.get()
+        key = (remote_version, enrolled_version)
+
+        with self._lock:
+            if self._index_key != key:
+                index = []
+                for aluno in alunos:
+                    try:
+                        aluno_id = int(aluno.get('id'))
+                    except (TypeError, ValueError):
+                        continue
+                    if aluno_id not in ids:
+                        index.append((normalize_text(aluno.get('nome_aluno') or aluno.get('nome')), aluno))
+                index.sort(key=lambda item: item[0])
+                self._index, self._index_key = index, key
+            return self._index
+
+    def all(self):
+        return [aluno for _, aluno in self.without_photo()]
+
+    def search(self, query='', page=1, per_page=50):
+        """Página `page` dos alunos sem foto cujo nome (ou CPF) contém `query`"""
+        index = self.without_photo()
+        terms = normalize_text(query).split()
+        digits = ''.join(char for char in query if char.isdigit())
+
+        if terms:
+            matches = [
+                aluno for nome, aluno in index
+                if all(term in nome for term in terms)
+                or (digits and digits in ''.join(char for char in str(aluno.get('cpf_aluno') or '') if char.isdigit()))
+            ]
+        else:
+            matches = [aluno for _, aluno in index]
+
+        start = (page - 1) * per_page
+        return {
+            'items': matches[start:start + per_page],
+            'total': len(matches),
+            'page': page,
+            'per_page': per_page
+        }
@@ -0,0 +1,4 @@
+import os
+
+# Nos testes a detecção/encoding roda na própria thread (sem pool de processos)
+os.environ.setdefault('FACE_ENCODER_PROCESSES', '0')
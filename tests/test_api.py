@@ -1,7 +1,17 @@
 import pytest
 import base64
+import io
+import time
+import numpy as np
+from PIL import Image
 from unittest.mock import patch, MagicMock
+import app as app_module
 from app import app
+from datetime import datetime
+from face_gallery import FaceGallery, SharedGalleryStore
+from face_pipeline import Detection
+from face_encoder import EncoderBusy
+from login_debounce import RecentRecognitions
 
 @pytest.fixture
 def client():
@@ -10,6 +20,20 @@ def client():
     with app.test_client() as client:
         yield client
 
+@pytest.fixture(autouse=True)
+def reset_encodings_cache(monkeypatch):
+    """Garante que cada teste comece com o cache de encodings vazio"""
+    monkeypatch.setattr(app_module, 'CACHE_BACKGROUND_REFRESH', False)
+    monkeypatch.setattr(app_module, 'gallery_store', None)
+    app_module.encodings_gallery = FaceGallery.empty()
+    app_module.gallery_generation = 0
+    app_module.cache_high_water = dict(app_module.EMPTY_HIGH_WATER)
+    app_module.last_cache_update = 0
+    monkeypatch.setattr(app_module, 'recent_logins', RecentRecognitions(60))
+    app_module.alunos_php_cache.clear()
+    app_module.enrolled_php_ids.clear()
+    yield
+
 def test_index_page(client):
     """Testa se a página inicial carrega corretamente"""
     response = client.get('/')
@@ -48,6 +72,18 @@ def test_health_check(mock_get_db, client):
     assert data['status'] == 'OK'
     assert data['database'] == 'Connected'
     assert data['users_in_db'] == 5
+    assert 'age_seconds' in data['cache']
+    assert 'last_refresh_duration' in data['cache']
+
+@patch('app.get_db_connection')
+def test_start_background_services_loads_gallery_before_first_request(mock_get_db, client):
+    """No boot do worker a galeria já é carregada: /health não mostra 'Never'"""
+    mock_db(mock_get_db, [photo_row(1, 10)], [encoding_row(1, 100, np.random.rand(128))])
+
+    app_module.start_background_services()
+
+    assert len(app_module.encodings_gallery) == 1
+    assert app_module.last_cache_update > 0
 
 @patch('app.get_db_connection')
 def test_health_check_db_failure(mock_get_db, client):
@@ -87,3 +123,727 @@ def test_get_alunos_php(mock_get_db, mock_requests_get, client):
     data = response.get_json()
     assert len(data) == 2
     assert data[0]['nome'] == 'Aluno Teste 1'
+
+@patch('requests.get')
+@patch('app.get_db_connection')
+def test_get_alunos_php_cache_search_and_etag(mock_get_db, mock_requests_get, client):
+    """Testa o cache da lista do PHP (304 e stale-on-error), a busca paginada e o ETag"""
+    import requests
+    mock_db(mock_get_db, [(2,)])
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.headers = {'ETag': '"v1"'}
+    mock_response.json.return_value = [
+        {"id": 1, "nome_aluno": "Érica Souza", "cpf_aluno": "111.222.333-44"},
+        {"id": 2, "nome_aluno": "Ana Lima", "cpf_aluno": "555"},
+        {"id": 3, "nome_aluno": "Bruno Erick", "cpf_aluno": "666"},
+        {"id": 4, "nome_aluno": "Carla Dias", "cpf_aluno": "777"}
+    ]
+    mock_requests_get.return_value = mock_response
+
+    response = client.get('/api/alunos_php?q=eri&per_page=1')
+    data = response.get_json()
+    assert data['total'] == 2  # sem acento e sem o aluno 2, que já tem foto
+    assert [aluno['id'] for aluno in data['items']] == [3]
+    etag = response.headers['ETag']
+
+    # Dentro do TTL nem a API PHP nem o banco são consultados de novo
+    response = client.get('/api/alunos_php?q=eri&per_page=1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert mock_requests_get.call_count == 1
+
+    # Um novo cadastro muda a lista (e o ETag) sem reconsultar o banco
+    app_module.enrolled_php_ids.add(3)
+    response = client.get('/api/alunos_php?q=11122', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert [aluno['id'] for aluno in response.get_json()['items']] == [1]
+
+    # Lista vencida: requisição condicional; com a API fora do ar a cópia continua valendo
+    app_module.alunos_php_cache.expires_at = 0
+    mock_response.status_code = 304
+    assert client.get('/api/alunos_php').status_code == 200
+    assert mock_requests_get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+
+    app_module.alunos_php_cache.expires_at = 0
+    mock_requests_get.side_effect = requests.exceptions.ConnectionError('fora do ar')
+    response = client.get('/api/alunos_php')
+    assert response.status_code == 200
+    assert [aluno['id'] for aluno in response.get_json()] == [4, 1]
+
+def photo_row(user_id, foto_id, stored=True, data_captura=datetime(2024, 3, 12, 10, 30)):
+    """Linha da consulta de fotos (com ou sem encoding gravado na versão atual)"""
+    version = (app_module.ENCODING_MODEL, app_module.DETECTOR_VERSION) if stored else (None, None)
+    return (user_id, f'Aluno Teste {user_id}', foto_id, f'/static/fotos/aluno{user_id}.jpg', data_captura) + version
+
+def encoding_row(user_id, encoding_id, encoding, data_criacao=datetime(2024, 3, 12, 10, 30)):
+    """Linha da consulta de encodings de encodings_usuario"""
+    return (user_id, f'Aluno Teste {user_id}', encoding_id, data_criacao, app_module.encoding_to_blob(encoding))
+
+def mock_db(mock_get_db, *results):
+    """Configura o banco mockado com os resultados de cada fetchall, em ordem"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.side_effect = list(results)
+    mock_conn.cursor.return_value = mock_cursor
+    mock_get_db.return_value = mock_conn
+    return mock_conn, mock_cursor
+
+@patch('app.encode_photo_file')
+@patch('app.get_db_connection')
+def test_load_encodings_cache_uses_stored_encodings(mock_get_db, mock_encode_photo, client):
+    """Testa que o cache lê os encodings gravados no banco sem reprocessar as fotos"""
+    encoding = np.random.rand(128)
+    mock_conn, _ = mock_db(mock_get_db, [photo_row(1, 10)], [encoding_row(1, 100, encoding)])
+
+    gallery = app_module.refresh_encodings_cache()
+
+    assert gallery.search(encoding)[0][:2] == (1, 'Aluno Teste 1')
+    assert np.allclose(gallery.matrix[0], encoding, atol=1e-6)
+    mock_encode_photo.assert_not_called()
+    mock_conn.commit.assert_not_called()
+
+@patch('app.encode_photo_file')
+@patch('app.get_db_connection')
+def test_load_encodings_cache_backfills_missing_encodings(mock_get_db, mock_encode_photo, client):
+    """Testa que fotos sem encoding gravado são processadas uma vez e persistidas"""
+    encoding = np.random.rand(128)
+    mock_encode_photo.return_value = encoding
+    mock_conn, mock_cursor = mock_db(mock_get_db, [photo_row(2, 20, stored=False)], [encoding_row(2, 200, encoding)])
+
+    gallery = app_module.refresh_encodings_cache()
+
+    assert np.allclose(gallery.matrix[0], encoding, atol=1e-6)
+    mock_encode_photo.assert_called_once_with('/static/fotos/aluno2.jpg')
+    mock_conn.commit.assert_called_once()
+    assert 'INSERT INTO encodings_usuario' in mock_cursor.execute.call_args_list[1][0][0]
+
+@patch('app.get_db_connection')
+def test_load_encodings_cache_incremental_refresh(mock_get_db, client):
+    """Testa que a atualização busca apenas as fotos novas e remove usuários sem foto"""
+    rng = np.random.default_rng(0)
+    app_module.encodings_gallery = FaceGallery.from_cache({
+        1: {'nome': 'Aluno Teste 1', 'encoding': rng.random(128)},
+        2: {'nome': 'Aluno Teste 2', 'encoding': rng.random(128)}
+    })
+    app_module.cache_high_water = {'foto_id': 20, 'data_captura': datetime(2024, 3, 12, 10, 30),
+                                   'encoding_id': 200, 'data_criacao': datetime(2024, 3, 12, 10, 30)}
+
+    new_encoding = rng.random(128)
+    _, mock_cursor = mock_db(
+        mock_get_db,
+        [photo_row(3, 30, data_captura=datetime(2024, 3, 13, 8, 0))],
+        [(3,)],
+        [encoding_row(3, 300, new_encoding, datetime(2024, 3, 13, 8, 0))],
+        [(1,), (3,)]
+    )
+
+    gallery = app_module.refresh_encodings_cache()
+
+    query, params = mock_cursor.execute.call_args_list[0][0]
+    assert 'f.id > %s' in query
+    assert params == (20, datetime(2024, 3, 12, 10, 30))
+    query, params = mock_cursor.execute.call_args_list[2][0]
+    assert 'e.usuario_id IN (%s)' in query
+    assert params[-1] == 3
+    assert sorted(gallery.ids.tolist()) == [1, 3]
+    assert app_module.cache_high_water == {'foto_id': 30, 'data_captura': datetime(2024, 3, 13, 8, 0),
+                                           'encoding_id': 300, 'data_criacao': datetime(2024, 3, 13, 8, 0)}
+
+@patch('app.get_db_connection')
+def test_incremental_refresh_without_changes_keeps_gallery(mock_get_db, client):
+    """Testa que as linhas relidas na marca d'água (>=) não geram uma nova galeria"""
+    from face_gallery import summarize_encodings
+    encoding = np.random.default_rng(5).random(128)
+    mark = datetime(2024, 3, 12, 10, 30)
+    gallery = FaceGallery.from_cache({1: {'nome': 'Aluno Teste 1', 'encodings': summarize_encodings([encoding])}})
+    app_module.encodings_gallery = gallery
+    app_module.cache_high_water = {'foto_id': 10, 'data_captura': mark, 'encoding_id': 100, 'data_criacao': mark}
+    mock_db(
+        mock_get_db,
+        [photo_row(1, 10, data_captura=mark)],
+        [(1,)],
+        [encoding_row(1, 100, encoding, mark)],
+        [(1,)]
+    )
+
+    assert app_module.refresh_encodings_cache() is gallery
+
+@patch('app.get_db_connection')
+def test_load_encodings_cache_summarizes_multiple_encodings(mock_get_db, client):
+    """Testa que os vários encodings do usuário viram protótipo + exemplares na galeria"""
+    rng = np.random.default_rng(3)
+    foto, antiga, login = (rng.normal(0, 0.1, 128) for _ in range(3))
+    mock_db(mock_get_db, [photo_row(1, 10)], [
+        encoding_row(1, 102, login, datetime(2024, 3, 14, 7, 0)),
+        encoding_row(1, 101, foto, datetime(2024, 3, 13, 7, 0)),
+        encoding_row(1, 100, antiga, datetime(2024, 3, 12, 7, 0)),
+    ])
+
+    gallery = app_module.refresh_encodings_cache()
+
+    assert gallery.ids.tolist() == [1]
+    assert gallery.counts.tolist() == [4]  # protótipo + 3 exemplares
+    assert np.allclose(gallery.matrix[0], np.mean([foto, antiga, login], axis=0), atol=1e-6)
+    # A captura parecida com a foto antiga é reconhecida pelo exemplar correspondente
+    assert gallery.search(antiga + 0.001)[0][2] < 0.05
+
+@patch('app.get_db_connection')
+def test_update_cache_returns_users(mock_get_db, client):
+    """Testa a atualização forçada do cache pela rota /update_cache"""
+    mock_db(mock_get_db, [photo_row(1, 10)], [encoding_row(1, 100, np.random.rand(128))])
+
+    response = client.post('/update_cache')
+    assert response.status_code == 200
+
+    data = response.get_json()
+    assert data['success'] is True
+    assert data['users'] == [{'id': 1, 'nome': 'Aluno Teste 1'}]
+    assert app_module.cache_refresh_stats['last_duration'] is not None
+
+@patch('app.get_db_connection')
+def test_shared_gallery_published_and_adopted(mock_get_db, client, tmp_path, monkeypatch):
+    """Testa que a galeria é publicada uma vez e mapeada pelos outros workers"""
+    store = SharedGalleryStore(str(tmp_path))
+    monkeypatch.setattr(app_module, 'gallery_store', store)
+    mock_db(mock_get_db, [photo_row(1, 10)], [encoding_row(1, 100, np.random.rand(128))])
+
+    app_module.refresh_encodings_cache()
+    assert store.current_generation() == 1
+    assert not app_module.encodings_gallery.matrix.flags.writeable  # matriz mapeada do disco
+
+    # Outro worker: mapeia a geração publicada sem consultar o banco
+    mock_get_db.reset_mock()
+    app_module.encodings_gallery = FaceGallery.empty()
+    app_module.gallery_generation = 0
+    app_module.cache_high_water = dict(app_module.EMPTY_HIGH_WATER)
+    app_module.adopt_published_gallery()
+
+    mock_get_db.assert_not_called()
+    assert app_module.encodings_gallery.ids.tolist() == [1]
+    assert app_module.cache_high_water == {'foto_id': 10, 'data_captura': datetime(2024, 3, 12, 10, 30),
+                                           'encoding_id': 100, 'data_criacao': datetime(2024, 3, 12, 10, 30)}
+
+@patch('app.get_db_connection')
+def test_invalidation_reaches_other_workers(mock_get_db, client, tmp_path, monkeypatch):
+    """Testa que a invalidação feita por um worker fica pendente até o banco ser consultado"""
+    store = SharedGalleryStore(str(tmp_path))
+    monkeypatch.setattr(app_module, 'gallery_store', store)
+
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = []
+    mock_conn.cursor.return_value = mock_cursor
+    mock_get_db.return_value = mock_conn
+
+    app_module.invalidate_encodings_cache()
+    assert app_module._invalidation_pending()
+
+    app_module.refresh_encodings_cache()
+    mock_get_db.assert_called_once()
+    assert not app_module._invalidation_pending()
+
+@patch('app.mysql.connector.connect')
+@patch('app.pooling.MySQLConnectionPool')
+def test_get_db_connection_uses_pool(mock_pool_class, mock_connect, monkeypatch):
+    """Testa que as conexões saem do pool (criado uma vez por processo)"""
+    monkeypatch.setattr(app_module, '_db_pool', {'pool': None, 'pid': None})
+    pooled_conn = MagicMock()
+    mock_pool_class.return_value.get_connection.return_value = pooled_conn
+
+    assert app_module.get_db_connection() is pooled_conn
+    assert app_module.get_db_connection() is pooled_conn
+    mock_pool_class.assert_called_once()
+    mock_connect.assert_not_called()
+
+@patch('app.mysql.connector.connect')
+@patch('app.pooling.MySQLConnectionPool')
+def test_get_db_connection_pool_exhausted(mock_pool_class, mock_connect, monkeypatch):
+    """Testa a conexão avulsa quando o pool está esgotado"""
+    monkeypatch.setattr(app_module, '_db_pool', {'pool': None, 'pid': None})
+    mock_pool_class.return_value.get_connection.side_effect = app_module.mysql.connector.errors.PoolError()
+    direct_conn = MagicMock()
+    mock_connect.return_value = direct_conn
+
+    assert app_module.get_db_connection() is direct_conn
+
+def test_read_request_image_formats():
+    """Testa a leitura da imagem em multipart, corpo binário e JSON com Base64"""
+    jpeg = b'\xff\xd8\xff\xe0fake-jpeg'
+
+    with app.test_request_context('/process_image', method='POST',
+                                  data={'image': (io.BytesIO(jpeg), 'captura.jpg'), 'threshold': '0.4'},
+                                  content_type='multipart/form-data'):
+        image_bytes, params = app_module.read_request_image()
+        assert image_bytes == jpeg
+        assert params['threshold'] == '0.4'
+
+    with app.test_request_context('/process_image?threshold=0.4', method='POST',
+                                  data=jpeg, content_type='image/jpeg'):
+        image_bytes, params = app_module.read_request_image()
+        assert image_bytes == jpeg
+        assert params['threshold'] == '0.4'
+
+    data_url = 'data:image/jpeg;base64,' + base64.b64encode(jpeg).decode()
+    with app.test_request_context('/process_image', method='POST',
+                                  json={'image': data_url, 'threshold': 0.4}):
+        image_bytes, params = app_module.read_request_image()
+        assert image_bytes == jpeg
+        assert params['threshold'] == 0.4
+
+def test_process_image_without_image(client):
+    """Testa o login sem imagem no corpo da requisição"""
+    response = client.post('/process_image', data={'threshold': '0.5'}, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Nenhuma imagem fornecida'
+
+@patch('app.enhance_face_image_for_save')
+def test_verificar_qualidade_foto_multipart(mock_enhance, client):
+    """Testa a verificação de qualidade com upload binário (multipart)"""
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64)).save(buffer, 'JPEG')
+    mock_enhance.return_value = (None, True, 'ok')
+
+    response = client.post('/verificar_qualidade_foto',
+                           data={'image': (io.BytesIO(buffer.getvalue()), 'foto.jpg')},
+                           content_type='multipart/form-data')
+    assert response.get_json()['success'] is True
+
+def jpeg_upload():
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480)).save(buffer, 'JPEG')
+    return {'image': (io.BytesIO(buffer.getvalue()), 'captura.jpg'), 'threshold': '0.5'}
+
+@patch('app.login_audit')
+@patch('app.find_face_encodings')
+def test_process_image_recognizes_user(mock_find_encodings, mock_login_audit, client):
+    """Testa o login completo: detecção, comparação com a galeria e registro do login"""
+    rng = np.random.default_rng(0)
+    encodings = {user_id: rng.normal(0, 0.1, 128) for user_id in (1, 2, 3)}
+    app_module.encodings_gallery = FaceGallery.from_cache({
+        user_id: {'nome': f'Aluno Teste {user_id}', 'encoding': encoding}
+        for user_id, encoding in encodings.items()
+    })
+    app_module.last_cache_update = time.time()
+    mock_find_encodings.return_value = ([encodings[2] + 0.001], Detection([(0, 100, 100, 0)], 'hog_fast', 0.01, []))
+
+    response = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data')
+
+    data = response.get_json()
+    assert data['success'] is True
+    assert data['name'] == 'Aluno Teste 2'
+    assert data['detection_stage'] == 'hog_fast'
+    # Captura bem próxima: o login leva junto o encoding para os exemplares do usuário
+    mock_login_audit.record.assert_called_once()
+    assert mock_login_audit.record.call_args[0] == (2,)
+    assert mock_login_audit.record.call_args.kwargs['encoding'] is not None
+
+@patch('app.login_audit')
+@patch('app.find_face_encodings')
+def test_process_image_uses_largest_face(mock_find_encodings, mock_login_audit, client):
+    """Testa que, com várias pessoas no quadro, o login usa o maior rosto"""
+    rng = np.random.default_rng(0)
+    encodings = {user_id: rng.normal(0, 0.1, 128) for user_id in (1, 2)}
+    app_module.encodings_gallery = FaceGallery.from_cache({
+        user_id: {'nome': f'Aluno Teste {user_id}', 'encoding': encoding}
+        for user_id, encoding in encodings.items()
+    })
+    app_module.last_cache_update = time.time()
+    mock_find_encodings.return_value = (
+        [encodings[1], encodings[2]],
+        Detection([(0, 40, 40, 0), (100, 300, 300, 100)], 'hog', 0.01, [])
+    )
+
+    data = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data').get_json()
+
+    assert data['success'] is True
+    assert data['name'] == 'Aluno Teste 2'
+
+@patch('app.login_audit')
+@patch('app.find_face_encodings')
+def test_process_image_rejects_small_face(mock_find_encodings, mock_login_audit, client):
+    """Testa que um rosto menor que MIN_FACE_SIZE é recusado sem comparar com a galeria"""
+    app_module.encodings_gallery = FaceGallery.from_cache({1: {'nome': 'Aluno Teste 1', 'encoding': np.zeros(128)}})
+    app_module.last_cache_update = time.time()
+    mock_find_encodings.return_value = ([np.zeros(128)], Detection([(0, 20, 20, 0)], 'hog', 0.01, []))
+
+    data = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data').get_json()
+
+    assert data['success'] is False
+    assert 'pequeno' in data['message']
+    mock_login_audit.record.assert_not_called()
+
+@patch('app.login_audit')
+@patch('app.find_face_encodings')
+def test_process_image_debounces_repeated_login(mock_find_encodings, mock_login_audit, client, tmp_path, monkeypatch):
+    """Testa que o mesmo aluno reconhecido de novo dentro da janela não gera outro login"""
+    rng = np.random.default_rng(0)
+    encodings = {user_id: rng.normal(0, 0.1, 128) for user_id in (1, 2)}
+    app_module.encodings_gallery = FaceGallery.from_cache({
+        user_id: {'nome': f'Aluno Teste {user_id}', 'encoding': encoding}
+        for user_id, encoding in encodings.items()
+    })
+    app_module.last_cache_update = time.time()
+    mock_find_encodings.return_value = ([encodings[2] + 0.001], Detection([(0, 100, 100, 0)], 'hog_fast', 0.01, []))
+    monkeypatch.setattr(app_module, 'recent_logins', RecentRecognitions(60, str(tmp_path)))
+
+    first = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data').get_json()
+    second = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data').get_json()
+
+    assert first['success'] is True and 'repeated' not in first
+    assert second['success'] is True and second['repeated'] is True
+    assert second['message'] == first['message']
+    mock_login_audit.record.assert_called_once()
+
+    # Outro worker (outra instância, mesmo diretório) também vê o login recente
+    monkeypatch.setattr(app_module, 'recent_logins', RecentRecognitions(60, str(tmp_path)))
+    third = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data').get_json()
+    assert third['repeated'] is True
+    mock_login_audit.record.assert_called_once()
+
+@patch('app.login_audit')
+@patch('app.find_face_encodings')
+def test_process_image_releases_claim_when_audit_queue_full(mock_find_encodings, mock_login_audit, client):
+    """Testa que um login descartado pela fila cheia não conta como já registrado"""
+    encoding = np.random.default_rng(0).normal(0, 0.1, 128)
+    app_module.encodings_gallery = FaceGallery.from_cache({1: {'nome': 'Aluno Teste 1', 'encoding': encoding}})
+    app_module.last_cache_update = time.time()
+    mock_find_encodings.return_value = ([encoding + 0.001], Detection([(0, 100, 100, 0)], 'hog', 0.01, []))
+    mock_login_audit.record.side_effect = [False, True]
+
+    first = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data').get_json()
+    second = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data').get_json()
+
+    assert first['success'] is True and second['success'] is True
+    assert 'repeated' not in second
+    assert mock_login_audit.record.call_count == 2
+
+@patch('app.find_face_encodings')
+def test_process_image_cache_not_loaded(mock_find_encodings, client):
+    """Testa que o login responde 503 enquanto a galeria não foi carregada"""
+    mock_find_encodings.return_value = ([np.zeros(128)], Detection([(0, 100, 100, 0)], 'hog', 0.01, []))
+
+    response = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data')
+    assert response.status_code == 503
+
+@patch('app.find_face_encodings')
+def test_process_image_encoder_busy(mock_find_encodings, client):
+    """Testa que o login responde 503 quando o pool de encoding está saturado"""
+    mock_find_encodings.side_effect = EncoderBusy("Fila de processamento facial cheia")
+
+    response = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data')
+    assert response.status_code == 503
+    assert response.get_json()['success'] is False
+
+@patch('face_encoder.encode_photo_path_safe')
+@patch('app.get_db_connection')
+def test_load_encodings_cache_parallel_backfill(mock_get_db, mock_encode_safe, client, monkeypatch, tmp_path):
+    """Testa a carga inicial em lote: todas as fotos pendentes são processadas e gravadas"""
+    monkeypatch.setattr(app_module, 'BACKFILL_PARALLEL_MIN', 2)
+    monkeypatch.setattr(app_module, 'BACKFILL_COMMIT_EVERY', 2)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'static' / 'fotos').mkdir(parents=True)
+
+    rows = []
+    for user_id in (1, 2, 3):
+        (tmp_path / 'static' / 'fotos' / f'aluno{user_id}.jpg').write_bytes(b'jpeg')
+        rows.append(photo_row(user_id, user_id * 10, stored=False))
+    rows.append((4, 'Aluno Sem Arquivo', 40, '/static/fotos/faltando.jpg', datetime(2024, 3, 12, 10, 30), None, None))
+    encodings = {str(tmp_path / 'static' / 'fotos' / f'aluno{i}.jpg'): np.full(128, i / 10) for i in (1, 2, 3)}
+    mock_encode_safe.side_effect = lambda img_path: (encodings[img_path], None)
+
+    mock_conn, mock_cursor = mock_db(mock_get_db, rows, [
+        encoding_row(user_id, user_id * 100, np.full(128, user_id / 10)) for user_id in (1, 2, 3)
+    ])
+
+    gallery = app_module.refresh_encodings_cache()
+
+    assert sorted(gallery.ids.tolist()) == [1, 2, 3]
+    assert mock_encode_safe.call_count == 3
+    assert mock_conn.commit.call_count == 2  # um lote parcial + o restante
+    saved = [call for call in mock_cursor.execute.call_args_list if 'INSERT INTO encodings_usuario' in call[0][0]]
+    assert sorted(call[0][1][1] for call in saved) == [10, 20, 30]
+
+@patch('app.login_audit')
+@patch('app.find_face_encodings')
+def test_process_image_rejects_ambiguous_match(mock_find_encodings, mock_login_audit, client):
+    """Testa a rejeição quando o 2º usuário está a menos da margem do 1º"""
+    rng = np.random.default_rng(1)
+    base = rng.normal(0, 0.1, 128)
+    app_module.encodings_gallery = FaceGallery.from_cache({
+        1: {'nome': 'Aluno Teste 1', 'encoding': base},
+        2: {'nome': 'Aluno Teste 2', 'encoding': base + 0.002},
+        3: {'nome': 'Aluno Teste 3', 'encoding': rng.normal(0, 0.1, 128)}
+    })
+    app_module.last_cache_update = time.time()
+    mock_find_encodings.return_value = ([base], Detection([(0, 100, 100, 0)], 'hog', 0.01, []))
+
+    upload = jpeg_upload()
+    upload['margin'] = '0.05'
+    response = client.post('/process_image', data=upload, content_type='multipart/form-data')
+
+    data = response.get_json()
+    assert data['success'] is False
+    assert data['debug']['ambiguous'] is True
+    assert [c['name'] for c in data['debug']['candidates']] == ['Aluno Teste 1', 'Aluno Teste 2', 'Aluno Teste 3']
+    mock_login_audit.record.assert_not_called()
+
+    # Sem margem (padrão) o mesmo quadro é aceito
+    response = client.post('/process_image', data=jpeg_upload(), content_type='multipart/form-data')
+    assert response.get_json()['success'] is True
+
+@patch('app.login_audit')
+@patch('app.find_batch_face_encodings')
+def test_process_image_batch_recognizes_all_faces(mock_find_encodings, mock_login_audit, client):
+    """Testa o login em lote: cada rosto do quadro é comparado com a galeria de uma vez"""
+    rng = np.random.default_rng(2)
+    cache = {user_id: {'nome': f'Aluno Teste {user_id}', 'encoding': rng.normal(0, 0.1, 128)} for user_id in (1, 2, 3)}
+    app_module.encodings_gallery = FaceGallery.from_cache(cache)
+    app_module.last_cache_update = time.time()
+    mock_find_encodings.return_value = (
+        [cache[1]['encoding'], cache[3]['encoding'] + 0.001, np.ones(128), cache[1]['encoding'] + 0.002],
+        Detection([(0, 10, 10, 0), (0, 30, 10, 20), (0, 50, 10, 40), (0, 70, 10, 60)], 'hog', 0.01, [])
+    )
+
+    response = client.post('/process_image_batch', data=jpeg_upload(), content_type='multipart/form-data')
+
+    data = response.get_json()
+    assert response.status_code == 200
+    assert data['success'] is True
+    assert data['recognized'] == ['Aluno Teste 1', 'Aluno Teste 3']
+    faces = data['faces']
+    assert [face['success'] for face in faces] == [True, True, False, False]
+    assert faces[1]['location'] == {'top': 0, 'right': 30, 'bottom': 10, 'left': 20}
+    assert faces[3]['duplicate_of'] == 1  # o mesmo aluno em outro rosto, mais distante
+    mock_login_audit.record_many.assert_called_once_with([1, 3])
+
+@patch('app.login_audit')
+@patch('app.find_batch_face_encodings')
+def test_process_image_batch_releases_users_not_queued(mock_find_encodings, mock_login_audit, client):
+    """Testa que, no login em lote, quem não coube na fila de auditoria é registrado no próximo quadro"""
+    rng = np.random.default_rng(2)
+    cache = {user_id: {'nome': f'Aluno Teste {user_id}', 'encoding': rng.normal(0, 0.1, 128)} for user_id in (1, 2)}
+    app_module.encodings_gallery = FaceGallery.from_cache(cache)
+    app_module.last_cache_update = time.time()
+    mock_find_encodings.return_value = (
+        [cache[1]['encoding'], cache[2]['encoding']],
+        Detection([(0, 10, 10, 0), (0, 30, 10, 20)], 'hog', 0.01, [])
+    )
+    mock_login_audit.record_many.side_effect = [[2], []]
+
+    client.post('/process_image_batch', data=jpeg_upload(), content_type='multipart/form-data')
+    second = client.post('/process_image_batch', data=jpeg_upload(), content_type='multipart/form-data').get_json()
+
+    assert mock_login_audit.record_many.call_args_list[1].args[0] == [2]
+    assert [face.get('repeated', False) for face in second['faces']] == [True, False]
+
+@patch('app.invalidate_encodings_cache')
+@patch('face_encoder.prepare_enrollment_photo_safe')
+@patch('bulk_enrollment.download_photo')
+@patch('app.get_db_connection')
+def test_cadastro_lote_reports_status_per_student(mock_get_db, mock_download, mock_prepare, mock_invalidate,
+                                                  client, tmp_path, monkeypatch):
+    """Testa o cadastro em lote: downloads, processamento e gravação com status por aluno"""
+    from bulk_enrollment import PhotoDownloadError
+
+    monkeypatch.setattr(app_module, 'UPLOAD_FOLDER', str(tmp_path))
+    # Consulta de quem já tem foto (o aluno 2)
+    mock_conn, mock_cursor = mock_db(mock_get_db, [(2, 20, 200)])
+    mock_cursor.lastrowid = 10
+    mock_cursor.rowcount = 1
+
+    def download(session, url, timeout):
+        if url.endswith('3.jpg'):
+            raise PhotoDownloadError('HTTP 404')
+        return url.encode()
+    mock_download.side_effect = download
+    mock_prepare.side_effect = lambda data: (None, None, None) if data.endswith(b'4.jpg') else (b'jpeg', np.ones(128), None)
+
+    response = client.post('/api/cadastro_lote', json={'alunos': [
+        {'id': 1, 'nome': 'Aluno Um', 'foto': 'http://php/1.jpg'},
+        {'id_usuario_php': 2, 'nome': 'Aluno Dois', 'foto_url': 'http://php/2.jpg'},
+        {'id': 3, 'nome': 'Aluno Tres', 'foto': 'http://php/3.jpg'},
+        {'id': 4, 'nome': 'Aluno Quatro', 'foto': 'http://php/4.jpg'},
+        {'nome': 'Sem Id'}
+    ]})
+
+    data = response.get_json()
+    assert response.status_code == 200
+    assert [result['status'] for result in data['results']] == [
+        'cadastrado', 'ja_cadastrado', 'erro_download', 'sem_rosto', 'invalido'
+    ]
+    assert data['results'][0]['id_usuario_php'] == 1
+    assert data['summary']['cadastrado'] == 1
+    assert mock_download.call_count == 3
+    assert len(list(tmp_path.iterdir())) == 1
+    mock_conn.commit.assert_called_once()
+    inserts = [call for call in mock_cursor.execute.call_args_list if 'INSERT INTO encodings_usuario' in call[0][0]]
+    assert len(inserts) == 1
+    mock_invalidate.assert_called_once()
+
+@patch('app.get_db_connection')
+def test_save_enrollment_batch_keeps_photo_inside_upload_folder(mock_get_db, tmp_path, monkeypatch):
+    """Testa que um nome com '../' no JSON do lote não grava a foto fora da pasta de fotos"""
+    upload_folder = tmp_path / 'fotos'
+    upload_folder.mkdir()
+    monkeypatch.setattr(app_module, 'UPLOAD_FOLDER', str(upload_folder))
+    _, mock_cursor = mock_db(mock_get_db)
+    mock_cursor.lastrowid = 10
+    mock_cursor.rowcount = 1
+    aluno = {'id_usuario_php': 9, 'nome': '../../Aluno Nove', 'cpf': '', 'foto_url': 'http://php/9.jpg'}
+
+    app_module._save_enrollment_batch([(aluno, b'jpeg', np.ones(128))])
+
+    assert [path.name for path in tmp_path.iterdir()] == ['fotos']
+    saved = list(upload_folder.iterdir())
+    assert len(saved) == 1 and saved[0].name.startswith('Aluno_Nove_9_')
+
+def test_bulk_student_accepts_alunos_php_rows():
+    """Testa que as linhas de /api/alunos_php (nome_aluno, cpf_aluno) com foto_url são aceitas"""
+    aluno = app_module._bulk_student({'id': '7', 'nome_aluno': 'Aluno Sete', 'cpf_aluno': '123',
+                                      'foto_url': 'http://php/7.jpg'})
+
+    assert aluno == {'id_usuario_php': 7, 'nome': 'Aluno Sete', 'cpf': '123', 'foto_url': 'http://php/7.jpg'}
+    assert app_module._bulk_student({'id': 7, 'nome_aluno': 'Aluno Sete'}) is None  # sem foto
+
+def test_cadastro_lote_requires_list(client):
+    """Testa que o cadastro em lote exige a lista de alunos"""
+    response = client.post('/api/cadastro_lote', json={'alunos': []})
+    assert response.status_code == 400
+
+@patch('app.enroll_students_bulk')
+def test_cadastro_lote_rejects_large_list(mock_enroll, client, monkeypatch):
+    """Testa que listas acima do limite são recusadas (413) e indicam o comando de linha"""
+    monkeypatch.setattr(app_module, 'BULK_ENROLL_MAX_API', 2)
+    alunos = [{'id_usuario_php': i, 'nome': f'Aluno {i}', 'foto_url': f'http://php/{i}.jpg'} for i in range(3)]
+
+    response = client.post('/api/cadastro_lote', json={'alunos': alunos})
+
+    assert response.status_code == 413
+    assert 'cadastro-lote' in response.get_json()['message']
+    mock_enroll.assert_not_called()
+
+@patch('app.get_db_connection')
+def test_exportar_login_streams_filtered_csv(mock_get_db, client, monkeypatch):
+    """Testa a exportação em blocos, com filtro de período e de usuário"""
+    from datetime import date, time as dt_time
+    monkeypatch.setattr(app_module, 'EXPORT_CHUNK_SIZE', 2)
+    mock_conn, mock_cursor = mock_db(mock_get_db)
+    mock_cursor.fetchmany.side_effect = [
+        [('Aluno 1', date(2024, 3, 12), dt_time(7, 30)), ('Aluno 1', date(2024, 3, 11), dt_time(7, 31))],
+        [('Aluno 1', date(2024, 3, 10), dt_time(7, 32))],
+        []
+    ]
+
+    response = client.get('/exportar_login?data_inicio=2024-03-01&data_fim=2024-03-31&usuario_id=1')
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0] == 'Nome;Data;Hora'
+    assert lines[1:] == ['Aluno 1;2024-03-12;07:30:00', 'Aluno 1;2024-03-11;07:31:00', 'Aluno 1;2024-03-10;07:32:00']
+    assert '2024-03-01_a_2024-03-31' in response.headers['Content-Disposition']
+    mock_conn.cursor.assert_called_once_with(buffered=False)
+    query, params = mock_cursor.execute.call_args[0]
+    assert 'l.data_login BETWEEN %s AND %s' in query and 'l.usuario_id = %s' in query
+    assert params == (date(2024, 3, 1), date(2024, 3, 31), 1)
+    mock_cursor.fetchall.assert_not_called()
+    mock_conn.close.assert_called_once()
+
+@patch('app.get_db_connection')
+def test_exportar_login_releases_connection_when_not_streamed(mock_get_db, client):
+    """Testa que HEAD ou um download abortado antes do primeiro bloco devolvem a conexão ao pool"""
+    mock_conn, mock_cursor = mock_db(mock_get_db)
+    mock_cursor.fetchmany.side_effect = [[('Aluno 1', '2024-03-12', '07:30:00')], []]
+
+    response = client.head('/exportar_login')
+    response.close()
+
+    assert response.status_code == 200
+    mock_cursor.fetchmany.assert_called()  # resultado pendente lido antes de fechar
+    mock_cursor.close.assert_called_once()
+    mock_conn.close.assert_called_once()
+
+    # Cliente que desconecta antes do primeiro bloco
+    mock_conn, mock_cursor = mock_db(mock_get_db)
+    mock_cursor.fetchmany.side_effect = [[('Aluno 1', '2024-03-12', '07:30:00')], []]
+    response = client.get('/exportar_login', buffered=False)
+    response.close()
+
+    mock_conn.close.assert_called_once()
+
+@patch('app.get_db_connection')
+def test_exportar_login_rejects_invalid_dates(mock_get_db, client):
+    """Testa que datas inválidas não chegam ao banco"""
+    response = client.get('/exportar_login?data_inicio=12/03/2024')
+    assert response.status_code == 302
+    mock_get_db.assert_not_called()
+
+@patch('app.invalidate_encodings_cache')
+@patch('app.extract_gallery_encoding')
+@patch('app.enhance_face_image_for_save')
+@patch('app.get_db_connection')
+def test_salvar_foto_upserts_user_and_photo(mock_get_db, mock_enhance, mock_extract, mock_invalidate,
+                                            client, tmp_path, monkeypatch):
+    """Testa que a troca de foto grava usuário e foto com ON DUPLICATE KEY UPDATE, sem SELECTs"""
+    monkeypatch.setattr(app_module, 'UPLOAD_FOLDER', str(tmp_path))
+    mock_conn, mock_cursor = mock_db(mock_get_db)
+    mock_cursor.lastrowid = 7
+    mock_cursor.rowcount = 2  # foto existente atualizada
+    mock_enhance.return_value = (Image.new('RGB', (300, 300)), True, 'ok')
+    mock_extract.return_value = np.ones(128)
+
+    upload = jpeg_upload()
+    upload.update({'usuario_id_php': '42', 'nome': 'Aluno Teste'})
+    response = client.post('/salvar_foto', data=upload, content_type='multipart/form-data')
+
+    assert response.get_json()['success'] is True
+    queries = [call[0][0] for call in mock_cursor.execute.call_args_list]
+    assert not any(query.strip().startswith('SELECT') for query in queries)
+    assert 'ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)' in queries[0]
+    assert 'INSERT INTO fotos_usuario' in queries[1]
+    assert "origem = 'historico'" in queries[2]  # encoding da foto anterior arquivado
+    mock_conn.commit.assert_called_once()
+
+@patch('app.get_db_connection')
+def test_presenca_dia_reads_daily_aggregate(mock_get_db, client):
+    """Testa que a presença do dia vem da tabela agregada, com horários formatados"""
+    from datetime import date, timedelta
+    mock_conn, mock_cursor = mock_db(
+        mock_get_db,
+        [(1, 'Aluno Teste 1', 101, timedelta(hours=7, minutes=5), timedelta(hours=12, seconds=3), 2)],
+        [(40,)]
+    )
+
+    response = client.get('/api/presenca/dia?data=2024-03-12')
+
+    data = response.get_json()
+    assert data['presentes'] == 1 and data['total_usuarios'] == 40
+    assert data['alunos'][0]['primeiro_login'] == '07:05:00'
+    assert data['alunos'][0]['ultimo_login'] == '12:00:03'
+    query, params = mock_cursor.execute.call_args_list[0][0]
+    assert 'FROM presenca_diaria' in query and 'FROM login' not in query
+    assert params == (date(2024, 3, 12),)
+
+@patch('app.get_db_connection')
+def test_presenca_periodo_filters_group(mock_get_db, client):
+    """Testa o resumo do período para um grupo de alunos (ex.: uma turma)"""
+    from datetime import date
+    mock_conn, mock_cursor = mock_db(
+        mock_get_db,
+        [(date(2024, 3, 11), 2, 3), (date(2024, 3, 12), 1, 1)],
+        [(1, 'Aluno Teste 1', 101, 2, 3, date(2024, 3, 12)), (2, 'Aluno Teste 2', 102, 1, 1, date(2024, 3, 11))]
+    )
+
+    response = client.get('/api/presenca/periodo?data_inicio=2024-03-11&data_fim=2024-03-12&id_usuario_php=102,101')
+
+    data = response.get_json()
+    assert [dia['presentes'] for dia in data['dias']] == [2, 1]
+    assert data['alunos'][0]['dias_presentes'] == 2
+    query, params = mock_cursor.execute.call_args_list[0][0]
+    assert 'u.id_usuario_php IN (%s, %s)' in query
+    assert params == (date(2024, 3, 11), date(2024, 3, 12), 101, 102)
+
+def test_presenca_periodo_rejects_long_range(client):
+    """Testa o limite do período consultado"""
+    response = client.get('/api/presenca/periodo?data_inicio=2020-01-01&data_fim=2024-01-01')
+    assert response.status_code == 400
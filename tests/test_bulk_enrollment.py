@@ -0,0 +1,51 @@
+import pytest
+from unittest.mock import MagicMock
+from bulk_enrollment import PhotoDownloadError, download_photo, iter_downloaded_batches, make_session
+
+
+def fake_session(responses):
+    """Sessão falsa: `responses` mapeia a URL para (status, conteúdo)"""
+    session = MagicMock()
+
+    def get(url, timeout, stream):
+        status, content = responses[url]
+        response = MagicMock()
+        response.status_code = status
+        response.iter_content.return_value = [content[i:i + 4] for i in range(0, len(content), 4)]
+        response.__enter__.return_value = response
+        return response
+    session.get.side_effect = get
+    return session
+
+def test_make_session_pools_connections():
+    """Testa que a sessão reaproveita conexões e tenta de novo em erros do servidor"""
+    session = make_session(pool_size=4, retries=3)
+    adapter = session.get_adapter('https://php/foto.jpg')
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 3
+    assert session.verify is False
+
+def test_download_photo_errors():
+    """Testa as falhas de download: status diferente de 200, foto grande demais e resposta vazia"""
+    session = fake_session({'a': (404, b''), 'b': (200, b'x' * 100), 'c': (200, b'')})
+
+    with pytest.raises(PhotoDownloadError, match='404'):
+        download_photo(session, 'a')
+    with pytest.raises(PhotoDownloadError, match='maior'):
+        download_photo(session, 'b', max_bytes=10)
+    with pytest.raises(PhotoDownloadError, match='vazia'):
+        download_photo(session, 'c')
+
+def test_iter_downloaded_batches_keeps_order():
+    """Testa que os lotes saem na ordem dos alunos, com o erro de cada download"""
+    responses = {f'http://php/{i}.jpg': (200, f'foto {i}'.encode()) for i in range(5)}
+    responses['http://php/2.jpg'] = (500, b'')
+    alunos = [{'foto_url': f'http://php/{i}.jpg'} for i in range(5)]
+
+    batches = list(iter_downloaded_batches(alunos, batch_size=2, workers=3, session=fake_session(responses)))
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    flat = [item for batch in batches for item in batch]
+    assert [aluno for aluno, _, _ in flat] == alunos
+    assert flat[0][1] == b'foto 0'
+    assert flat[2][1] is None and 'HTTP 500' in flat[2][2]
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+import pytest
+from unittest.mock import patch
+import face_encoder
+from face_encoder import FaceEncoderPool, EncoderBusy, EncoderTimeout
+
+CONFIG = {
+    'detection_budget': 5.0,
+    'batch_budget': 5.0,
+    'enrollment_budget': 10.0,
+    'enable_cnn': False,
+    'cnn_budget': 3.0,
+    'encoding_model': 'small'
+}
+
+@patch('face_recognition.face_locations')
+@patch('face_recognition.face_encodings')
+def test_inline_pool_runs_login_job(mock_face_encodings, mock_face_locations):
+    """Testa que, sem processos, a tarefa roda na própria thread com a cascata configurada"""
+    mock_face_locations.return_value = [(10, 60, 60, 10)]
+    mock_face_encodings.return_value = [np.zeros(128)]
+    pool = FaceEncoderPool(CONFIG, processes=0)
+
+    encodings, detection = pool.run(face_encoder.encode_login_frame, np.zeros((480, 640, 3), dtype=np.uint8))
+
+    assert len(encodings) == 1
+    assert detection.stage == 'hog_fast'
+    assert mock_face_encodings.call_args.kwargs['model'] == 'small'
+
+def test_process_pool_runs_in_other_process():
+    """Testa o pool de processos real: resultado, tempo máximo e fila cheia"""
+    pool = FaceEncoderPool(CONFIG, processes=1, max_pending=1, timeout=30.0)
+    try:
+        assert pool.run(face_encoder._ping) != os.getpid()
+
+        with pytest.raises(EncoderTimeout):
+            pool.run(time.sleep, 2, timeout=0.1)
+
+        # A tarefa que estourou o tempo ainda ocupa a única vaga da fila
+        with pytest.raises(EncoderBusy):
+            pool.run(face_encoder._ping)
+    finally:
+        pool.shutdown()
+
+def test_busy_pool_rejects_without_waiting():
+    """Testa que a fila cheia falha na hora, sem bloquear a thread da requisição"""
+    pool = FaceEncoderPool(CONFIG, processes=1, max_pending=1, timeout=30.0)
+    try:
+        pool.run(face_encoder._ping)  # processo já iniciado
+        worker = threading.Thread(target=pool.run, args=(time.sleep, 1))
+        worker.start()
+        time.sleep(0.2)
+
+        start = time.time()
+        with pytest.raises(EncoderBusy):
+            pool.run(face_encoder._ping)
+        assert time.time() - start < 0.5
+        worker.join()
+    finally:
+        pool.shutdown()
+
+def test_map_bulk_keeps_order():
+    """Testa a carga em lote no pool temporário: resultados na ordem dos itens"""
+    pool = FaceEncoderPool(CONFIG, processes=1)
+    assert list(pool.map_bulk(abs, range(-10, 0), processes=2, chunksize=3)) == list(range(10, 0, -1))
+
+def test_app_process_does_not_load_dlib():
+    """Testa que o processo do Flask importa o app sem carregar o face_recognition/dlib"""
+    code = "import sys, app; print('face_recognition' in sys.modules or 'dlib' in sys.modules)"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == 'False'
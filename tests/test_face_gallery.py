@@ -0,0 +1,223 @@
+import numpy as np
+import face_recognition
+from unittest.mock import patch
+from face_gallery import FaceGallery, SharedGalleryStore, ExactIndex, IVFIndex, configure_index, summarize_encodings
+
+
+def make_cache(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        user_id: {'nome': f'Aluno {user_id}', 'encoding': rng.normal(0, 0.1, 128)}
+        for user_id in range(1, n + 1)
+    }
+
+def test_distances_match_face_recognition():
+    """Testa que a distância vetorizada é a mesma do face_recognition"""
+    cache = make_cache(50)
+    gallery = FaceGallery.from_cache(cache)
+    probe = np.random.default_rng(1).normal(0, 0.1, 128)
+
+    expected = face_recognition.face_distance([user['encoding'] for user in cache.values()], probe)
+    assert np.allclose(gallery.distances(probe), expected, atol=1e-5)
+
+def test_search_returns_top_k_sorted():
+    """Testa que a busca retorna os k usuários mais próximos em ordem"""
+    cache = make_cache(200)
+    gallery = FaceGallery.from_cache(cache)
+    probe = cache[42]['encoding'] + 0.001
+
+    results = gallery.search(probe, k=5)
+    assert len(results) == 5
+    assert results[0][0] == 42
+    assert results[0][1] == 'Aluno 42'
+    distances = [distance for _, _, distance in results]
+    assert distances == sorted(distances)
+
+def test_search_batch_matches_search():
+    """Testa que a busca em lote (vários rostos) dá o mesmo resultado da busca por rosto"""
+    cache = make_cache(300)
+    gallery = FaceGallery.from_cache(cache)
+    probes = np.stack([cache[7]['encoding'] + 0.001, cache[150]['encoding'], np.zeros(128)])
+
+    results = gallery.search_batch(probes, k=3)
+    assert len(results) == 3
+    for probe, batch_result in zip(probes, results):
+        expected = gallery.search(probe, k=3)
+        assert [user_id for user_id, _, _ in batch_result] == [user_id for user_id, _, _ in expected]
+        assert np.allclose([d for _, _, d in batch_result], [d for _, _, d in expected], atol=1e-5)
+
+def test_search_empty_gallery():
+    """Testa a busca em uma galeria vazia"""
+    assert FaceGallery.from_cache({}).search(np.zeros(128)) == []
+
+def test_updated_replaces_and_removes_users():
+    """Testa a atualização incremental da galeria"""
+    cache = make_cache(10)
+    gallery = FaceGallery.from_cache(cache)
+    changed = {3: {'nome': 'Aluno 3 (nova foto)', 'encoding': np.ones(128)},
+               11: {'nome': 'Aluno 11', 'encoding': np.zeros(128)}}
+
+    updated = gallery.updated(changed, removed_ids={5})
+
+    assert sorted(updated.ids.tolist()) == [1, 2, 3, 4, 6, 7, 8, 9, 10, 11]
+    assert updated.search(np.ones(128))[0][:2] == (3, 'Aluno 3 (nova foto)')
+    assert len(gallery) == 10
+
+def test_summarize_encodings_is_bounded():
+    """Testa o resumo do usuário: protótipo (média) + exemplares limitados"""
+    encodings = np.random.default_rng(4).normal(0, 0.1, (20, 128))
+
+    summary = summarize_encodings(encodings, max_exemplars=4)
+
+    assert summary.shape == (5, 128)
+    assert np.allclose(summary[0], encodings.mean(axis=0), atol=1e-6)
+    assert np.allclose(summary[1], encodings[0], atol=1e-6)  # o mais recente sempre fica
+    assert summarize_encodings(encodings[:1]).shape == (1, 128)
+
+def test_multiple_encodings_per_user_use_min_distance():
+    """Testa que a distância do usuário é a menor entre protótipo e exemplares"""
+    rng = np.random.default_rng(5)
+    claro, escuro = rng.normal(0, 0.1, 128), rng.normal(0, 0.1, 128)
+    cache = make_cache(30)
+    cache[7] = {'nome': 'Aluno 7', 'encodings': summarize_encodings([claro, escuro])}
+    gallery = FaceGallery.from_cache(cache)
+
+    assert len(gallery) == 30
+    for probe in (claro, escuro):
+        user_id, _, distance = gallery.search(probe + 0.001, k=3)[0]
+        assert user_id == 7 and distance < 0.05
+    assert gallery.distances(escuro)[list(cache).index(7)] < 1e-3
+
+    # Incremental e IVF preservam os blocos de cada usuário
+    updated = gallery.updated({8: {'nome': 'Aluno 8', 'encoding': np.ones(128)}}, removed_ids={1})
+    assert updated.search(claro)[0][0] == 7
+    try:
+        configure_index('ivf', min_size=10, n_probe=8)
+        assert FaceGallery.from_cache(cache).search(escuro, k=2)[0][0] == 7
+    finally:
+        configure_index('exact')
+
+def test_ivf_index_recall_against_exact():
+    """Testa que o índice IVF encontra os mesmos vizinhos que a busca exata"""
+    rng = np.random.default_rng(2)
+    centers = rng.normal(0, 1, (50, 128))
+    matrix = (centers[rng.integers(0, 50, 5000)] + rng.normal(0, 0.6, (5000, 128))).astype(np.float32)
+    sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+    exact = ExactIndex(matrix, sq_norms)
+    ivf = IVFIndex(matrix, sq_norms, n_probe=8)
+
+    hits = 0
+    for target in rng.choice(5000, 100, replace=False):
+        probe = matrix[target] + rng.normal(0, 0.03, 128).astype(np.float32)
+        expected, _ = exact.search(probe, k=5)
+        found, distances = ivf.search(probe, k=5)
+        assert list(distances) == sorted(distances)
+        hits += len(np.intersect1d(found, expected))
+
+    assert hits / 500 >= 0.95
+
+def test_ivf_index_skips_empty_lists():
+    """Testa que listas vazias próximas do rosto não deixam a busca sem candidatos"""
+    rng = np.random.default_rng(3)
+    matrix = rng.normal(0, 0.1, (200, 128)).astype(np.float32)
+    sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+    ivf = IVFIndex(matrix, sq_norms, n_lists=4, n_probe=1)
+
+    # Centróide sem nenhum encoding, exatamente sobre o rosto procurado
+    probe = np.full(128, 5.0, dtype=np.float32)
+    ivf.centroids = np.vstack([ivf.centroids, probe])
+    ivf.centroid_sq_norms = np.einsum('ij,ij->i', ivf.centroids, ivf.centroids)
+    ivf.offsets = np.append(ivf.offsets, ivf.offsets[-1])
+    ivf.n_lists += 1
+
+    found, distances = ivf.search(probe, k=2)
+
+    assert len(found) == 2
+    assert list(distances) == sorted(distances)
+
+def test_ivf_gallery_update_reuses_centroids(tmp_path):
+    """Testa que um cadastro novo não refaz o k-means, nem no worker que mapeia a galeria publicada"""
+    cache = make_cache(400)
+    try:
+        configure_index('ivf', min_size=100, n_probe=4, retrain_drift=0.2)
+        gallery = FaceGallery.from_cache(cache).prepare()
+        centroids = gallery.index.centroids
+
+        with patch.object(IVFIndex, '_train', side_effect=AssertionError('k-means refeito')):
+            novo = {401: {'nome': 'Aluno 401', 'encoding': np.full(128, 0.5)}}
+            updated = gallery.updated(novo, removed_ids={1}).prepare()
+            assert updated.index.centroids is centroids
+            assert updated.search(np.full(128, 0.5))[0][0] == 401
+            assert 1 not in updated.ids
+
+            store = SharedGalleryStore(str(tmp_path))
+            loaded, _ = store.load(store.publish(updated))
+            assert np.array_equal(loaded.prepare().index.assignment, updated.index.assignment)
+            assert loaded.search(np.full(128, 0.5))[0][0] == 401
+
+        # Mudanças acima de retrain_drift do tamanho treinado: k-means refeito
+        many = make_cache(100, seed=5)
+        many = {user_id + 1000: user for user_id, user in many.items()}
+        assert updated.updated(many).prepare().index.centroids is not centroids
+    finally:
+        configure_index('exact')
+
+def test_gallery_uses_configured_index():
+    """Testa a troca do índice da galeria (com busca exata abaixo do tamanho mínimo)"""
+    cache = make_cache(300)
+    try:
+        configure_index('ivf', min_size=100, n_probe=4)
+        gallery = FaceGallery.from_cache(cache).prepare()
+        assert isinstance(gallery.index, IVFIndex)
+        assert gallery.search(cache[7]['encoding'])[0][0] == 7
+
+        configure_index('ivf', min_size=1000)
+        assert isinstance(FaceGallery.from_cache(cache).index, ExactIndex)
+    finally:
+        configure_index('exact')
+
+def test_shared_store_publish_and_load(tmp_path):
+    """Testa a publicação de gerações e o mapeamento somente leitura"""
+    store = SharedGalleryStore(str(tmp_path))
+    assert store.current_generation() == 0
+
+    gallery = FaceGallery.from_cache(make_cache(20))
+    for _ in range(5):
+        generation = store.publish(gallery, {'foto_id': 20})
+
+    loaded, metadata = store.load(generation)
+    assert generation == 5
+    assert metadata == {'foto_id': 20}
+    assert loaded.ids.tolist() == gallery.ids.tolist()
+    assert not loaded.matrix.flags.writeable
+    assert np.array_equal(loaded.matrix, gallery.matrix)
+    # Somente as últimas gerações permanecem em disco
+    assert sorted(f for f in tmp_path.iterdir() if f.suffix == '.npy') == [
+        tmp_path / f'gallery-{g:08d}.npy' for g in (3, 4, 5)
+    ]
+    # Usuários com vários encodings mantêm seus blocos de linhas
+    multi = FaceGallery.from_cache({1: {'nome': 'Aluno 1', 'encodings': np.ones((3, 128))}})
+    assert store.load(store.publish(multi))[0].counts.tolist() == [3]
+
+def test_shared_store_builder_lock_is_exclusive(tmp_path):
+    """Testa que só um construtor obtém o lock por vez"""
+    store = SharedGalleryStore(str(tmp_path))
+    other_worker = SharedGalleryStore(str(tmp_path))
+
+    with store.builder_lock() as is_builder:
+        assert is_builder
+        with other_worker.builder_lock() as other_is_builder:
+            assert not other_is_builder
+
+def test_shared_store_invalidation(tmp_path):
+    """Testa o carimbo de invalidação compartilhado entre workers"""
+    store = SharedGalleryStore(str(tmp_path))
+    assert not store.invalidation_pending()
+
+    store.invalidate()
+    stamp = store.invalidation_stamp()
+    assert SharedGalleryStore(str(tmp_path)).invalidation_pending()
+
+    store.mark_checked(stamp)
+    assert not store.invalidation_pending()
+    assert store.last_checked() > 0
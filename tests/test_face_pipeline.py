@@ -0,0 +1,103 @@
+import io
+import cv2
+import numpy as np
+from unittest.mock import patch
+from PIL import Image, ImageEnhance
+from face_pipeline import (decode_image, enhance_for_matching, build_detection_cascade,
+                           DetectionCascade, DetectionStage)
+
+
+def make_jpeg(width, height):
+    rng = np.random.default_rng(0)
+    buffer = io.BytesIO()
+    Image.fromarray((rng.random((height, width, 3)) * 255).astype(np.uint8)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def test_decode_image_downscales_to_max_width():
+    """Testa que a imagem decodificada respeita a largura máxima e a proporção"""
+    rgb_image = decode_image(make_jpeg(1920, 1080), max_width=640)
+    assert rgb_image.shape == (360, 640, 3)
+    assert rgb_image.dtype == np.uint8
+
+def test_decode_image_keeps_small_images():
+    """Testa que imagens menores que o limite não são ampliadas"""
+    assert decode_image(make_jpeg(320, 240), max_width=640).shape == (240, 320, 3)
+
+def test_enhance_for_matching_matches_pil():
+    """Testa que o realce em NumPy reproduz o ImageEnhance do PIL"""
+    rng = np.random.default_rng(1)
+    rgb_image = cv2.GaussianBlur((rng.random((48, 64, 3)) * 255).astype(np.uint8), (5, 5), 0)
+
+    pil_image = ImageEnhance.Contrast(Image.fromarray(rgb_image)).enhance(1.4)
+    expected = np.array(ImageEnhance.Sharpness(pil_image).enhance(1.3)).astype(int)
+    result = enhance_for_matching(rgb_image).astype(int)
+
+    # O PIL não filtra a borda de 1 pixel; o miolo deve coincidir (arredondamento)
+    assert np.abs(expected - result)[1:-1, 1:-1].max() <= 2
+
+@patch('face_recognition.face_locations')
+def test_cascade_stops_at_first_stage_with_faces(mock_face_locations):
+    """Testa que a cascata avança de estágio e reporta qual encontrou o rosto"""
+    mock_face_locations.side_effect = [[], [(10, 60, 60, 10)]]
+    cascade = build_detection_cascade(total_budget=5.0)
+
+    detection = cascade.detect(np.zeros((480, 640, 3), dtype=np.uint8))
+
+    assert detection.stage == 'hog'
+    assert detection.locations == [(10, 60, 60, 10)]
+    assert mock_face_locations.call_count == 2
+
+@patch('face_recognition.face_locations')
+def test_cascade_maps_scaled_locations_back(mock_face_locations):
+    """Testa que o estágio em meia resolução devolve coordenadas da imagem original"""
+    mock_face_locations.return_value = [(10, 60, 60, 10)]
+    cascade = build_detection_cascade(total_budget=5.0)
+
+    detection = cascade.detect(np.zeros((480, 640, 3), dtype=np.uint8))
+
+    assert detection.stage == 'hog_fast'
+    assert detection.locations == [(20, 120, 120, 20)]
+    assert mock_face_locations.call_args[0][0].shape == (240, 320, 3)
+
+@patch('face_recognition.face_locations')
+def test_cascade_skips_stages_over_budget(mock_face_locations):
+    """Testa que o CNN é pulado quando o custo estimado passa do orçamento"""
+    mock_face_locations.return_value = []
+    cascade = DetectionCascade([
+        DetectionStage('hog', model='hog', budget=1.0, seconds_per_mpx=0.1),
+        DetectionStage('cnn', model='cnn', budget=1.0, seconds_per_mpx=8.0),
+    ], total_budget=2.0)
+
+    detection = cascade.detect(np.zeros((480, 640, 3), dtype=np.uint8))
+
+    assert detection.stage is None
+    assert detection.skipped == ['cnn']
+    assert [call.kwargs['model'] for call in mock_face_locations.call_args_list] == ['hog']
+
+@patch('face_recognition.face_locations')
+def test_cascade_retries_stage_after_one_slow_run(mock_face_locations):
+    """Testa que uma execução lenta isolada só tira o estágio da cascata por algumas detecções"""
+    mock_face_locations.return_value = []
+    cascade = build_detection_cascade(total_budget=1.5)
+    image = np.zeros((480, 640, 3), dtype=np.uint8)
+    hog = cascade.stages[1]
+    hog.observe(image.shape, 5.0)
+
+    skipped = [cascade.detect(image).skipped for _ in range(60)]
+
+    assert skipped[0] == ['hog']
+    assert [] in skipped
+    assert hog.estimate(image.shape) < hog.budget
+
+@patch('face_recognition.face_locations')
+def test_exhaustive_cascade_adds_faces_from_later_stages(mock_face_locations):
+    """Testa que, no login em lote, o upsample ainda roda e soma os rostos pequenos aos já achados"""
+    # Meia resolução: só o rosto grande; resolução cheia: o grande de novo e um pequeno no fundo
+    mock_face_locations.side_effect = [[(10, 60, 60, 10)], [(22, 118, 118, 22), (300, 420, 320, 400)]]
+    cascade = build_detection_cascade(total_budget=5.0, exhaustive=True)
+
+    detection = cascade.detect(np.zeros((480, 640, 3), dtype=np.uint8))
+
+    assert detection.locations == [(20, 120, 120, 20), (300, 420, 320, 400)]
+    assert detection.stage == 'hog_fast+hog'
+    assert mock_face_locations.call_count == 2
@@ -0,0 +1,147 @@
+import os
+import sys
+import numpy as np
+import face_recognition
+from datetime import datetime
+from PIL import Image
+from unittest.mock import patch, MagicMock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Improves', 'scripts'))
+from improved_face_recognition import ImprovedFaceRecognition, COSINE_WEIGHT, EUCLIDEAN_WEIGHT
+
+
+def make_system(gallery_path):
+    with patch('improved_face_recognition.cv2.CascadeClassifier', create=True):
+        return ImprovedFaceRecognition({}, gallery_path=str(gallery_path))
+
+def mock_db(system, rows):
+    """Banco mockado devolvendo as fotos cadastradas (u.id, u.nome, f.id, f.caminho, f.data_captura)"""
+    cursor = MagicMock()
+    cursor.fetchall.return_value = rows
+    conn = MagicMock()
+    conn.cursor.return_value = cursor
+    system.get_db_connection = MagicMock(return_value=conn)
+    return system.get_db_connection
+
+def test_gallery_reuses_saved_encodings(tmp_path, monkeypatch):
+    """Testa que fotos já processadas e não alteradas não são recalculadas"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('static/fotos')
+    for name in ('a.jpg', 'b.jpg'):
+        Image.new('RGB', (8, 8)).save(f'static/fotos/{name}')
+    rows = [
+        (1, 'Aluno 1', 10, '/static/fotos/a.jpg', datetime(2024, 3, 12, 10, 30)),
+        (2, 'Aluno 2', 20, '/static/fotos/b.jpg', datetime(2024, 3, 12, 10, 30)),
+    ]
+    encode = MagicMock(side_effect=lambda image: [np.random.rand(128)])
+    gallery_path = tmp_path / 'cache' / 'gallery.npz'
+
+    first = make_system(gallery_path)
+    mock_db(first, rows)
+    first.extract_multiple_encodings = encode
+    saved = first.refresh_gallery()
+    assert encode.call_count == 2
+    assert gallery_path.exists()
+
+    # Outro processo: a galeria vem do disco e só a foto recapturada é processada de novo
+    second = make_system(gallery_path)
+    mock_db(second, [rows[0], rows[1][:4] + (datetime(2024, 3, 13, 8, 0),)])
+    second.extract_multiple_encodings = encode
+    gallery = second.refresh_gallery()
+
+    assert encode.call_count == 3
+    assert list(gallery['foto_ids']) == [10, 20]
+    assert np.array_equal(gallery['encodings'][0], saved['encodings'][0])
+    assert not np.array_equal(gallery['encodings'][1], saved['encodings'][1])
+
+def test_gallery_does_not_reprocess_photo_without_face(tmp_path, monkeypatch):
+    """Testa que uma foto sem rosto fica registrada e só é reprocessada se mudar"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('static/fotos')
+    Image.new('RGB', (8, 8)).save('static/fotos/a.jpg')
+    row = (1, 'Aluno 1', 10, '/static/fotos/a.jpg', datetime(2024, 3, 12, 10, 30))
+    encode = MagicMock(return_value=[])
+    gallery_path = tmp_path / 'gallery.npz'
+
+    system = make_system(gallery_path)
+    system.extract_multiple_encodings = encode
+    mock_db(system, [row])
+    for _ in range(3):
+        gallery = system.refresh_gallery()
+
+    assert encode.call_count == 1
+    assert list(gallery['counts']) == [0]
+    assert len(gallery['encodings']) == 0
+
+    # Nem outro processo lendo a galeria do disco reprocessa a foto
+    other = make_system(gallery_path)
+    other.extract_multiple_encodings = encode
+    mock_db(other, [row])
+    other.refresh_gallery()
+    assert encode.call_count == 1
+
+    # Foto recapturada: processada de novo
+    mock_db(other, [row[:4] + (datetime(2024, 3, 13, 8, 0),)])
+    other.refresh_gallery()
+    assert encode.call_count == 2
+
+def test_get_gallery_does_not_query_database(tmp_path):
+    """Testa que o caminho do login só lê a galeria publicada (sem banco nem encoding)"""
+    system = make_system(tmp_path / 'gallery.npz')
+    get_db = mock_db(system, [])
+
+    gallery = system.get_gallery()
+
+    assert len(gallery['encodings']) == 0
+    get_db.assert_not_called()
+
+def test_similarity_scores_match_pairwise_formula(tmp_path):
+    """Testa que a versão matricial reproduz o score antigo calculado par a par"""
+    system = make_system(tmp_path / 'gallery.npz')
+    rng = np.random.default_rng(0)
+    captured = rng.normal(0, 0.1, (3, 128))
+    db = rng.normal(0, 0.1, (5, 128))
+
+    scores = system.calculate_similarity_scores(captured, db)
+
+    for i, probe in enumerate(captured):
+        for j, encoding in enumerate(db):
+            euclidean = face_recognition.face_distance([probe], encoding)[0]
+            cosine = np.dot(probe, encoding) / (np.linalg.norm(probe) * np.linalg.norm(encoding))
+            combined = (1 - cosine) * COSINE_WEIGHT + euclidean * EUCLIDEAN_WEIGHT
+            assert abs(scores['euclidean'][i, j] - euclidean) < 1e-15
+            assert abs(scores['cosine'][i, j] - cosine) < 1e-15
+            assert abs(scores['combined'][i, j] - combined) < 1e-15
+
+def test_similarity_scores_best_and_second_user(tmp_path):
+    """Testa o melhor e o segundo usuário por encoding capturado (linhas agrupadas por usuário)"""
+    system = make_system(tmp_path / 'gallery.npz')
+    rng = np.random.default_rng(1)
+    db = rng.normal(0, 0.1, (6, 128))
+    starts = np.array([0, 2, 3])  # usuário 0: linhas 0-1, usuário 1: linha 2, usuário 2: linhas 3-5
+    captured = np.stack([db[4] + 0.001, db[1] + 0.001])
+
+    scores = system.calculate_similarity_scores(captured, db, starts)
+
+    combined = scores['combined']
+    expected_user_scores = np.stack([combined[:, 0:2].min(axis=1), combined[:, 2], combined[:, 3:6].min(axis=1)], axis=1)
+    assert np.array_equal(scores['user_scores'], expected_user_scores)
+    for probe, best in enumerate([2, 0]):
+        ranking = np.argsort(expected_user_scores[probe])
+        assert scores['best_user'][probe] == best == ranking[0]
+        assert scores['second_user'][probe] == ranking[1]
+        assert scores['best_score'][probe] == expected_user_scores[probe, ranking[0]]
+        assert scores['second_score'][probe] == expected_user_scores[probe, ranking[1]]
+
+def test_similarity_scores_single_user(tmp_path):
+    """Testa que com um único usuário na galeria não há segundo colocado"""
+    system = make_system(tmp_path / 'gallery.npz')
+    rng = np.random.default_rng(2)
+    db = rng.normal(0, 0.1, (3, 128))
+
+    scores = system.calculate_similarity_scores(db[:2] + 0.001, db, np.array([0]))
+
+    assert list(scores['best_user']) == [0, 0]
+    assert list(scores['second_user']) == [-1, -1]
+    assert np.all(np.isinf(scores['second_score']))
+    assert np.array_equal(scores['best_score'], scores['combined'].min(axis=1))
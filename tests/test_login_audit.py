@@ -0,0 +1,113 @@
+from datetime import date, datetime, time
+from unittest.mock import MagicMock
+from login_audit import LoginAuditWriter
+
+
+def make_writer(conn, **kwargs):
+    writer = LoginAuditWriter(lambda: conn, **kwargs)
+    # Sem thread de fundo: os testes chamam flush() diretamente
+    writer.start = lambda: None
+    return writer
+
+def test_flush_writes_multi_row_insert():
+    """Testa que os logins enfileirados são gravados em um único lote"""
+    conn = MagicMock()
+    cursor = conn.cursor.return_value
+    writer = make_writer(conn)
+
+    writer.record(1, datetime(2024, 3, 12, 7, 30, 5, 123))
+    writer.record(2, datetime(2024, 3, 12, 7, 30, 6))
+    writer.flush()
+
+    cursor.executemany.assert_called_once()
+    rows = cursor.executemany.call_args[0][1]
+    assert rows == [(1, date(2024, 3, 12), time(7, 30, 5)), (2, date(2024, 3, 12), time(7, 30, 6))]
+    conn.commit.assert_called_once()
+    conn.close.assert_called_once()
+
+def test_record_many_uses_same_timestamp():
+    """Testa que os logins de um mesmo quadro vão juntos, com o mesmo horário"""
+    conn = MagicMock()
+    cursor = conn.cursor.return_value
+    writer = make_writer(conn)
+
+    assert writer.record_many([4, 5], datetime(2024, 3, 12, 7, 30, 5)) == []
+    writer.flush()
+
+    rows = cursor.executemany.call_args[0][1]
+    assert rows == [(4, date(2024, 3, 12), time(7, 30, 5)), (5, date(2024, 3, 12), time(7, 30, 5))]
+
+def test_record_many_returns_users_not_queued():
+    """Testa que, com a fila cheia, record_many informa quem ficou de fora"""
+    writer = make_writer(MagicMock(), max_queue=2)
+
+    assert writer.record_many([4, 5, 6]) == [6]
+
+def test_flush_respects_batch_size():
+    """Testa que o flush divide a fila em lotes do tamanho configurado"""
+    conn = MagicMock()
+    writer = make_writer(conn, batch_size=2)
+
+    for usuario_id in range(5):
+        writer.record(usuario_id)
+    writer.flush()
+
+    assert conn.cursor.return_value.executemany.call_count == 3
+
+def test_failed_write_keeps_events_queued():
+    """Testa que os eventos voltam para a fila quando o banco falha"""
+    writer = make_writer(None)
+
+    writer.record(1)
+    writer.flush()
+
+    assert writer.queue.qsize() == 1
+
+def test_background_thread_flushes_on_stop():
+    """Testa que a thread grava o que estiver pendente no desligamento"""
+    conn = MagicMock()
+    writer = LoginAuditWriter(lambda: conn, flush_interval=60)
+
+    writer.record(1)
+    writer.stop()
+
+    conn.cursor.return_value.executemany.assert_called_once()
+    assert writer.queue.empty()
+
+def test_flush_writes_login_encodings_and_prunes():
+    """Testa que o encoding da captura vai para encodings_usuario no mesmo lote"""
+    conn = MagicMock()
+    cursor = conn.cursor.return_value
+    writer = make_writer(conn, encoding_version=('small', 'hog-up1-w800'), max_login_encodings=3)
+
+    writer.record(1, datetime(2024, 3, 12, 7, 30, 5), encoding=b'blob')
+    writer.record(2, datetime(2024, 3, 12, 7, 30, 6))
+    writer.flush()
+
+    logins, encodings = cursor.executemany.call_args_list
+    assert len(logins[0][1]) == 2
+    assert encodings[0][1] == [(1, b'blob', 'small', 'hog-up1-w800')]
+    prune_query, prune_params = cursor.execute.call_args[0]
+    assert 'DELETE FROM encodings_usuario' in prune_query
+    assert prune_params == (1, 'login', 1, 'login', 3)
+    conn.commit.assert_called_once()
+
+def test_flush_updates_daily_attendance():
+    """Testa que o lote agrega a presença por dia e usuário antes do upsert"""
+    conn = MagicMock()
+    cursor = conn.cursor.return_value
+    writer = make_writer(conn, daily_attendance=True)
+
+    writer.record(1, datetime(2024, 3, 12, 7, 30, 5))
+    writer.record(2, datetime(2024, 3, 12, 7, 31))
+    writer.record(1, datetime(2024, 3, 12, 12, 0))
+    writer.flush()
+
+    assert cursor.executemany.call_count == 2
+    query, rows = cursor.executemany.call_args_list[1][0]
+    assert 'INSERT INTO presenca_diaria' in query
+    assert rows == [
+        (date(2024, 3, 12), 1, time(7, 30, 5), time(12, 0), 2),
+        (date(2024, 3, 12), 2, time(7, 31), time(7, 31), 1)
+    ]
+    conn.commit.assert_called_once()
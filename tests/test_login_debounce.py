@@ -0,0 +1,54 @@
+import os
+from unittest.mock import patch
+import login_debounce
+from login_debounce import RecentRecognitions
+
+
+def test_claim_within_window_returns_cached_response():
+    """Testa que só o primeiro reconhecimento na janela é novo"""
+    recent = RecentRecognitions(window=60)
+
+    assert recent.claim(1, {'name': 'Aluno 1'}, now=1000) == (True, {'name': 'Aluno 1'})
+    assert recent.claim(1, {'name': 'outro'}, now=1030) == (False, {'name': 'Aluno 1'})
+    assert recent.claim(2, None, now=1030)[0] is True
+    # Depois da janela o login volta a ser registrado
+    assert recent.claim(1, {'name': 'Aluno 1'}, now=1061)[0] is True
+
+def test_markers_are_shared_between_workers(tmp_path):
+    """Testa que instâncias diferentes (workers) combinam pelos marcadores em disco"""
+    worker_a = RecentRecognitions(window=60, directory=str(tmp_path))
+    worker_b = RecentRecognitions(window=60, directory=str(tmp_path))
+
+    assert worker_a.claim(7, {'name': 'Aluno 7'}, now=1000)[0] is True
+    assert worker_b.claim(7, {'name': 'Aluno 7'}, now=1010) == (False, {'name': 'Aluno 7'})
+    assert worker_b.claim(7, {'name': 'Aluno 7'}, now=1070)[0] is True
+    assert worker_a.claim(7, None, now=1075)[0] is False  # vale o marcador gravado pelo outro worker
+
+def test_disabled_window_always_records():
+    """Testa que a janela 0 desativa o controle"""
+    recent = RecentRecognitions(window=0)
+    assert recent.claim(1, now=1000)[0] is True
+    assert recent.claim(1, now=1000)[0] is True
+
+def test_release_undoes_claim_across_workers(tmp_path):
+    """Testa que um login não gravado (fila cheia) libera o usuário em todos os workers"""
+    worker_a = RecentRecognitions(window=60, directory=str(tmp_path))
+    worker_b = RecentRecognitions(window=60, directory=str(tmp_path))
+
+    assert worker_a.claim(7, {'name': 'Aluno 7'}, now=1000)[0] is True
+    worker_a.release(7)
+
+    assert worker_b.claim(7, {'name': 'Aluno 7'}, now=1001)[0] is True
+    assert worker_a.claim(7, None, now=1002)[0] is False
+
+def test_without_fcntl_uses_memory_only(tmp_path):
+    """Testa que, sem fcntl (Windows), o controle fica só em memória, sem marcadores"""
+    with patch.object(login_debounce, 'fcntl', None):
+        recent = RecentRecognitions(window=60, directory=str(tmp_path / 'marcadores'))
+
+        assert recent.claim(1, now=1000)[0] is True
+        assert recent.claim(1, now=1010)[0] is False
+        recent.release(1)
+        assert recent.claim(1, now=1020)[0] is True
+
+    assert not os.path.exists(tmp_path / 'marcadores')